@@ -1,2 +1,3 @@
 from .inmemorydb import InMemoryDB
 from .rocksdb import RocksDB
+from .sqlitedb import SqliteDB
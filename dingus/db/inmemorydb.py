@@ -4,6 +4,9 @@ from __future__ import annotations
 class InMemoryDB(object):
     def __init__(self) -> None:
         self.kv = {}
+        # keys at the first page of a sweep and the position of the next page in them
+        self._snapshot: list[bytes] = []
+        self._position = 0
 
     async def set(self, key: bytes, value: bytes) -> None:
         self.kv[key] = value
@@ -17,5 +20,25 @@ class InMemoryDB(object):
         if key in self.kv:
             del self.kv[key]
 
+    async def keys_page(self, after: bytes | None, limit: int) -> tuple[list[bytes], bytes | None]:
+        """
+        Return at most limit keys following after and the after of the next page, None after the last page.
+        The pages are read from a snapshot of the keys taken at the first page, in insertion order rather than
+        sorted, so a page costs O(limit): after must be the one returned with the previous page.
+        Keys set later are not listed and keys deleted later can still be.
+        """
+        if after is None:
+            self._snapshot = list(self.kv)
+            self._position = 0
+        elif self._position == 0 or self._snapshot[self._position - 1] != after:
+            raise ValueError("after is not the cursor of the previous page")
+        keys = self._snapshot[self._position : self._position + limit]
+        self._position += len(keys)
+        if len(keys) < limit:
+            self._snapshot = []
+            self._position = 0
+            return (keys, None)
+        return (keys, keys[-1])
+
     async def write(self) -> None:
         pass
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+import asyncio
+import os
+from pathlib import Path
+import sqlite3
+
+DEFAULT_CACHE_SIZE = 1 << 16
+
+
+class SqliteDB(object):
+    """
+    Persistent key-value store backed by sqlite in WAL mode.
+    set and delete are buffered in memory and flushed in a single transaction by write.
+    Reads go through the pending batch first, then an LRU cache of cache_size entries.
+    The sqlite calls run in order on a single worker thread, so reads and commits do not block the event loop.
+    """
+
+    def __init__(self, filename: str = "", cache_size: int = DEFAULT_CACHE_SIZE) -> None:
+        if not filename:
+            if "BASE_PATH" in os.environ:
+                self.filename = f"{os.environ['BASE_PATH']}/database/smt.sqlite"
+            else:
+                self.filename = "./database/smt.sqlite"
+        else:
+            self.filename = filename
+        Path(self.filename).parent.mkdir(parents=True, exist_ok=True)
+
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS kv (key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID")
+        self.db.commit()
+
+        # pending writes, a value of None marks a deletion
+        self.batch: dict[bytes, bytes | None] = {}
+        # batches handed to the worker thread and not committed yet, oldest first
+        self._flushing: list[dict[bytes, bytes | None]] = []
+        # number of committed batches, a read started before a commit is not cached
+        self._commits = 0
+        self._executor: ThreadPoolExecutor | None = None
+        self._executor_pid = 0
+        self.cache_size = cache_size
+        self.cache: OrderedDict[bytes, bytes] = OrderedDict()
+        self.stats = {
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "batch_writes": 0,
+        }
+
+    async def set(self, key: bytes, value: bytes) -> None:
+        self.batch[key] = value
+
+    async def get(self, key: bytes) -> bytes:
+        for batch in [self.batch] + self._flushing[::-1]:
+            if key in batch:
+                value = batch[key]
+                return b"" if value is None else value
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats["cache_hits"] += 1
+            return self.cache[key]
+
+        self.stats["cache_misses"] += 1
+        commits = self._commits
+        row = await self._run(self._select_value, key)
+        if row is None:
+            return b""
+
+        value = bytes(row[0])
+        if commits == self._commits:
+            self._cache_put(key, value)
+        return value
+
+    async def delete(self, key: bytes) -> None:
+        self.batch[key] = None
+
+    async def keys_page(self, after: bytes | None, limit: int) -> tuple[list[bytes], bytes | None]:
+        """
+        Return the stored keys greater than after in order, about limit of them, with the pending batch applied.
+        The second item is the after of the next page, None after the last page.
+        """
+        stored = await self._run(self._select_keys, after, limit)
+        last = stored[-1] if len(stored) == limit else None
+        keys = set(stored)
+        for batch in self._flushing + [self.batch]:
+            for k, v in batch.items():
+                if (after is None or k > after) and (last is None or k <= last):
+                    if v is None:
+                        keys.discard(k)
+                    else:
+                        keys.add(k)
+        return (sorted(keys), last)
+
+    async def write(self) -> None:
+        if len(self.batch) == 0:
+            return
+
+        batch = self.batch
+        self.batch = {}
+        self._flushing.append(batch)
+        to_set = [(k, v) for k, v in batch.items() if v is not None]
+        to_delete = [(k,) for k, v in batch.items() if v is None]
+        try:
+            await self._run(self._commit, to_set, to_delete)
+        except BaseException:
+            # the batch is pending again, under the writes made since
+            self.batch = {**batch, **self.batch}
+            raise
+        finally:
+            self._flushing.remove(batch)
+
+        for k, v in to_set:
+            if k in self.cache:
+                self.cache[k] = v
+        for (k,) in to_delete:
+            self.cache.pop(k, None)
+
+        self._commits += 1
+        self.stats["batch_writes"] += 1
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.db.close()
+
+    async def _run(self, fn: Callable, *args: Any) -> Any:
+        # a forked process does not inherit the worker thread, it starts its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._executor_pid = os.getpid()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _select_value(self, key: bytes) -> tuple[bytes] | None:
+        return self.db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+
+    def _select_keys(self, after: bytes | None, limit: int) -> list[bytes]:
+        if after is None:
+            rows = self.db.execute("SELECT key FROM kv ORDER BY key LIMIT ?", (limit,))
+        else:
+            rows = self.db.execute("SELECT key FROM kv WHERE key > ? ORDER BY key LIMIT ?", (after, limit))
+        return [bytes(row[0]) for row in rows]
+
+    def _commit(self, to_set: list[tuple[bytes, bytes]], to_delete: list[tuple[bytes]]) -> None:
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", to_set)
+            self.db.executemany("DELETE FROM kv WHERE key = ?", to_delete)
+
+    def _cache_put(self, key: bytes, value: bytes) -> None:
+        if self.cache_size <= 0:
+            return
+        self.cache[key] = value
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
@@ -1,6 +1,7 @@
 from .sparse_merkle_tree import SparseMerkleTree
 from .skip_merkle_tree import SkipMerkleTree
 from .skip_merkle_tree import verify as smt_verify
+from .skip_merkle_tree import verify_batch as smt_verify_batch
 from .hasher import TreeHasher
 from .merkle_tree import MerkleTree
 from .types import *
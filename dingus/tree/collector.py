@@ -0,0 +1,103 @@
+from typing import Coroutine, Any
+import time
+
+from .constants import EMPTY_HASH, GC_SWEEP_PAGE_SIZE
+
+
+class GarbageCollector(object):
+    """
+    Incremental mark-and-sweep collector over the content addressed node store of a tree.
+    A cycle marks the nodes reachable from the live roots taken when it starts, then deletes every other key of the store.
+    Nodes are never deleted because of one reference going away, so subtrees shared by hash are safe.
+
+    The work is split in bounded time slices by step. Nodes written while a cycle runs are shaded by the tree and
+    survive it: a node reachable at the end of the cycle was either reachable at its start or written since.
+    The collector owns the store, keys that are not reachable tree nodes are deleted too. The sweep reads the keys
+    of the store in pages of page_size keys, in key order: the page and the cursor are kept between the steps.
+
+    The tree provides _db, live_roots() returning the hashes of the roots to keep and node_children(data) returning
+    the hashes of the stored nodes referenced by the encoded node.
+    """
+
+    def __init__(self, tree, page_size: int = GC_SWEEP_PAGE_SIZE) -> None:
+        self.tree = tree
+        self.page_size = page_size
+        self._marked: set[bytes] = set()
+        self._shaded: set[bytes] = set()
+        self._mark_stack: list[bytes] | None = None
+        # keys of the current page still to sweep, in reverse order, and the cursor of the next page
+        self._sweep_keys: list[bytes] | None = None
+        self._sweep_cursor: bytes | None = None
+        self._sweep_more = False
+        self.stats = {
+            "cycles": 0,
+            "marked": 0,
+            "swept": 0,
+            "pages": 0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._mark_stack is not None or self._sweep_keys is not None
+
+    def shade(self, node_hash: bytes) -> None:
+        # Shaded nodes are kept apart from marked ones: a node written again during the mark phase
+        # must still be visited, its children were written before the cycle started.
+        if self.running:
+            self._shaded.add(node_hash)
+
+    async def step(self, time_slice: float) -> Coroutine[Any, Any, bool]:
+        # work for about time_slice seconds, at least one node. Return True when a cycle is completed.
+        deadline = time.monotonic() + time_slice
+        db = self.tree._db
+        if not self.running:
+            self._mark_stack = [h for h in self.tree.live_roots() if h != EMPTY_HASH]
+
+        while self._mark_stack is not None:
+            if len(self._mark_stack) == 0:
+                self._mark_stack = None
+                self._sweep_keys = []
+                self._sweep_cursor = None
+                self._sweep_more = True
+                break
+            node_hash = self._mark_stack.pop()
+            if node_hash not in self._marked:
+                self._marked.add(node_hash)
+                self.stats["marked"] += 1
+                data = await db.get(node_hash)
+                if data:
+                    self._mark_stack += self.tree.node_children(data)
+            if time.monotonic() > deadline:
+                return False
+
+        swept = 0
+        while len(self._sweep_keys) > 0 or self._sweep_more:
+            if len(self._sweep_keys) == 0:
+                # the keys before the cursor are swept, deletions can not move it
+                self._sweep_keys, self._sweep_cursor = await db.keys_page(self._sweep_cursor, self.page_size)
+                self._sweep_keys.reverse()
+                self._sweep_more = self._sweep_cursor is not None
+                self.stats["pages"] += 1
+            else:
+                key = self._sweep_keys.pop()
+                if key not in self._marked and key not in self._shaded:
+                    await db.delete(key)
+                    swept += 1
+            if time.monotonic() > deadline:
+                break
+        if swept > 0:
+            await db.write()
+            self.stats["swept"] += swept
+        if len(self._sweep_keys) > 0 or self._sweep_more:
+            return False
+
+        self._sweep_keys = None
+        self._marked = set()
+        self._shaded = set()
+        self.stats["cycles"] += 1
+        return True
+
+    async def collect(self) -> None:
+        # complete the running cycle, or run a full one
+        while not await self.step(float("inf")):
+            pass
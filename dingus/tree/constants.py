@@ -8,7 +8,17 @@ EMPTY_HASH_PLACEHOLDER_PREFIX = bytes.fromhex("02")
 
 DEFAULT_KEY_LENGTH = 32
 DEFAULT_SUBTREE_MAX_HEIGHT = 8
+MAX_SUBTREE_HEIGHT = 16
 DEFAULT_SUBTREE_NODES = 1 << DEFAULT_SUBTREE_MAX_HEIGHT
+DEFAULT_SUBTREE_CACHE_SIZE = 1 << 10
+DEFAULT_SUBTREE_CACHE_LAYERS = 2
+DEFAULT_UPDATE_WORKERS = 1
+DEFAULT_UPDATE_CONCURRENCY = 1
+DEFAULT_VERIFY_WORKERS = 1
+PARALLEL_UPDATE_MIN_KEYS = 1 << 12
+DEFAULT_VERSION_RETENTION = 0
+BULK_LOAD_BATCH_SIZE = 1 << 12
+GC_SWEEP_PAGE_SIZE = 1 << 10
 
 DEFAULT_HASHER = "tree"
 
@@ -12,3 +12,7 @@ class InvalidKeyError(Exception):
 
 class InvalidDataError(Exception):
     pass
+
+
+class InvalidHeightError(Exception):
+    pass
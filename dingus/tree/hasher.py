@@ -1,3 +1,5 @@
+from contextvars import ContextVar
+from functools import lru_cache
 from ecpy.curves import Curve, Point
 
 # import dingus.tree.types as types
@@ -13,6 +15,80 @@ ecc_generator = Point(
 )
 
 
+class HashCounter(object):
+    """
+    HashCounter.count is the total number of hashes computed by tree nodes and hashers in the process.
+    A HashCounter used as a context manager counts in hashes only the ones computed in its context: in the block
+    and in the asyncio tasks started from it, not in concurrent tasks of other trees. Counters can be nested.
+    """
+
+    count = 0
+
+    def __init__(self) -> None:
+        self.hashes = 0
+        self._token = None
+
+    def __enter__(self) -> "HashCounter":
+        self._token = _active_counters.set(_active_counters.get() + (self,))
+        return self
+
+    def __exit__(self, *args) -> None:
+        _active_counters.reset(self._token)
+
+    @classmethod
+    def add(cls, hashes: int) -> None:
+        cls.count += hashes
+        for counter in _active_counters.get():
+            counter.hashes += hashes
+
+
+_active_counters: ContextVar[tuple[HashCounter, ...]] = ContextVar("hash_counters", default=())
+
+
+def counted_hash(data: bytes) -> bytes:
+    HashCounter.count += 1
+    for counter in _active_counters.get():
+        counter.hashes += 1
+    return hash(data)
+
+
+# parent of two empty nodes, known in advance
+EMPTY_BRANCH_HASH = hash(BRANCH_PREFIX + EMPTY_HASH + EMPTY_HASH)
+
+
+@lru_cache(maxsize=1 << 12)
+def merge_plan(structure: tuple[int, ...]) -> tuple[tuple[int, int], ...]:
+    """
+    Return the pairs of indices hashed together, in order, to reduce a subtree with the given structure to its root.
+    Nodes take indices 0 to len(structure) - 1 and each merged pair takes the next free index, so the root is the last one.
+    """
+    structure = list(structure)
+    indices = list(range(len(structure)))
+    next_index = len(structure)
+    plan = []
+    for height in reversed(range(1, max(structure) + 1)):
+        _structure = []
+        _indices = []
+
+        i = 0
+        while i < len(structure):
+            if structure[i] == height:
+                plan.append((indices[i], indices[i + 1]))
+                _indices.append(next_index)
+                _structure.append(height - 1)
+                next_index += 1
+                i += 2
+            else:
+                _indices.append(indices[i])
+                _structure.append(structure[i])
+                i += 1
+        structure = _structure
+        indices = _indices
+
+    assert len(structure) == 1
+    return tuple(plan)
+
+
 class TreeHasher(object):
     empty = EMPTY_HASH
 
@@ -23,29 +99,18 @@ class TreeHasher(object):
             return nodes[0].hash
 
         hashes = [node.hash for node in nodes]
-
-        structure = list(structure)
-        for height in reversed(range(1, max(structure) + 1)):
-            _hashes = []
-            _structure = []
-
-            i = 0
-            while i < len(hashes):
-                if structure[i] == height:
-                    _hash = hash(BRANCH_PREFIX + hashes[i] + hashes[i + 1])
-                    _hashes.append(_hash)
-                    _structure.append(structure[i] - 1)
-
-                    i += 1
-                else:
-                    _hashes.append(hashes[i])
-                    _structure.append(structure[i])
-                i += 1
-            hashes = _hashes
-            structure = _structure
-
-        assert len(hashes) == 1
-        return hashes[0]
+        plan = merge_plan(tuple(structure))
+        skipped = 0
+        for i, j in plan:
+            left, right = hashes[i], hashes[j]
+            if left == EMPTY_HASH and right == EMPTY_HASH:
+                hashes.append(EMPTY_BRANCH_HASH)
+                skipped += 1
+            else:
+                hashes.append(hash(BRANCH_PREFIX + left + right))
+
+        HashCounter.add(len(plan) - skipped)
+        return hashes[-1]
 
 
 class ECCHasher(object):
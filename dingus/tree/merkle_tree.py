@@ -1,15 +1,169 @@
-from dingus.tree.constants import EMPTY_HASH, LEAF_PREFIX, BRANCH_PREFIX
+from __future__ import annotations
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable
+from dingus.tree.constants import EMPTY_HASH, LEAF_PREFIX, BRANCH_PREFIX, NODE_HASH_SIZE
+from dingus.tree.errors import InvalidDataError, MissingNodeError
+from dingus.tree.utils import encode_varint, decode_varint, merkle_root
 from dingus.crypto import hash
 import math
+import os
+
+
+@dataclass
+class MerkleProof(object):
+    """
+    Inclusion proof of the leaves at indexes in a tree of size leaves, as in LIP-0031.
+    indexes are sorted and unique. sibling_hashes are the roots of the subtrees without queried leaves
+    that are needed to compute the root, from left to right: siblings shared by several leaves are given once.
+    """
+
+    size: int
+    indexes: list[int]
+    sibling_hashes: list[bytes]
+
+
+class NodeStore(object):
+    """
+    Hashes of the complete subtrees of a MerkleTree by level and position, level 0 holds the leaf hashes.
+    Each level is an append-only array of concatenated hashes. With a directory, save appends the new hashes
+    of each level to its file: saved hashes are read from the files when needed, only the others are kept in memory.
+    """
+
+    def __init__(self, directory: str | None = None) -> None:
+        self.directory = directory
+        # hashes of each level in its file and the ones appended after the last save
+        self._saved: list[int] = []
+        self._pending: list[bytearray] = []
+        self._files: dict[int, BinaryIO] = {}
+        if directory is None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        while os.path.exists(self._filename(len(self._saved))):
+            # a hash partially written by an interrupted save is dropped
+            self._saved.append(os.path.getsize(self._filename(len(self._saved))) // NODE_HASH_SIZE)
+            self._pending.append(bytearray())
+
+    def _filename(self, level: int) -> str:
+        return os.path.join(self.directory, f"level_{level}")
+
+    def _file(self, level: int) -> BinaryIO:
+        if level not in self._files:
+            filename = self._filename(level)
+            self._files[level] = open(filename, "r+b" if os.path.exists(filename) else "w+b")
+        return self._files[level]
+
+    def count(self, level: int) -> int:
+        if level >= len(self._saved):
+            return 0
+        return self._saved[level] + len(self._pending[level]) // NODE_HASH_SIZE
+
+    def get(self, level: int, index: int) -> bytes:
+        if index >= self.count(level):
+            raise MissingNodeError(f"No node {index} at level {level}")
+        if index < self._saved[level]:
+            f = self._file(level)
+            f.seek(NODE_HASH_SIZE * index)
+            return f.read(NODE_HASH_SIZE)
+        offset = NODE_HASH_SIZE * (index - self._saved[level])
+        return bytes(self._pending[level][offset : offset + NODE_HASH_SIZE])
+
+    def extend(self, level: int, hashes: list[bytes]) -> None:
+        while len(self._saved) <= level:
+            self._saved.append(0)
+            self._pending.append(bytearray())
+        self._pending[level] += b"".join(hashes)
+
+    def truncate(self, size: int) -> None:
+        # keep the nodes of the first size leaves, the store can be ahead of the last saved tree
+        if self.count(0) < size:
+            raise MissingNodeError(f"The store holds {self.count(0)} leaves out of {size}")
+        for level in range(len(self._saved)):
+            count = size >> level
+            if self.count(level) < count:
+                raise MissingNodeError(f"The store misses nodes at level {level}")
+            # the files are truncated by the next save
+            del self._pending[level][NODE_HASH_SIZE * max(count - self._saved[level], 0) :]
+            self._saved[level] = min(self._saved[level], count)
+
+    def save(self) -> None:
+        if self.directory is None:
+            return
+        for level, pending in enumerate(self._pending):
+            f = self._file(level)
+            f.truncate(NODE_HASH_SIZE * self._saved[level])
+            f.seek(NODE_HASH_SIZE * self._saved[level])
+            f.write(pending)
+            f.flush()
+            os.fsync(f.fileno())
+            self._saved[level] += len(pending) // NODE_HASH_SIZE
+            self._pending[level] = bytearray()
+
+    def close(self) -> None:
+        for f in self._files.values():
+            f.close()
+        self._files = {}
 
 
 class MerkleTree(object):
-    def __init__(self, data: list[bytes] = []) -> None:
+    def __init__(self, data: list[bytes] = [], nodes: NodeStore | None = None) -> None:
         self.root = EMPTY_HASH
         self.size = 0
-        self.append_path = [self.root]
+        # roots of the complete subtrees indexed by level, the subtree of 2**i leaves is set if bit i of size is set
+        self._levels: list[bytes | None] = []
+        # with nodes, the hashes of all complete subtrees are kept to generate proofs
+        if nodes is not None and nodes.count(0) > 0:
+            raise InvalidDataError("The node store is not empty, use load")
+        self.nodes = nodes
         self.append(data)
 
+    @classmethod
+    def from_data(cls, data: bytes, nodes: NodeStore | None = None) -> MerkleTree:
+        # the tree is given by its size and append path, the leaves are not needed to append new ones
+        try:
+            size, offset = decode_varint(data, 0)
+        except IndexError:
+            raise InvalidDataError
+        tree = cls()
+        for level in range(size.bit_length()):
+            if (size >> level) & 1 == 0:
+                tree._levels.append(None)
+                continue
+            h = data[offset : offset + NODE_HASH_SIZE]
+            if len(h) != NODE_HASH_SIZE:
+                raise InvalidDataError
+            tree._levels.append(h)
+            offset += NODE_HASH_SIZE
+        if offset != len(data):
+            raise InvalidDataError
+        tree.size = size
+        tree.root = MerkleTree.root_from_append_path(tree.append_path)
+        if nodes is not None:
+            nodes.truncate(size)
+            tree.nodes = nodes
+        return tree
+
+    @property
+    def data(self) -> bytes:
+        return encode_varint(self.size) + b"".join(h for h in self._levels if h is not None)
+
+    @classmethod
+    def load(cls, filename: str, nodes: NodeStore | None = None) -> MerkleTree:
+        with open(filename, "rb") as f:
+            return cls.from_data(f.read(), nodes)
+
+    def save(self, filename: str) -> None:
+        # the nodes are saved first: the tree file never refers to nodes that are not saved
+        if self.nodes is not None:
+            self.nodes.save()
+        # write a new file and move it over the old one, a crash leaves either of them
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(self.data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
     @classmethod
     def leaf_hash(cls, data: bytes) -> bytes:
         return hash(LEAF_PREFIX + data)
@@ -19,60 +173,199 @@ class MerkleTree(object):
         return hash(BRANCH_PREFIX + data)
 
     @classmethod
-    def merkle_root(cls, data: list[bytes]) -> bytes:
+    def merkle_root(cls, data: Iterable[bytes]) -> bytes:
         """Returns the Merkle root from a list of bytes as specified 
         in https://github.com/LiskHQ/lips/blob/main/proposals/lip-0031.md#merkle-root
         """
 
-        size = len(data)
-        if size == 0:
-            return EMPTY_HASH
-        if size == 1:
-            return MerkleTree.leaf_hash(data[0])
+        return merkle_root(data)
 
-        # Largest power of two smaller than size
-        k = 2 ** (math.floor(math.log2(size - 1)))
-        # Split the data array into 2 subtrees. leftTree from index 0 to index k (not included), rightTree for the rest
-        left_tree = data[:k]
-        right_tree = data[k:]
-        return MerkleTree.branch_hash(MerkleTree.merkle_root(left_tree) + MerkleTree.merkle_root(right_tree))
+    @property
+    def append_path(self) -> list[bytes]:
+        # roots of the complete subtrees, from the lowest level up. The empty tree has the empty hash.
+        if self.size == 0:
+            return [EMPTY_HASH]
+        return [h for h in self._levels if h is not None]
 
     def append(self, data: list[bytes]) -> bytes:
         """
         Append new values to the tree.
+        Whole complete subtrees are hashed at once and the root is computed once, after the last value.
         """
 
-        for value in data:
-            self._append(value)
-
+        i = 0
+        while i < len(data):
+            # the largest complete subtree that fits in the remaining values and starts at size
+            level = (len(data) - i).bit_length() - 1
+            if self.size > 0:
+                level = min(level, (self.size & -self.size).bit_length() - 1)
+            n = 1 << level
+            self._push(self._subtree_root(data[i : i + n]), level)
+            self.size += n
+            i += n
+
+        if i > 0:
+            self.root = MerkleTree.root_from_append_path(self.append_path)
         return self.root
 
-    def _append(self, data: bytes) -> bytes:
+    def _push(self, h: bytes, level: int) -> None:
+        # add the root h of a complete subtree of 2**level leaves, merging it with the complete subtrees on its left
+        levels = self._levels
+        levels += [None] * (level - len(levels))
+        while level < len(levels) and levels[level] is not None:
+            h = MerkleTree.branch_hash(levels[level] + h)
+            levels[level] = None
+            level += 1
+            if self.nodes is not None:
+                self.nodes.extend(level, [h])
+        if level == len(levels):
+            levels.append(h)
+        else:
+            levels[level] = h
+
+    def _subtree_root(self, data: list[bytes]) -> bytes:
+        # root of the complete subtree of data, the number of values is a power of 2
+        layer = [MerkleTree.leaf_hash(d) for d in data]
+        level = 0
+        while True:
+            if self.nodes is not None:
+                self.nodes.extend(level, layer)
+            if len(layer) == 1:
+                return layer[0]
+            layer = [MerkleTree.branch_hash(layer[i] + layer[i + 1]) for i in range(0, len(layer), 2)]
+            level += 1
+
+    def _node(self, start: int, end: int) -> bytes:
+        # root of the leaves from start to end. start is a multiple of the largest power of 2 not above end - start,
+        # the range is made of complete subtrees of decreasing size.
+        if self.nodes is None:
+            raise MissingNodeError("The tree does not keep its nodes")
+        complete_roots = []
+        while start < end:
+            level = (end - start).bit_length() - 1
+            assert start % (1 << level) == 0
+            complete_roots.append(self.nodes.get(level, start >> level))
+            start += 1 << level
+        return MerkleTree.root_from_append_path(complete_roots[::-1])
+
+    def generate_proof(self, indexes: list[int]) -> MerkleProof:
         """
-        Append a new value to the tree.
+        Return the inclusion proof of the leaves at indexes.
+        The tree is split as in merkle_root, a subtree without queried leaves gives its root as a sibling hash.
         """
 
-        h = MerkleTree.leaf_hash(data)
-        if self.size == 0:
-            self.root = h
-            self.append_path = [h]
-            self.size += 1
-            return h
-
-        spliced = False
-        for i in range(math.floor(math.log2(self.size)) + 1):
-            if ((self.size >> i) & 1) == 1:
-                h = MerkleTree.branch_hash(self.append_path.pop(0) + h)
-            elif not spliced:
-                new_append_path = [h] + self.append_path
-                spliced = True
-        if not spliced:
-            new_append_path = [h]
-
-        self.root = h
-        self.append_path = new_append_path
-        self.size += 1
-        return self.root
+        indexes = sorted(set(indexes))
+        if len(indexes) > 0 and (indexes[0] < 0 or indexes[-1] >= self.size):
+            raise IndexError(f"Leaf index out of range for a tree of size {self.size}")
+        sibling_hashes: list[bytes] = []
+
+        def walk(start: int, end: int, i: int, j: int) -> None:
+            # indexes[i:j] are the queried leaves between start and end
+            if i == j:
+                sibling_hashes.append(self._node(start, end))
+                return
+            if end - start == 1:
+                return
+            k = 1 << ((end - start - 1).bit_length() - 1)
+            m = bisect_left(indexes, start + k, i, j)
+            walk(start, start + k, i, m)
+            walk(start + k, end, m, j)
+
+        walk(0, self.size, 0, len(indexes))
+        return MerkleProof(self.size, indexes, sibling_hashes)
+
+    @classmethod
+    def verify_proof(cls, data: list[bytes], proof: MerkleProof, root: bytes) -> bool:
+        # data holds the values of the leaves at proof.indexes, in the same order
+        indexes = proof.indexes
+        if len(data) != len(indexes) or indexes != sorted(set(indexes)):
+            return False
+        if len(indexes) > 0 and (indexes[0] < 0 or indexes[-1] >= proof.size):
+            return False
+        sibling_index = 0
+
+        def walk(start: int, end: int, i: int, j: int) -> bytes:
+            nonlocal sibling_index
+            if i == j:
+                if sibling_index == len(proof.sibling_hashes):
+                    raise InvalidDataError("Missing sibling hashes")
+                sibling_index += 1
+                return proof.sibling_hashes[sibling_index - 1]
+            if end - start == 1:
+                return MerkleTree.leaf_hash(data[i])
+            k = 1 << ((end - start - 1).bit_length() - 1)
+            m = bisect_left(indexes, start + k, i, j)
+            return MerkleTree.branch_hash(walk(start, start + k, i, m) + walk(start + k, end, m, j))
+
+        try:
+            computed_root = walk(0, proof.size, 0, len(indexes))
+        except InvalidDataError:
+            return False
+        return sibling_index == len(proof.sibling_hashes) and computed_root == root
+
+    def generate_consistency_proof(self, old_size: int, size: int | None = None) -> list[bytes]:
+        """
+        Return the proof that the tree of old_size leaves is a prefix of the tree of size leaves, the current one by default.
+        The trees of LIP-0031 are split as in RFC 6962, the proof is the one of its section 2.1.2.
+        """
+
+        size = self.size if size is None else size
+        if not 0 <= old_size <= size <= self.size:
+            raise IndexError(f"Invalid sizes {old_size} and {size} for a tree of size {self.size}")
+        proof: list[bytes] = []
+        if old_size == 0 or old_size == size:
+            return proof
+
+        def subproof(m: int, start: int, end: int, complete: bool) -> None:
+            # complete is True while the range is a subtree of the old tree whose root the verifier has
+            if m == end - start:
+                if not complete:
+                    proof.append(self._node(start, end))
+                return
+            k = 1 << ((end - start - 1).bit_length() - 1)
+            if m <= k:
+                subproof(m, start, start + k, complete)
+                proof.append(self._node(start + k, end))
+            else:
+                subproof(m - k, start + k, end, False)
+                proof.append(self._node(start, start + k))
+
+        subproof(old_size, 0, size, True)
+        return proof
+
+    @classmethod
+    def verify_consistency(cls, old_size: int, old_root: bytes, size: int, root: bytes, proof: list[bytes]) -> bool:
+        # as in RFC 9162, section 2.1.4.2
+        if not 0 <= old_size <= size:
+            return False
+        if old_size == 0 or old_size == size:
+            return len(proof) == 0 and (old_size == 0 or old_root == root)
+        if old_size & (old_size - 1) == 0:
+            # the old tree is a complete subtree, its root is not in the proof
+            proof = [old_root] + proof
+        if len(proof) == 0:
+            return False
+
+        fn = old_size - 1
+        sn = size - 1
+        while fn & 1:
+            fn >>= 1
+            sn >>= 1
+        fr = sr = proof[0]
+        for c in proof[1:]:
+            if sn == 0:
+                return False
+            if fn & 1 or fn == sn:
+                fr = MerkleTree.branch_hash(c + fr)
+                sr = MerkleTree.branch_hash(c + sr)
+                while fn & 1 == 0 and fn != 0:
+                    fn >>= 1
+                    sn >>= 1
+            else:
+                sr = MerkleTree.branch_hash(sr + c)
+            fn >>= 1
+            sn >>= 1
+        return sn == 0 and fr == old_root and sr == root
 
     @classmethod
     def get_right_witness(cls, size: int, data: list[bytes]) -> list[bytes]:
@@ -98,14 +391,16 @@ class MerkleTree(object):
 
             # d is the l-th binary digit of idx (from the right)
             d = (incremental_idx >> l) & 1
+            start = 0
             if d == 1:
-                witness.append(data.pop(0))
+                witness.append(data[0])
+                start = 1
                 # Complete the subtree after right hashing
                 incremental_idx += 1 << l
 
             # hash pairs of nodes from the right
             _data = []
-            for i in range(0, len(data), 2):
+            for i in range(start, len(data), 2):
                 if i + 1 < len(data):
                     _data.append(MerkleTree.branch_hash(data[i] + data[i + 1]))
                 else:
@@ -123,9 +418,8 @@ class MerkleTree(object):
         if len(append_path) == 0:
             return EMPTY_HASH
 
-        h = append_path.pop(0)
-        while len(append_path) > 0:
-            g = append_path.pop(0)
+        h = append_path[0]
+        for g in append_path[1:]:
             h = MerkleTree.branch_hash(g + h)
 
         return h
@@ -145,20 +439,25 @@ class MerkleTree(object):
         l = 0
         incremental_idx = size
         h = b""
-        while len(append_path) > 0 or len(right_witness) > 0:
+        # next hash of append_path and of right_witness, the lists are not modified
+        a = w = 0
+        while a < len(append_path) or w < len(right_witness):
             d = (size >> l) & 1
-            if len(append_path) > 0 and d == 1:
-                left_hash = append_path.pop(0)
+            if a < len(append_path) and d == 1:
+                left_hash = append_path[a]
+                a += 1
                 if not h:
-                    right_hash = right_witness.pop(0)
+                    right_hash = right_witness[w]
+                    w += 1
                     h = MerkleTree.branch_hash(left_hash + right_hash)
                     incremental_idx += 1 << l
                 else:
                     h = MerkleTree.branch_hash(left_hash + h)
 
             r = (incremental_idx >> l) & 1
-            if len(right_witness) > 0 and r == 1:
-                right_hash = right_witness.pop(0)
+            if w < len(right_witness) and r == 1:
+                right_hash = right_witness[w]
+                w += 1
                 h = MerkleTree.branch_hash(h + right_hash)
                 incremental_idx += 1 << l
 
@@ -1,677 +1,228 @@
 from __future__ import annotations
-from itertools import accumulate
+from bisect import bisect_left
 from dataclasses import dataclass
-from typing import Coroutine, Any
-import os.path
+from typing import Any
 
-from .hasher import TreeHasher, ECCHasher
+from . import skip_merkle_tree
 from .constants import (
     DEFAULT_KEY_LENGTH,
-    DEFAULT_SUBTREE_MAX_HEIGHT,
-    DEFAULT_HASHER,
     EMPTY_HASH,
     EMPTY_VALUE,
+    NODE_HASH_SIZE,
 )
 from .types import (
     BranchNode,
-    LeafNode,
-    SubTree,
-    EmptyNode,
-    TreeNode,
-    StubNode,
+    Query,
+    QueryWithProof,
 )
 from .errors import *
-from .utils import binary_expansion, binary_search, is_bit_set, binary_to_bytes
-from dingus.db import InMemoryDB, RocksDB
-
-@dataclass
-class Query(object):
-    key: bytes
-    value: bytes
-
-    def __post_init__(self) -> None:
-        self.hash = EMPTY_HASH if self.value == EMPTY_VALUE else LeafNode(self.key, self.value).hash
-
-    @property
-    def binary_path(self) -> str:
-        # Convert the key to binary
-        return binary_expansion(self.key)[: self.height]
-
-    @property
-    def binary_key(self) -> str:
-        # Convert the key to binary with fixed length
-        return binary_expansion(self.key)
-
-    def is_sibling_of(self, q: Query) -> bool:
-        # end of string is exclusive
-        if self.binary_key[: self.height - 1] != q.binary_key[: q.height - 1]:
-            return False
-
-        return (self.binary_key[self.height - 1] == "0" and q.binary_key[self.height - 1] == "1") or (
-            self.binary_key[self.height - 1] == "1" and q.binary_key[self.height - 1] == "0"
-        )
-
-
-@dataclass
-class QueryWithProof(Query):
-    ancestor_hashes: list[bytes]
-    sibling_hashes: list[bytes]
+from .utils import encode_varint, decode_varint
 
 
 @dataclass
 class Proof(object):
+    """
+    Proof with a single bitmap shared by the queries, the queries carry only their key and value.
+    The bitmap walks the part of the tree revealed by the proof from the root down, left child first:
+    - a node holding query keys has bit 1 if it is a branch on the way to the queries, 0 if the queries end there;
+    - the sibling of such a branch child has bit 1 if its hash is the next of sibling_hashes, 0 if it is empty.
+    The bits of a path shared by several queries are written once and the query heights are given by the walk.
+    The bitmap is padded with 0 bits to a whole byte.
+    """
+
     sibling_hashes: list[bytes]
     bitmap: bytes
     queries: list[Query]
 
-class SkipMerkleTree(object):
-    def __init__(
-        self,
-        key_length: int = DEFAULT_KEY_LENGTH,
-        subtree_height: int = DEFAULT_SUBTREE_MAX_HEIGHT,
-        db: str = "inmemorydb",
-        hasher=DEFAULT_HASHER,
-    ) -> None:
-        self.key_length = key_length
-        self.subtree_height = subtree_height
-        self.max_number_of_nodes = 1 << self.subtree_height
-        if hasher == "tree":
-            self.hasher = TreeHasher()
-        elif hasher == "ecc":
-            self.hasher = ECCHasher()
-        else:
-            self.hasher = TreeHasher()
-
-        self.root = SubTree([0], [EmptyNode()], self.hasher)
-        if db == "inmemorydb":
-            self._db = InMemoryDB()
-        elif db == "rocksdb":
-            self._db = RocksDB(filename="./database/skmt.db")
-        self.stats = {
-            "db_set": 0,
-            "db_get": 0,
-            "db_delete": 0,
-            "hashes": 0,
-            "leaf_created": 0,
-            "update_subtree_calls": 0,
-            "update_node_calls": 0,
-        }
-
-    async def print(self, subtree: SubTree | None = None, preamble: str = " ", hash_length: int = 4) -> str:
-        if subtree is None:
-            subtree = self.root
-        BROWN = lambda t: f"\u001b[38;2;{105};{103};{60}m" + t + "\u001b[0m"
-        head = f"{preamble*self.subtree_height}R:{subtree.hash.hex()[:hash_length]}\n"
-        body = []
-        for i in reversed(range(len(subtree.nodes))):
-            h, node = subtree.structure[i], subtree.nodes[i]
-            if i > 0:
-                connector = "├"
-            else:
-                connector = "╰"
-            if isinstance(node, EmptyNode):
-                body.append(preamble * self.subtree_height + connector + "──" * h + f"─<∅{h}")
-
-            elif isinstance(node, LeafNode):
-                key = node.key[:4]
-                bin_key = bin(int.from_bytes(key, "big")).lstrip("0b").zfill(8 * len(key))
-
-                body.append(
-                    preamble * self.subtree_height
-                    + connector
-                    + "──" * h
-                    + f"─<🌿{h} {node.key.hex()[:hash_length]}->{node.hash.hex()[:hash_length]}"
-                    # + f"─<🌿{h}:{bin_key[:0]}->{node.key.hex()[:hash_length]}:{node.hash.hex()[:hash_length]}"
-                )
-            elif isinstance(node, StubNode):
-                current_subtree = await self.get_subtree(node.hash)
-                ctp = await self.print(current_subtree, preamble + "  ")
-                _body = "\n".join(
-                    [
-                        f"{BROWN('─<B')}:{node.hash.hex()[:hash_length]}",
-                        f"{preamble*self.subtree_height}{BROWN('├')}{ctp}",
-                    ]
-                )
-
-                body.append(preamble * self.subtree_height + connector + "──" * h + _body)
-        return head + "\n".join(body)
-
-    async def get_subtree(self, node_hash: bytes) -> Coroutine[Any, Any, SubTree]:
-        if node_hash == EmptyNode.hash:
-            return SubTree([0], [EmptyNode()], self.hasher)
-
-        data = await self._db.get(node_hash)
-        self.stats["db_get"] += 1
-        if not data:
-            raise MissingNodeError
-
-        structure, nodes = SubTree.parse(data, self.key_length)
-        return SubTree(structure, nodes, self.hasher)
-
-    async def set_subtree(self, subtree: SubTree) -> None:
-        await self._db.set(subtree.hash, subtree.data)
-        self.stats["db_set"] += 1
-
-    async def write_to_db(self) -> None:
-        # re batch in memory nodes and write subtrees to db
-        await self._db.write()
-
-    async def update(
-        self,
-        keys: list[bytes],
-        values: list[bytes],
-    ) -> Coroutine[Any, Any, SubTree]:
-        """
-        As specified in from https:#github.com/LiskHQ/lips/blob/master/proposals/lip-0039.md
-        """
-
-        if len(keys) == 0:
-            return self.root
-
-        self.root = await self._update_subtree(keys, values, self.root, 0)
-        await self.write_to_db()
-        return self.root
-
-    async def _update_subtree(
-        self,
-        keys: list[bytes],
-        values: list[bytes],
-        current_subtree: SubTree,
-        height: int,
-        is_deleting: bool = True,
-    ) -> Coroutine[Any, Any, SubTree]:
-
-        self.stats["update_subtree_calls"] += 1
-        assert len(keys) == len(values)
-        assert (height % self.subtree_height) == 0
-        if len(keys) == 0:
-            return current_subtree
-
-        bin_keys: list[list[bytes]] = [[] for _ in range(self.max_number_of_nodes)]
-        bin_values: list[list[bytes]] = [[] for _ in range(self.max_number_of_nodes)]
-        b = height // 8
-
-        for i in range(len(keys)):
-            k, v = keys[i], values[i]
-
-            if self.subtree_height == 4:
-                if height % 8 == 0:  # upper half
-                    bin_idx = k[b] >> 4
-                elif height % 8 == 4:  # lower half
-                    bin_idx = k[b] & 15
-                else:
-                    raise InvalidKeyError
-            elif self.subtree_height == 8:
-                bin_idx = k[b]
-
-            bin_keys[bin_idx].append(k)
-            bin_values[bin_idx].append(v)
-
-        layer_nodes = []
-        layer_structure = []
-        V = 0
-        for i in range(len(current_subtree.nodes)):
-            h = current_subtree.structure[i]
-            current_node = current_subtree.nodes[i]
-            incr = 1 << (self.subtree_height - h)
-            base_length = list(accumulate([len(b) for b in bin_keys[V : V + incr]]))
-
-            _nodes, _heights = await self._update_node(
-                bin_keys[V : V + incr],
-                bin_values[V : V + incr],
-                base_length,
-                0,
-                current_node,
-                height,
-                h,
-            )
-            layer_nodes += _nodes
-            layer_structure += _heights
-            V += incr
-
-        assert V == self.max_number_of_nodes
-
-        if is_deleting:
-            # go through nodes again and push up empty nodes and single leaves, recursively
-            # this step is actually necessary only if we deleted some keys
-            for height in reversed(range(1, max(layer_structure) + 1)):
-                next_layer_nodes: list[TreeNode] = []
-                next_layer_structure: list[int] = []
-                i = 0
-                while i < len(layer_nodes):
-                    # pair node with next one
-                    if layer_structure[i] == height:
-                        # Push up empty node
-                        if isinstance(layer_nodes[i], EmptyNode) and isinstance(layer_nodes[i + 1], EmptyNode):
-                            parent_node = layer_nodes[i]
-                        # Push up leaf node
-                        elif isinstance(layer_nodes[i], EmptyNode) and isinstance(layer_nodes[i + 1], LeafNode):
-                            parent_node = layer_nodes[i + 1]
-                        # Push up leaf node
-                        elif isinstance(layer_nodes[i], LeafNode) and isinstance(layer_nodes[i + 1], EmptyNode):
-                            parent_node = layer_nodes[i]
-                        # Push up subtree node holding lower nodes. It will be unpacked later on
-                        else:
-                            if isinstance(layer_nodes[i], SubTree):
-                                left_nodes = layer_nodes[i].nodes
-                                left_structure = layer_nodes[i].structure
-                            else:
-                                left_nodes = [layer_nodes[i]]
-                                left_structure = [layer_structure[i]]
-                            if isinstance(layer_nodes[i + 1], SubTree):
-                                right_nodes = layer_nodes[i + 1].nodes
-                                right_structure = layer_nodes[i + 1].structure
-                            else:
-                                right_nodes = [layer_nodes[i + 1]]
-                                right_structure = [layer_structure[i + 1]]
-                            parent_node = SubTree(
-                                left_structure + right_structure,
-                                left_nodes + right_nodes,
-                                self.hasher,
-                            )
-
-                        next_layer_nodes.append(parent_node)
-                        next_layer_structure.append(layer_structure[i] - 1)
-                        i += 1
-                    # else just pass it up to next layer
-                    else:
-                        next_layer_nodes.append(layer_nodes[i])
-                        next_layer_structure.append(layer_structure[i])
-                    i += 1
-                layer_nodes = list(next_layer_nodes)
-                layer_structure = list(next_layer_structure)
-
-            assert len(layer_nodes) == 1
-            if isinstance(layer_nodes[0], SubTree):
-                # the last node is already a subtree, just assign it
-                new_subtree = layer_nodes[0]
-            else:
-                # the last node is an empty or leaf node, create a fake subtree that will be unpacked later
-                new_subtree = SubTree([0], layer_nodes, self.hasher)
-
-        else:
-            # we do not need to push up anything
-            new_subtree = SubTree(layer_structure, layer_nodes, self.hasher)
-
-        await self.set_subtree(new_subtree)
-        return new_subtree
-
-    async def _update_node(
-        self,
-        keys: list[list[bytes]],
-        values: list[list[bytes]],
-        bin_length: list[int],
-        base_length: int,
-        current_node: TreeNode,
-        height: int,
-        h: int,
-    ) -> Coroutine[Any, Any, tuple[list[TreeNode], list[int]]]:
-        assert height + h < 8 * self.key_length
-        assert len(keys) == len(values)
-        self.stats["update_node_calls"] += 1
-
-        total_data = bin_length[-1] - base_length
-        if total_data == 0:
-            return ([current_node], [h])
-
-        if total_data == 1:
-            idx = bin_length.index(base_length + 1)
-
-            if isinstance(current_node, EmptyNode):
-                # if the update value is non-empty, return a new leaf
-                if len(values[idx][0]) != 0:
-                    new_leaf = LeafNode(keys[idx][0], values[idx][0])
-                    self.stats["leaf_created"] += 1
-                    return ([new_leaf], [h])
-                # else return the empty node (deleting an empty node)
-                return ([current_node], [h])
-
-            if isinstance(current_node, LeafNode):
-                if current_node.key == keys[idx][0]:
-                    # if the update value is non-empty, update the leaf
-                    if len(values[idx][0]) != 0:
-                        new_leaf = LeafNode(keys[idx][0], values[idx][0])
-                        self.stats["leaf_created"] += 1
-                        return ([new_leaf], [h])
-                    # else return the empty node (deleting a leaf node)
-                    return ([EmptyNode()], [h])
-
-        # If we are at the bottom of the tree, we call update_subtree and return update nodes
-        if h == self.subtree_height:
-
-            if isinstance(current_node, StubNode):
-                # StubNode  can only be stored at bottom of subtree
-                btm_subtree = await self.get_subtree(current_node.hash)
-                await self._db.delete(current_node.hash)
-                self.stats["db_delete"] += 1
-
-            elif isinstance(current_node, EmptyNode):
-                btm_subtree = await self.get_subtree(EmptyNode.hash)
-
-            elif isinstance(current_node, LeafNode):
-                btm_subtree = SubTree([0], [current_node], self.hasher)
-
-            else:
-                raise InvalidDataError
-
-            assert len(keys) == len(values) == 1
-            new_subtree = await self._update_subtree(keys[0], values[0], btm_subtree, height + h)
-            if len(new_subtree.nodes) == 1:
-                # stub is empty or leaf
-                return ([new_subtree.nodes[0]], [h])
-            return ([StubNode(new_subtree.hash)], [h])
-
-        # Else, we just call _update_node and return the returned values
-        if isinstance(current_node, EmptyNode):
-            left_node = EmptyNode()
-            right_node = EmptyNode()
-        elif isinstance(current_node, LeafNode):
-            if is_bit_set(current_node.key, height + h):
-                left_node = EmptyNode()
-                right_node = current_node
-            else:
-                left_node = current_node
-                right_node = EmptyNode()
-        else:
-            print(type(current_node))
+    @classmethod
+    def from_data(cls, data: bytes) -> Proof:
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        try:
+            n_queries, offset = decode_varint(data, 0)
+            key_length, offset = decode_varint(data, offset)
+            queries = []
+            for _ in range(n_queries):
+                key = data[offset : offset + key_length]
+                value_length, offset = decode_varint(data, offset + key_length)
+                value = data[offset : offset + value_length]
+                if len(key) != key_length or len(value) != value_length:
+                    raise InvalidDataError
+                queries.append(Query(key, value, b""))
+                offset += value_length
+
+            bitmap_length, offset = decode_varint(data, offset)
+            bitmap = data[offset : offset + bitmap_length]
+            n_siblings, offset = decode_varint(data, offset + bitmap_length)
+            sibling_hashes = [data[offset + NODE_HASH_SIZE * i : offset + NODE_HASH_SIZE * (i + 1)] for i in range(n_siblings)]
+            offset += NODE_HASH_SIZE * n_siblings
+        except IndexError:
             raise InvalidDataError
+        if len(bitmap) != bitmap_length or offset != len(data):
+            raise InvalidDataError
+        return Proof(sibling_hashes, bitmap, queries)
 
-        idx = len(keys) // 2
-        left_nodes, left_heights = await self._update_node(
-            keys[:idx],
-            values[:idx],
-            bin_length[:idx],
-            base_length,
-            left_node,
-            height,
-            h + 1,
-        )
-        right_nodes, right_heights = await self._update_node(
-            keys[idx:],
-            values[idx:],
-            bin_length[idx:],
-            bin_length[idx - 1],
-            right_node,
-            height,
-            h + 1,
-        )
-
-        return (left_nodes + right_nodes, left_heights + right_heights)
-
-    async def generate_proof(self, query_keys: list[bytes]) -> Proof:
-        if len(query_keys) == 0:
-            return Proof([], [])
-
-        query_proofs: list[QueryWithProof] = [await self._generate_query_proof(self.root, k, 0) for k in query_keys]
-        
-        # prepare queries from single proofs, maintaining original order (same as query keys)
-        queries: list[Query] = [Query(sp.key, sp.value, sp.bitmap) for sp in query_proofs]
-        # sort by largest height (bottom first), smaller key (left first)
-        query_proofs = sorted(query_proofs, key=lambda q: (-q.height, q.key))
-        sibling_hashes: list[bytes] = []
-        ancestor_hashes: list[bytes] = [h for sp in query_proofs for h in sp.ancestor_hashes]
-
-        while len(query_proofs) > 0:
-            sp = query_proofs.pop(0)
-            if sp.height == 0:
-                continue
-
-            if sp.binary_bitmap[0] == "1":
-                node_hash = sp.sibling_hashes.pop()
-                if not node_hash in sibling_hashes and not node_hash in ancestor_hashes:
-                    sibling_hashes.append(node_hash)
-
-            sp.binary_bitmap = sp.binary_bitmap[1:]
-            query_proofs = insert_and_filter_queries(sp, query_proofs)
-
-        return Proof(sibling_hashes, queries)
-
-    async def _generate_query_proof(self, current_subtree: SubTree, query_key: bytes, height: int) -> QueryWithProof:
-        if len(query_key) != self.key_length:
-            raise Exception('Invalid length of query_key')
-        b = height // 8
-        if self.subtree_height == 4:
-            if height % 8 == 0:  # upper half
-                bin_idx = query_key[b] >> 4
-            elif height % 8 == 4:  # lower half
-                bin_idx = query_key[b] & 15
-            else:
+    @property
+    def data(self) -> bytes:
+        # varint counts and lengths, query keys of a common length, the bitmap and the sibling hashes
+        key_length = len(self.queries[0].key) if len(self.queries) > 0 else 0
+        parts = [encode_varint(len(self.queries)), encode_varint(key_length)]
+        for q in self.queries:
+            if len(q.key) != key_length:
                 raise InvalidKeyError
-        elif self.subtree_height == 8:
-            bin_idx = query_key[b]
-        V = 0
-        for i in range(len(current_subtree.nodes)):
-            h = current_subtree.structure[i]
-            current_node = current_subtree.nodes[i]
-            incr = 1 << (self.subtree_height - h)
-            if V <= bin_idx < V + incr:
-                break 
-            V += incr
-        
-        max_id = 0
-        for i in range(len(current_subtree.nodes)):
-            current_subtree.nodes[i].id = int(max_id)
-            max_id += 1
-        
-        query_height = int(h)
-        # target_node = current_node
-        target_id = current_node.id
-        
-        ancestor_hashes = []
-        sibling_hashes = []
-
-        nodes = list(current_subtree.nodes)
-        structure = list(current_subtree.structure)
-        binary_bitmap = ""
-
-        # Calculate ancestor and sibling hashes using the target_node as starting point
-        # Recalculate internal hashes from the stored current_subtree.nodes, while appending to sibling_hashes the one needed in the queried path.
-        for s in reversed(range(1, max(structure) + 1)):
-            _nodes = []
-            _structure = []
-
-            i = 0
-            while i < len(nodes):
-                if structure[i] == s:
-                    parent_node = BranchNode(nodes[i].hash, nodes[i + 1].hash)
-                    parent_node.id = int(max_id)
-                    max_id += 1
-                    _nodes.append(parent_node)
-                    _structure.append(structure[i] - 1)
-                    # check if the target node is the next
-                    # 'is' operator checks equality of pointers
-                    # if target_node is nodes[i]:
-                    if target_id == nodes[i].id:
-                        ancestor_hashes.insert(0, parent_node.hash)
-                        target_id = parent_node.id
-                        if isinstance(nodes[i + 1], EmptyNode):
-                            binary_bitmap = binary_bitmap + "0"
-                        else:
-                            binary_bitmap = binary_bitmap + "1"
-                            sibling_hashes.insert(0, nodes[i + 1].hash)
-                    # 'is' operator checks equality of pointers
-                    # elif target_node is nodes[i + 1]:
-                    elif target_id == nodes[i+1].id:
-                    # elif (target_node and target_node.hash == nodes[i+1].hash) or (target_node == None and target_node_idx == i+1):
-                        ancestor_hashes.insert(0, parent_node.hash)
-                        target_id = parent_node.id
-                        if isinstance(nodes[i], EmptyNode):
-                            binary_bitmap = binary_bitmap + "0"
-                        else:
-                            binary_bitmap = binary_bitmap + "1"
-                            sibling_hashes.insert(0, nodes[i].hash)
-                    i += 1
-                else:
-                    _nodes.append(nodes[i])
-                    _structure.append(structure[i])
-                i += 1
-            nodes = _nodes
-            structure = _structure
-
-        if isinstance(current_node, EmptyNode):
-            return QueryWithProof(query_key, EMPTY_VALUE, binary_to_bytes(binary_bitmap), ancestor_hashes, sibling_hashes)
-
-        elif isinstance(current_node, LeafNode):
-            ancestor_hashes.append(current_node.hash)
-            return QueryWithProof(
-                current_node.key,
-                current_node.value,
-                binary_to_bytes(binary_bitmap),
-                ancestor_hashes,
-                sibling_hashes,
-            )
+            parts += [q.key, encode_varint(len(q.value)), q.value]
+        parts += [encode_varint(len(self.bitmap)), self.bitmap, encode_varint(len(self.sibling_hashes))]
+        parts += self.sibling_hashes
+        return b"".join(parts)
+
+
+class SharedBitmap(skip_merkle_tree.ProofLayout):
+    # a single bitmap for all queries, the sibling hashes from the root down, left first
+    def merge(self, query_proofs: list[QueryWithProof]) -> Proof:
+        return merge_query_proofs(query_proofs)
+
+    def verify(self, query_keys: list[bytes], proof: Proof, merkle_root: bytes, key_length: int = DEFAULT_KEY_LENGTH) -> bool:
+        return verify(query_keys, proof, merkle_root, key_length)
+
+
+class SkipMerkleTree(skip_merkle_tree.SkipMerkleTree):
+    # the skip Merkle tree giving proofs with a shared bitmap
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        kwargs.setdefault("proof_layout", SharedBitmap())
+        super().__init__(*args, **kwargs)
+
+
+def _unique_by_key(queries: list[Query]) -> list[Query]:
+    # queries sorted by key, one for each key
+    unique: dict[bytes, Query] = {}
+    for q in queries:
+        unique.setdefault(q.key, q)
+    return [unique[k] for k in sorted(unique)]
+
+
+def merge_query_proofs(query_proofs: list[QueryWithProof]) -> Proof:
+    queries = [Query(sp.key, sp.value, b"") for sp in query_proofs]
+    if len(query_proofs) == 0:
+        return Proof([], b"", [])
+
+    key_bits = query_proofs[0].key_bits
+    proofs = _unique_by_key(query_proofs)
+    key_ints = [sp.key_int for sp in proofs]
+    bits: list[str] = []
+    sibling_hashes: list[bytes] = []
+
+    def sibling(sp: QueryWithProof, depth: int) -> None:
+        # sibling at depth + 1 on the path of sp, given by the bit at depth of its bitmap from the least significant one
+        if (sp.bitmap_int >> depth) & 1 == 0:
+            bits.append("0")
+            return
+        bits.append("1")
+        # the sibling hashes of sp are its non-empty siblings from the root down
+        sibling_hashes.append(sp.sibling_hashes[(sp.bitmap_int & ((1 << depth) - 1)).bit_count()])
+
+    def walk(lo: int, hi: int, depth: int) -> None:
+        if proofs[lo].height == depth:
+            # the queries end at this node, a leaf or an empty node
+            bits.append("0")
+            return
+        bits.append("1")
+        prefix = key_ints[lo] >> (key_bits - depth)
+        mid = bisect_left(key_ints, ((prefix << 1) | 1) << (key_bits - depth - 1), lo, hi)
+        if mid == lo:
+            sibling(proofs[lo], depth)
+        else:
+            walk(lo, mid, depth + 1)
+        if mid == hi:
+            sibling(proofs[lo], depth)
+        else:
+            walk(mid, hi, depth + 1)
 
-        elif isinstance(current_node, StubNode):
-            assert height % self.subtree_height == 0
-            lower_subtree = await self.get_subtree(current_node.hash)
-            lower_query_proof: QueryWithProof = await self._generate_query_proof(lower_subtree, query_key, height + query_height)
-            # In the skip Merkle tree we have to handle hashes and bitmap from lower layers
-           
-            return QueryWithProof(
-                lower_query_proof.key,
-                lower_query_proof.value,
-                binary_to_bytes(lower_query_proof.binary_bitmap + binary_bitmap),
-                ancestor_hashes + lower_query_proof.ancestor_hashes,
-                sibling_hashes + lower_query_proof.sibling_hashes,
-            )
+    walk(0, len(proofs), 0)
+    binary_bitmap = "".join(bits)
+    binary_bitmap += "0" * (-len(binary_bitmap) % 8)
+    bitmap = int(binary_bitmap, 2).to_bytes(len(binary_bitmap) // 8, "big")
+    return Proof(sibling_hashes, bitmap, queries)
 
 
-def insert_and_filter_queries(q: QueryWithProof or Query, queries: list[QueryWithProof or Query]) -> list[QueryWithProof or Query]:
+def calculate_root(sibling_hashes: list[bytes], bitmap: bytes, queries: list[Query]) -> tuple[bytes, dict[bytes, int]]:
+    """
+    Return the root hash and the height of the node of each query key, walking the bitmap.
+    Raise InvalidDataError if the bitmap and the sibling hashes do not match the queries.
+    """
+    heights: dict[bytes, int] = {}
     if len(queries) == 0:
-        return [q]
-
-    insert_index = binary_search(
-        queries,
-        lambda p: (q.height == p.height and q.key < p.key) or (q.height > p.height),
-    )
-
-    if insert_index == len(queries):
-        return queries + [q]
-    
-    p = queries[insert_index]
-    # if not p.binary_path.endswith(q.binary_path, p.height):
-    if p.binary_path != q.binary_path:
-        queries.insert(insert_index, q)
-
-    return queries
+        return (EMPTY_HASH, heights)
+
+    key_bits = queries[0].key_bits
+    queries = _unique_by_key(queries)
+    key_ints = [q.key_int for q in queries]
+    bitmap_int = int.from_bytes(bitmap, "big")
+    n_bits = 8 * len(bitmap)
+    cursor = [0, 0]  # next bit, next sibling hash
+
+    def read_bit() -> int:
+        if cursor[0] == n_bits:
+            raise InvalidDataError("Bitmap too short")
+        cursor[0] += 1
+        return (bitmap_int >> (n_bits - cursor[0])) & 1
+
+    def sibling() -> bytes:
+        if read_bit() == 0:
+            return EMPTY_HASH
+        if cursor[1] == len(sibling_hashes):
+            raise InvalidDataError("Missing sibling hashes")
+        cursor[1] += 1
+        return sibling_hashes[cursor[1] - 1]
+
+    def walk(lo: int, hi: int, depth: int) -> bytes:
+        if read_bit() == 0:
+            # several queries can end at the same empty node, a leaf is given by a single query key
+            node_hash = queries[lo].hash
+            if hi - lo > 1 and any(q.value != EMPTY_VALUE for q in queries[lo:hi]):
+                raise InvalidDataError("Queries end at different nodes")
+            for q in queries[lo:hi]:
+                heights[q.key] = depth
+            return node_hash
+        if depth == key_bits:
+            raise InvalidDataError("Bitmap deeper than the keys")
+        prefix = key_ints[lo] >> (key_bits - depth)
+        mid = bisect_left(key_ints, ((prefix << 1) | 1) << (key_bits - depth - 1), lo, hi)
+        left_hash = sibling() if mid == lo else walk(lo, mid, depth + 1)
+        right_hash = sibling() if mid == hi else walk(mid, hi, depth + 1)
+        return BranchNode(left_hash, right_hash).hash
+
+    root_hash = walk(0, len(queries), 0)
+    # only the padding bits are left
+    padding = n_bits - cursor[0]
+    if cursor[1] != len(sibling_hashes) or padding >= 8 or bitmap_int & ((1 << padding) - 1) != 0:
+        raise InvalidDataError("Unused proof data")
+    return (root_hash, heights)
 
 
 def verify(query_keys: list[bytes], proof: Proof, merkle_root: bytes, key_length: int = DEFAULT_KEY_LENGTH) -> bool:
     if len(query_keys) != len(proof.queries):
         return False
-
+    values: dict[bytes, bytes] = {}
     for key, query in zip(query_keys, proof.queries):
-        # The bitmap does not contain extra leading 0s
-        if query.bitmap[0] == 0:
+        if len(key) != key_length or len(query.key) != key_length:
             return False
-        # q is an inclusion proof for k or a default empty node
-        if len(key) != key_length:
+        # queries for the same key are the same
+        if values.setdefault(query.key, query.value) != query.value:
             return False
+
+    try:
+        root_hash, heights = calculate_root(proof.sibling_hashes, proof.bitmap, proof.queries)
+    except InvalidDataError:
+        return False
+    if root_hash != merkle_root:
+        return False
+
+    for key, query in zip(query_keys, proof.queries):
+        # q is an inclusion proof for k or a default empty node
         if key == query.key:
             continue
-
-        # q is an inclusion proof for another leaf node
-        common_prefix = os.path.commonprefix([binary_expansion(query.key), binary_expansion(key)])
-        if len(query.binary_bitmap) > len(common_prefix):
-            # q does not give an non-inclusion proof for k
+        # q is a leaf or an empty node on the path of k
+        common_prefix_length = 8 * key_length - (int.from_bytes(key, "big") ^ query.key_int).bit_length()
+        if heights[query.key] > common_prefix_length:
             return False
-
-    
-    filtered_queries = []
-    filter: dict[bytes, bool] = {}
-    for q in proof.queries:
-        # Remove duplicate queries preserving order. 
-        # This can happen if the same query is given for different query_keys, as for inclusion proofs or non-inclusion proofs pointing to a leaf node
-        # or for non-inclusion proofs pointing to the same empty node. 
-        # To do this, we check the binary path (key binary expansion up to the query height)
-        if q.binary_path not in filter:
-            filtered_queries.append(q)
-            filter[q.binary_path] = True
-        
-    return calculate_root(proof.sibling_hashes, filtered_queries) == merkle_root
-
-
-def calculate_root(sibling_hashes: list[bytes], queries: list[Query]) -> bytes:
-    sorted_queries = sorted(queries, key=lambda q: (-q.height, q.key))
-
-    while len(sorted_queries) > 0:
-        q = sorted_queries.pop(0)
-
-        # We reached the top of the tree, return merkle root
-        if q.height == 0:
-            # To avoid appending useless bits to all query bitmaps
-            assert len(q.binary_bitmap) == 0
-            return q.hash
-
-        # we distinguish three cases for the sibling hash:
-        # 1. sibling is next element of sorted_queries
-        if len(sorted_queries) > 0 and q.is_sibling_of(sorted_queries[0]):
-            sibling_hash = sorted_queries[0].hash
-            
-            if sorted_queries[0].hash == EMPTY_HASH:
-                # print(sorted_queries[0].hash.hex())
-                assert q.binary_bitmap[0] == "0"
-            else:
-                assert q.binary_bitmap[0] == "1"
-            if q.hash == EMPTY_HASH:
-                assert sorted_queries[0].binary_bitmap[0] == "0"
-            else:
-                assert sorted_queries[0].binary_bitmap[0] == "1"
-            del sorted_queries[0]
-        # 2. sibling is default empty node
-        elif q.binary_bitmap[0] == "0":
-            sibling_hash = EMPTY_HASH
-        # 3. sibling hash comes from sibling_hashes
-        elif q.binary_bitmap[0] == "1":
-            sibling_hash = sibling_hashes.pop(0)
-
-        d = q.binary_key[q.height - 1]
-        if d == "0":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", q.hash.hex()[:4], sibling_hash.hex()[:4], " --> ", BranchNode(q.hash, sibling_hash).hash.hex()[:4])
-            q.hash = BranchNode(q.hash, sibling_hash).hash
-        elif d == "1":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", sibling_hash.hex()[:4], q.hash.hex()[:4], " --> ", BranchNode(sibling_hash, q.hash).hash.hex()[:4])
-            q.hash = BranchNode(sibling_hash, q.hash).hash
-
-        q.binary_bitmap = q.binary_bitmap[1:]
-        sorted_queries = insert_and_filter_queries(q, sorted_queries)
-
-    raise Exception("Can not calculate root hash")
-
-
-def is_inclusion_proof(query_key: bytes, query: Query) -> bool:
-    return query_key == query.key and query.value != EMPTY_VALUE
-
-
-def create_test_case(n: int, key_length: int = 2) -> list[tuple[bytes, bytes]]:
-    from dingus.crypto import hash
-    keys = sorted([os.urandom(key_length) for _ in range(n)])
-    keys_set = {}
-    for i, key in enumerate(keys):
-        if key in keys_set:
-            keys.pop(i)
-        keys_set[key] = True
-
-    values = [hash(k) for k in keys]
-
-    return (keys, values)
-    
-async def testing():
-    import time
-    initial_keys, initial_values = create_test_case(12)
-    extra_keys, extra_values = initial_keys[:20], initial_values[:20]
-    _smt = SkipMerkleTree()
-    assert _smt.root.hash == EMPTY_HASH
-    start_time = time.time()
-    new_root = await _smt.update(initial_keys, initial_values)
-    assert _smt.root.hash == new_root.hash
-    print(f"create SMT tree with {len(initial_keys)} leaves: {time.time() - start_time:.2f}s")
-
-    start_time = time.time()
-    extra_new_root = await _smt.update(extra_keys, extra_values)
-    assert _smt.root.hash == extra_new_root.hash
-    print(await _smt.print(_smt.root))
-    return _smt
-if __name__ == "__main__":
-    import asyncio
-    asyncio.run(testing())
\ No newline at end of file
+    return True
@@ -1,12 +1,29 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from heapq import heappop, heappush
 from itertools import accumulate
-from typing import Coroutine, Any
+from typing import Callable, Coroutine, Any, Iterable
+import asyncio
+import copy
+import multiprocessing
 import os.path
 import uuid
 
-from .hasher import TreeHasher, ECCHasher
+from .collector import GarbageCollector
+from .hasher import TreeHasher, ECCHasher, HashCounter
 from .constants import (
     DEFAULT_KEY_LENGTH,
     DEFAULT_SUBTREE_MAX_HEIGHT,
+    MAX_SUBTREE_HEIGHT,
+    DEFAULT_SUBTREE_CACHE_SIZE,
+    DEFAULT_SUBTREE_CACHE_LAYERS,
+    DEFAULT_UPDATE_WORKERS,
+    DEFAULT_VERIFY_WORKERS,
+    DEFAULT_VERSION_RETENTION,
+    BULK_LOAD_BATCH_SIZE,
+    PARALLEL_UPDATE_MIN_KEYS,
     DEFAULT_HASHER,
     EMPTY_HASH,
     EMPTY_VALUE,
@@ -21,10 +38,12 @@ from .types import (
     EmptyNode,
     TreeNode,
     StubNode,
+    VerifyFailure,
+    VerifyResult,
 )
 from .errors import *
-from .utils import binary_expansion, binary_search, is_bit_set, binary_to_bytes
-from dingus.db import InMemoryDB, RocksDB
+from .utils import is_bit_set, binary_to_bytes
+from dingus.db import InMemoryDB, RocksDB, SqliteDB
 
 
 class SkipMerkleTree(object):
@@ -34,10 +53,20 @@ class SkipMerkleTree(object):
         subtree_height: int = DEFAULT_SUBTREE_MAX_HEIGHT,
         db: str = "inmemorydb",
         hasher=DEFAULT_HASHER,
+        cache_size: int = DEFAULT_SUBTREE_CACHE_SIZE,
+        cache_layers: int = DEFAULT_SUBTREE_CACHE_LAYERS,
+        workers: int = DEFAULT_UPDATE_WORKERS,
+        retention: int | None = DEFAULT_VERSION_RETENTION,
+        gc_slice: float | None = None,
+        proof_layout: "ProofLayout | None" = None,
     ) -> None:
+        if not 1 <= subtree_height <= MAX_SUBTREE_HEIGHT:
+            raise InvalidHeightError(f"Subtree height must be between 1 and {MAX_SUBTREE_HEIGHT}")
         self.key_length = key_length
         self.subtree_height = subtree_height
         self.max_number_of_nodes = 1 << self.subtree_height
+        # bytes of the node count in the encoded subtrees
+        self.count_size = 1 if subtree_height <= 8 else 2
         if hasher == "tree":
             self.hasher = TreeHasher()
         elif hasher == "ecc":
@@ -50,6 +79,41 @@ class SkipMerkleTree(object):
             self._db = InMemoryDB()
         elif db == "rocksdb":
             self._db = RocksDB(filename="./database/skmt.db")
+        elif db == "sqlitedb":
+            self._db = SqliteDB(filename="./database/skmt.sqlite")
+
+        # LRU cache of decoded subtrees keyed by hash, holding only the top cache_layers subtree layers
+        # that every update and proof goes through.
+        # Dirty subtrees are kept encoded in _dirty and deleted ones in _deleted until write_to_db, so eviction never drops them.
+        self.cache_size = cache_size
+        self.cache_height = cache_layers * subtree_height
+        self._cache: OrderedDict[bytes, SubTree] = OrderedDict()
+        self._dirty: dict[bytes, bytes] = {}
+        self._deleted: set[bytes] = set()
+
+        # With workers > 1, large updates compute the subtrees below the root in a pool of forked processes.
+        # _bin_updates holds their results by root bin until the sequential update reaches them.
+        self.workers = workers
+        self._bin_updates: dict[int, tuple[TreeNode, TreeNode, dict[bytes, bytes], dict[bytes, int], dict[str, int], int]] = {}
+        # Counts the removed leaves and the deletions below a split node while updating.
+        # The push-up pass of _update_subtree runs only if it changed during the update of the subtree.
+        self._removals = 0
+
+        # Root hashes are kept by height in versions. Subtrees replaced by an update are retired with their size:
+        # they become stale at the update height and stay in the db while an older retained version can reach them.
+        # retention is the number of versions kept besides the latest one, None keeps all of them.
+        self.retention = retention
+        self.versions: OrderedDict[int, bytes] = OrderedDict()
+        self._retired: dict[bytes, int] = {}
+        self._stale: OrderedDict[bytes, tuple[int, int]] = OrderedDict()
+
+        # With gc_slice set, stale subtrees are not deleted by the tree: after each update a garbage collector
+        # runs for gc_slice seconds and deletes the subtrees no retained version can reach.
+        self.gc_slice = gc_slice
+        self._collector = GarbageCollector(self) if gc_slice is not None else None
+
+        # generate_proof returns proofs in the layout of proof_layout, a bitmap per query by default
+        self.proof_layout = proof_layout if proof_layout is not None else QueryBitmaps()
         self.stats = {
             "db_set": 0,
             "db_get": 0,
@@ -58,6 +122,13 @@ class SkipMerkleTree(object):
             "leaf_created": 0,
             "update_subtree_calls": 0,
             "update_node_calls": 0,
+            "push_up_passes": 0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "versions": 0,
+            "stale_subtrees": 0,
+            "stale_bytes": 0,
+            "db_bytes": 0,
         }
 
     async def print(self, subtree: SubTree | None = None, preamble: str = " ", hash_length: int = 4) -> str:
@@ -99,42 +170,248 @@ class SkipMerkleTree(object):
                 body.append(preamble * self.subtree_height + connector + "──" * h + _body)
         return head + "\n".join(body)
 
-    async def get_subtree(self, node_hash: bytes) -> Coroutine[Any, Any, SubTree]:
+    async def get_subtree(self, node_hash: bytes, height: int = 0) -> Coroutine[Any, Any, SubTree]:
         if node_hash == EmptyNode.hash:
             return SubTree([0], [EmptyNode()], self.hasher)
 
-        data = await self._db.get(node_hash)
-        self.stats["db_get"] += 1
+        if node_hash in self._cache:
+            self._cache.move_to_end(node_hash)
+            self.stats["cache_hits"] += 1
+            return self._cache[node_hash]
+
+        self.stats["cache_misses"] += 1
+        if node_hash in self._dirty:
+            data = self._dirty[node_hash]
+        else:
+            data = await self._db.get(node_hash)
+            self.stats["db_get"] += 1
         if not data:
             raise MissingNodeError
 
-        structure, nodes = SubTree.parse(data, self.key_length)
-        return SubTree(structure, nodes, self.hasher)
-
-    async def set_subtree(self, subtree: SubTree) -> None:
-        await self._db.set(subtree.hash, subtree.data)
-        self.stats["db_set"] += 1
+        structure, nodes = SubTree.parse(data, self.key_length, self.count_size)
+        subtree = SubTree(structure, nodes, self.hasher)
+        self._cache_subtree(node_hash, subtree, height)
+        return subtree
+
+    async def set_subtree(self, subtree: SubTree, height: int = 0) -> None:
+        # write-back: the subtree is persisted only at write_to_db
+        node_hash = subtree.hash
+        self._revive_subtree(node_hash)
+        self._dirty[node_hash] = subtree.encode(self.count_size)
+        self._cache_subtree(node_hash, subtree, height)
+
+    def _retire_subtree(self, node_hash: bytes, size: int) -> None:
+        # the subtree is no longer reachable from the tree being updated
+        if node_hash != EMPTY_HASH:
+            self._retired[node_hash] = size
+
+    def _revive_subtree(self, node_hash: bytes) -> None:
+        # a retired or stale subtree was created again: it is still in the db and will be written over
+        self._deleted.discard(node_hash)
+        if node_hash in self._retired:
+            self.stats["db_bytes"] -= self._retired.pop(node_hash)
+        elif node_hash in self._stale:
+            _, size = self._stale.pop(node_hash)
+            self.stats["db_bytes"] -= size
+            self.stats["stale_subtrees"] -= 1
+            self.stats["stale_bytes"] -= size
+
+    async def delete_subtree(self, node_hash: bytes) -> None:
+        self._cache.pop(node_hash, None)
+        self._dirty.pop(node_hash, None)
+        self._deleted.add(node_hash)
+        self.stats["db_delete"] += 1
+
+    def _cache_subtree(self, node_hash: bytes, subtree: SubTree, height: int) -> None:
+        if self.cache_size <= 0 or height >= self.cache_height:
+            return
+        self._cache[node_hash] = subtree
+        self._cache.move_to_end(node_hash)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
 
     async def write_to_db(self) -> None:
-        # re batch in memory nodes and write subtrees to db
+        # flush deleted and dirty subtrees and write the batch to db
+        for node_hash in self._deleted:
+            await self._db.delete(node_hash)
+        self._deleted = set()
+        for node_hash, data in self._dirty.items():
+            await self._db.set(node_hash, data)
+            self.stats["db_set"] += 1
+            self.stats["db_bytes"] += len(data)
+            if self._collector is not None:
+                self._collector.shade(node_hash)
+        self._dirty = {}
         await self._db.write()
 
+    def live_roots(self) -> list[bytes]:
+        return [self.root.hash] + list(self.versions.values())
+
+    def node_children(self, data: bytes) -> list[bytes]:
+        # hashes of the subtrees below an encoded subtree
+        _, nodes = SubTree.parse(data, self.key_length, self.count_size)
+        return [node.hash for node in nodes if isinstance(node, StubNode)]
+
+    async def load(self, root_hash: bytes) -> Coroutine[Any, Any, SubTree]:
+        # resume from a root stored in a persistent db
+        self.root = await self.get_subtree(root_hash)
+        return self.root
+
+    async def get_root(self, height: int) -> Coroutine[Any, Any, SubTree]:
+        # root subtree of a retained version
+        if height not in self.versions:
+            raise InvalidHeightError
+        return await self.get_subtree(self.versions[height])
+
     async def update(
         self,
         keys: list[bytes],
         values: list[bytes],
+        height: int | None = None,
     ) -> Coroutine[Any, Any, SubTree]:
         """
         As specified in from https:#github.com/LiskHQ/lips/blob/master/proposals/lip-0039.md
+        The new root is stored as the version at height, by default the one after the latest version.
         """
-
+        height = self._next_height(height)
         if len(keys) == 0:
+            await self._commit_version(height)
             return self.root
 
-        self.root = await self._update_subtree(keys, values, self.root, 0)
-        await self.write_to_db()
+        with HashCounter() as counter:
+            if self.workers > 1 and len(keys) >= PARALLEL_UPDATE_MIN_KEYS and "fork" in multiprocessing.get_all_start_methods():
+                self._bin_updates = await self._update_bins_in_parallel(keys, values)
+            previous_root = self.root
+            self.root = await self._update_subtree(keys, values, self.root, 0)
+            self._bin_updates = {}
+            if previous_root.hash != self.root.hash:
+                self._retire_subtree(previous_root.hash, previous_root.encoded_size(self.count_size))
+            await self._commit_version(height)
+        self.stats["hashes"] += counter.hashes
+        return self.root
+
+    async def delete(self, keys: list[bytes], height: int | None = None) -> Coroutine[Any, Any, SubTree]:
+        # remove keys from the tree, missing keys are ignored
+        return await self.update(keys, [EMPTY_VALUE] * len(keys), height)
+
+    async def bulk_load(
+        self,
+        pairs: Iterable[tuple[bytes, bytes]],
+        height: int | None = None,
+    ) -> Coroutine[Any, Any, SubTree]:
+        """
+        Build the tree bottom up from (key, value) pairs sorted by key, with the same root as update.
+        A subtree is written as soon as its key range is closed and only the subtrees on the path to the
+        current key are kept in memory, so pairs can be streamed from a snapshot. The tree must be empty.
+        """
+        assert self.root.hash == EMPTY_HASH
+        height = self._next_height(height)
+        with HashCounter() as counter:
+            sorted_pairs = _SortedPairs(pairs, self.key_length)
+            if sorted_pairs.head is not None:
+                self.root = await self._bulk_load_subtree(sorted_pairs.pop(), sorted_pairs, 0)
+            await self._commit_version(height)
+        self.stats["hashes"] += counter.hashes
         return self.root
 
+    async def _bulk_load_subtree(self, first: tuple[bytes, bytes], pairs: "_SortedPairs", height: int) -> Coroutine[Any, Any, SubTree]:
+        # consume the pairs sharing the first height bits with first and build their subtree
+        bins: list[int] = []
+        bin_nodes: list[TreeNode] = []
+        pair = first
+        while True:
+            # pair is the first one of its bin: a single pair is a leaf, more pairs go to a lower subtree
+            if pairs.head is not None and _same_prefix(pairs.head[0], pair[0], height + self.subtree_height):
+                lower_subtree = await self._bulk_load_subtree(pair, pairs, height + self.subtree_height)
+                node = StubNode(lower_subtree.hash)
+            else:
+                node = LeafNode(pair[0], pair[1])
+                self.stats["leaf_created"] += 1
+            bins.append(self._bin_index(pair[0], height))
+            bin_nodes.append(node)
+
+            if pairs.head is None or not _same_prefix(pairs.head[0], first[0], height):
+                break
+            pair = pairs.pop()
+
+        nodes: list[TreeNode] = []
+        structure: list[int] = []
+        self._pack_bins(bins, bin_nodes, 0, len(bins), 0, 0, nodes, structure)
+        subtree = SubTree(structure, nodes, self.hasher)
+        await self.set_subtree(subtree, height)
+        if len(self._dirty) >= BULK_LOAD_BATCH_SIZE:
+            await self.write_to_db()
+        return subtree
+
+    def _pack_bins(
+        self,
+        bins: list[int],
+        bin_nodes: list[TreeNode],
+        start: int,
+        end: int,
+        V: int,
+        h: int,
+        nodes: list[TreeNode],
+        structure: list[int],
+    ) -> None:
+        # Append the nodes of the subtree part at height h covering the bins from V, given its non-empty bins[start:end].
+        # As in the push up of _update_subtree, empty parts are a single empty node and a leaf alone is moved up.
+        if start == end:
+            nodes.append(EmptyNode())
+            structure.append(h)
+        elif h == self.subtree_height or (end - start == 1 and isinstance(bin_nodes[start], LeafNode)):
+            nodes.append(bin_nodes[start])
+            structure.append(h)
+        else:
+            mid = V + (1 << (self.subtree_height - h - 1))
+            split = bisect_left(bins, mid, start, end)
+            self._pack_bins(bins, bin_nodes, start, split, V, h + 1, nodes, structure)
+            self._pack_bins(bins, bin_nodes, split, end, mid, h + 1, nodes, structure)
+
+    def _next_height(self, height: int | None) -> int:
+        # version heights are increasing, by default the one after the latest version
+        latest = next(reversed(self.versions), -1)
+        if height is None:
+            return latest + 1
+        if height <= latest:
+            raise InvalidHeightError
+        return height
+
+    async def _commit_version(self, height: int) -> None:
+        # store the root as the version at height, the subtrees retired by the update are stale from height on
+        self.versions[height] = self.root.hash
+        for node_hash, size in self._retired.items():
+            self._stale[node_hash] = (height, size)
+            self.stats["stale_subtrees"] += 1
+            self.stats["stale_bytes"] += size
+        self._retired = {}
+        await self._prune_versions()
+        await self.write_to_db()
+        await self._collect_garbage()
+
+    async def _prune_versions(self) -> None:
+        # drop versions out of retention and delete the subtrees only they could reach
+        if self.retention is not None:
+            while len(self.versions) > self.retention + 1:
+                self.versions.popitem(last=False)
+        self.stats["versions"] = len(self.versions)
+
+        oldest = next(iter(self.versions))
+        while len(self._stale) > 0:
+            node_hash, (height, size) = next(iter(self._stale.items()))
+            if height > oldest:
+                break
+            self._stale.popitem(last=False)
+            if self._collector is None:
+                await self.delete_subtree(node_hash)
+            self.stats["db_bytes"] -= size
+            self.stats["stale_subtrees"] -= 1
+            self.stats["stale_bytes"] -= size
+
+    async def _collect_garbage(self) -> None:
+        if self._collector is not None:
+            await self._collector.step(self.gc_slice)
+
     async def _update_subtree(
         self,
         keys: list[bytes],
@@ -149,61 +426,63 @@ class SkipMerkleTree(object):
         assert (height % self.subtree_height) == 0
         if len(keys) == 0:
             return current_subtree
+        removals = self._removals
 
-        bin_keys: list[list[bytes]] = [[] for _ in range(self.max_number_of_nodes)]
-        bin_values: list[list[bytes]] = [[] for _ in range(self.max_number_of_nodes)]
-        b = height // 8
-
+        # keys grouped by bin, only the bins holding keys are kept, in bin order:
+        # a subtree has up to 2^16 bins and an update usually touches a few of them
+        grouped: dict[int, tuple[list[bytes], list[bytes]]] = {}
         for i in range(len(keys)):
             k, v = keys[i], values[i]
-
-            if self.subtree_height == 4:
-                if height % 8 == 0:  # upper half
-                    bin_idx = k[b] >> 4
-                elif height % 8 == 4:  # lower half
-                    bin_idx = k[b] & 15
-                else:
-                    raise InvalidKeyError
-            elif self.subtree_height == 8:
-                bin_idx = k[b]
-
-            bin_keys[bin_idx].append(k)
-            bin_values[bin_idx].append(v)
+            bin_idx = self._bin_index(k, height)
+            if bin_idx in grouped:
+                grouped[bin_idx][0].append(k)
+                grouped[bin_idx][1].append(v)
+            else:
+                grouped[bin_idx] = ([k], [v])
+        bins = sorted(grouped)
+        bin_keys = [grouped[b][0] for b in bins]
+        bin_values = [grouped[b][1] for b in bins]
+        bin_length = list(accumulate(len(b) for b in bin_keys))
 
         layer_nodes = []
         layer_structure = []
         V = 0
+        start = 0
         for i in range(len(current_subtree.nodes)):
             h = current_subtree.structure[i]
             current_node = current_subtree.nodes[i]
             incr = 1 << (self.subtree_height - h)
-            base_length = list(accumulate([len(b) for b in bin_keys[V : V + incr]]))
+            end = bisect_left(bins, V + incr, start)
 
             _nodes, _heights = await self._update_node(
-                bin_keys[V : V + incr],
-                bin_values[V : V + incr],
-                base_length,
-                0,
+                bin_keys[start:end],
+                bin_values[start:end],
+                bins[start:end],
+                bin_length[start:end],
+                bin_length[start - 1] if start > 0 else 0,
                 current_node,
                 height,
                 h,
+                V,
             )
             layer_nodes += _nodes
             layer_structure += _heights
             V += incr
+            start = end
 
         assert V == self.max_number_of_nodes
 
-        if is_deleting:
+        if is_deleting and self._removals != removals:
             # go through nodes again and push up empty nodes and single leaves, recursively
             # this step is actually necessary only if we deleted some keys
-            for height in reversed(range(1, max(layer_structure) + 1)):
+            self.stats["push_up_passes"] += 1
+            for layer_height in reversed(range(1, max(layer_structure) + 1)):
                 next_layer_nodes: list[TreeNode] = []
                 next_layer_structure: list[int] = []
                 i = 0
                 while i < len(layer_nodes):
                     # pair node with next one
-                    if layer_structure[i] == height:
+                    if layer_structure[i] == layer_height:
                         # Push up empty node
                         if isinstance(layer_nodes[i], EmptyNode) and isinstance(layer_nodes[i + 1], EmptyNode):
                             parent_node = layer_nodes[i]
@@ -256,26 +535,29 @@ class SkipMerkleTree(object):
             # we do not need to push up anything
             new_subtree = SubTree(layer_structure, layer_nodes, self.hasher)
 
-        await self.set_subtree(new_subtree)
+        await self.set_subtree(new_subtree, height)
         return new_subtree
 
     async def _update_node(
         self,
         keys: list[list[bytes]],
         values: list[list[bytes]],
+        bins: list[int],
         bin_length: list[int],
         base_length: int,
         current_node: TreeNode,
         height: int,
         h: int,
+        first_bin: int,
     ) -> Coroutine[Any, Any, tuple[list[TreeNode], list[int]]]:
+        # keys and values are grouped by the non-empty bins below the node, the first of them is first_bin
         assert height + h < 8 * self.key_length
         assert len(keys) == len(values)
         self.stats["update_node_calls"] += 1
 
-        total_data = bin_length[-1] - base_length
-        if total_data == 0:
+        if len(keys) == 0:
             return ([current_node], [h])
+        total_data = bin_length[-1] - base_length
 
         if total_data == 1:
             idx = bin_length.index(base_length + 1)
@@ -297,32 +579,25 @@ class SkipMerkleTree(object):
                         self.stats["leaf_created"] += 1
                         return ([new_leaf], [h])
                     # else return the empty node (deleting a leaf node)
+                    self._removals += 1
                     return ([EmptyNode()], [h])
+                elif len(values[idx][0]) == 0:
+                    # deleting a missing key leaves the node as it is
+                    return ([current_node], [h])
 
         # If we are at the bottom of the tree, we call update_subtree and return update nodes
         if h == self.subtree_height:
-
-            if isinstance(current_node, StubNode):
-                # StubNode  can only be stored at bottom of subtree
-                btm_subtree = await self.get_subtree(current_node.hash)
-                await self._db.delete(current_node.hash)
-                self.stats["db_delete"] += 1
-
-            elif isinstance(current_node, EmptyNode):
-                btm_subtree = await self.get_subtree(EmptyNode.hash)
-
-            elif isinstance(current_node, LeafNode):
-                btm_subtree = SubTree([0], [current_node], self.hasher)
-
-            else:
-                raise InvalidDataError
-
             assert len(keys) == len(values) == 1
-            new_subtree = await self._update_subtree(keys[0], values[0], btm_subtree, height + h)
-            if len(new_subtree.nodes) == 1:
-                # stub is empty or leaf
-                return ([new_subtree.nodes[0]], [h])
-            return ([StubNode(new_subtree.hash)], [h])
+            if height == 0 and len(self._bin_updates) > 0:
+                bin_update = self._bin_updates.pop(self._bin_index(keys[0][0], 0), None)
+                if bin_update is not None and bin_update[0] == current_node:
+                    new_node = await self._apply_bin_update(*bin_update[1:])
+                    if not isinstance(new_node, StubNode):
+                        # removals of the worker are not tracked, the node may have to be pushed up
+                        self._removals += 1
+                    return ([new_node], [h])
+
+            return ([await self._update_bottom_node(keys[0], values[0], current_node, height + h)], [h])
 
         # Else, we just call _update_node and return the returned values
         if isinstance(current_node, EmptyNode):
@@ -338,222 +613,454 @@ class SkipMerkleTree(object):
         else:
             print(type(current_node))
             raise InvalidDataError
+        if any(len(v) == 0 for bin_values in values for v in bin_values):
+            # deletions below a leaf or empty node can leave a single leaf or empty node under a branch
+            self._removals += 1
 
-        idx = len(keys) // 2
+        mid_bin = first_bin + (1 << (self.subtree_height - h - 1))
+        idx = bisect_left(bins, mid_bin)
         left_nodes, left_heights = await self._update_node(
             keys[:idx],
             values[:idx],
+            bins[:idx],
             bin_length[:idx],
             base_length,
             left_node,
             height,
             h + 1,
+            first_bin,
         )
         right_nodes, right_heights = await self._update_node(
             keys[idx:],
             values[idx:],
+            bins[idx:],
             bin_length[idx:],
-            bin_length[idx - 1],
+            bin_length[idx - 1] if idx > 0 else base_length,
             right_node,
             height,
             h + 1,
+            mid_bin,
         )
 
         return (left_nodes + right_nodes, left_heights + right_heights)
 
-    async def generate_proof(self, query_keys: list[bytes]) -> Proof:
-        if len(query_keys) == 0:
-            return Proof([], [])
+    async def _update_bottom_node(
+        self,
+        keys: list[bytes],
+        values: list[bytes],
+        current_node: TreeNode,
+        height: int,
+    ) -> Coroutine[Any, Any, TreeNode]:
+        # update the subtree below a bottom node and return the node replacing it
+        if isinstance(current_node, StubNode):
+            # StubNode  can only be stored at bottom of subtree
+            btm_subtree = await self.get_subtree(current_node.hash, height)
+            self._retire_subtree(current_node.hash, btm_subtree.encoded_size(self.count_size))
 
-        query_proofs: list[QueryWithProof] = [await self._generate_query_proof(self.root, k, 0) for k in query_keys]
-        
-        # prepare queries from single proofs, maintaining original order (same as query keys)
-        queries: list[Query] = [Query(sp.key, sp.value, sp.bitmap) for sp in query_proofs]
-        # sort by largest height (bottom first), smaller key (left first)
-        query_proofs = sorted(query_proofs, key=lambda q: (-q.height, q.key))
-        sibling_hashes: list[bytes] = []
-        ancestor_hashes: list[bytes] = [h for sp in query_proofs for h in sp.ancestor_hashes]
-
-        while len(query_proofs) > 0:
-            sp = query_proofs.pop(0)
-            if sp.height == 0:
-                continue
-
-            if sp.binary_bitmap[0] == "1":
-                node_hash = sp.sibling_hashes.pop()
-                if not node_hash in sibling_hashes and not node_hash in ancestor_hashes:
-                    sibling_hashes.append(node_hash)
-
-            sp.binary_bitmap = sp.binary_bitmap[1:]
-            query_proofs = insert_and_filter_queries(sp, query_proofs)
-
-        return Proof(sibling_hashes, queries)
-
-    async def _generate_query_proof(self, current_subtree: SubTree, query_key: bytes, height: int) -> QueryWithProof:
-        if len(query_key) != self.key_length:
-            raise Exception('Invalid length of query_key')
-        b = height // 8
-        if self.subtree_height == 4:
-            if height % 8 == 0:  # upper half
-                bin_idx = query_key[b] >> 4
-            elif height % 8 == 4:  # lower half
-                bin_idx = query_key[b] & 15
-            else:
-                raise InvalidKeyError
-        elif self.subtree_height == 8:
-            bin_idx = query_key[b]
+        elif isinstance(current_node, EmptyNode):
+            btm_subtree = await self.get_subtree(EmptyNode.hash)
+
+        elif isinstance(current_node, LeafNode):
+            btm_subtree = SubTree([0], [current_node], self.hasher)
+
+        else:
+            raise InvalidDataError
+
+        removals = self._removals
+        new_subtree = await self._update_subtree(keys, values, btm_subtree, height)
+        if len(new_subtree.nodes) == 1:
+            # stub is empty or leaf, the subtree is never referenced and is not written
+            self._dirty.pop(new_subtree.hash, None)
+            self._cache.pop(new_subtree.hash, None)
+            return new_subtree.nodes[0]
+        # the lower subtree is not a single node, its removals do not change the canonical form of this one
+        self._removals = removals
+        return StubNode(new_subtree.hash)
+
+    async def _update_bins_in_parallel(
+        self,
+        keys: list[bytes],
+        values: list[bytes],
+    ) -> Coroutine[Any, Any, dict[int, tuple[TreeNode, TreeNode, dict[bytes, bytes], dict[bytes, int], dict[str, int], int]]]:
+        bin_keys: list[list[bytes]] = [[] for _ in range(self.max_number_of_nodes)]
+        bin_values: list[list[bytes]] = [[] for _ in range(self.max_number_of_nodes)]
+        for k, v in zip(keys, values):
+            bin_idx = self._bin_index(k, 0)
+            bin_keys[bin_idx].append(k)
+            bin_values[bin_idx].append(v)
+
+        # Find the node at the bottom of the root subtree for each bin, as _update_node would reach it.
+        # Only bins that are certain to reach it are computed in parallel, the others are left to the sequential update.
+        jobs = []
         V = 0
-        for i in range(len(current_subtree.nodes)):
-            h = current_subtree.structure[i]
-            current_node = current_subtree.nodes[i]
+        for h, node in zip(self.root.structure, self.root.nodes):
             incr = 1 << (self.subtree_height - h)
-            if V <= bin_idx < V + incr:
-                break 
+            for bin_idx in range(V, V + incr):
+                if h == self.subtree_height:
+                    current_node = node
+                elif isinstance(node, LeafNode) and self._bin_index(node.key, 0) == bin_idx:
+                    current_node = node
+                else:
+                    current_node = EmptyNode()
+                n = len(bin_keys[bin_idx])
+                if n > 1 or (n == 1 and isinstance(current_node, StubNode)):
+                    jobs.append((bin_idx, bin_keys[bin_idx], bin_values[bin_idx], current_node))
             V += incr
-        
-        max_id = 0
-        for i in range(len(current_subtree.nodes)):
-            current_subtree.nodes[i].id = int(max_id)
-            max_id += 1
-        
-        query_height = int(h)
-        # target_node = current_node
-        target_id = current_node.id
-        
-        ancestor_hashes = []
-        sibling_hashes = []
 
-        nodes = list(current_subtree.nodes)
-        structure = list(current_subtree.structure)
-        binary_bitmap = ""
+        global _forked_tree
+        _forked_tree = self
+        try:
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"), initializer=_init_update_worker) as pool:
+                results = await asyncio.gather(
+                    *[loop.run_in_executor(pool, _update_bottom_node_worker, k, v, n, self.subtree_height) for _, k, v, n in jobs]
+                )
+        finally:
+            _forked_tree = None
+
+        return {bin_idx: (current_node,) + result for (bin_idx, _, _, current_node), result in zip(jobs, results)}
 
-        # Calculate ancestor and sibling hashes using the target_node as starting point
-        # Recalculate internal hashes from the stored current_subtree.nodes, while appending to sibling_hashes the one needed in the queried path.
+    async def _apply_bin_update(
+        self,
+        new_node: TreeNode,
+        dirty: dict[bytes, bytes],
+        retired: dict[bytes, int],
+        stats: dict[str, int],
+        hashes: int,
+    ) -> Coroutine[Any, Any, TreeNode]:
+        # replay the writes of a worker as if the bottom node was updated here
+        for node_hash, size in retired.items():
+            self._retire_subtree(node_hash, size)
+        for node_hash, data in dirty.items():
+            self._revive_subtree(node_hash)
+            self._dirty[node_hash] = data
+        for k, v in stats.items():
+            self.stats[k] += v
+        HashCounter.add(hashes)
+        return new_node
+
+    async def generate_proof(self, query_keys: list[bytes], root: bytes | None = None) -> Proof:
+        # the proof is against the current root, or against the root hash of a retained version
+        if len(query_keys) == 0:
+            return self.proof_layout.merge([])
+
+        with HashCounter() as counter:
+            root_subtree = self.root if root is None or root == self.root.hash else await self.get_subtree(root)
+            # descend the tree once for all keys: sorted keys sharing a prefix share subtree loads and layer hashes
+            query_paths = await self._generate_query_paths(root_subtree, sorted(set(query_keys)), 0)
+            query_proofs: list[QueryWithProof] = []
+            for k in query_keys:
+                key, value, binary_bitmap, ancestor_hashes, sibling_hashes = query_paths[k]
+                query_proofs.append(QueryWithProof(key, value, binary_to_bytes(binary_bitmap), list(ancestor_hashes), list(sibling_hashes)))
+
+        self.stats["hashes"] += counter.hashes
+        return self.proof_layout.merge(query_proofs)
+
+    async def _generate_query_paths(
+        self, current_subtree: SubTree, query_keys: list[bytes], height: int
+    ) -> Coroutine[Any, Any, dict[bytes, tuple[bytes, bytes, str, list[bytes], list[bytes]]]]:
+        """
+        Return (key, value, binary_bitmap, ancestor_hashes, sibling_hashes) for each of the sorted query_keys.
+        Keys reaching the same node of current_subtree share its path, keys reaching the same stub share the lower subtree.
+        """
+        for k in query_keys:
+            if len(k) != self.key_length:
+                raise Exception('Invalid length of query_key')
+
+        nodes = current_subtree.nodes
+        structure = current_subtree.structure
+        # first bin covered by each node
+        bin_starts = [0] + list(accumulate(1 << (self.subtree_height - h) for h in structure))[:-1]
+        targets: dict[int, list[bytes]] = {}
+        for k in query_keys:
+            target_idx = bisect_right(bin_starts, self._bin_index(k, height)) - 1
+            targets.setdefault(target_idx, []).append(k)
+
+        layers = self._subtree_layers(current_subtree)
+        query_paths = {}
+        for target_idx, keys in targets.items():
+            ancestor_hashes = []
+            sibling_hashes = []
+            binary_bitmap = ""
+            # walk up from the target node, the bitmap is built bottom-up
+            idx = target_idx
+            for hashes, is_empty, parents, siblings, parent_hashes in layers:
+                sibling_idx = siblings[idx]
+                idx = parents[idx]
+                if sibling_idx < 0:
+                    continue
+                ancestor_hashes.append(parent_hashes[idx])
+                if is_empty[sibling_idx]:
+                    binary_bitmap = binary_bitmap + "0"
+                else:
+                    binary_bitmap = binary_bitmap + "1"
+                    sibling_hashes.append(hashes[sibling_idx])
+            ancestor_hashes.reverse()
+            sibling_hashes.reverse()
+
+            target_node = nodes[target_idx]
+            if isinstance(target_node, EmptyNode):
+                for k in keys:
+                    query_paths[k] = (k, EMPTY_VALUE, binary_bitmap, ancestor_hashes, sibling_hashes)
+
+            elif isinstance(target_node, LeafNode):
+                ancestor_hashes.append(target_node.hash)
+                for k in keys:
+                    query_paths[k] = (target_node.key, target_node.value, binary_bitmap, ancestor_hashes, sibling_hashes)
+
+            elif isinstance(target_node, StubNode):
+                assert height % self.subtree_height == 0
+                lower_height = height + structure[target_idx]
+                lower_subtree = await self.get_subtree(target_node.hash, lower_height)
+                lower_paths = await self._generate_query_paths(lower_subtree, keys, lower_height)
+                # In the skip Merkle tree we have to handle hashes and bitmap from lower layers
+                for k in keys:
+                    key, value, lower_bitmap, lower_ancestor_hashes, lower_sibling_hashes = lower_paths[k]
+                    # leading zeros of the lower bitmap are dropped, as in its byte encoding
+                    query_paths[k] = (
+                        key,
+                        value,
+                        lower_bitmap.lstrip("0") + binary_bitmap,
+                        ancestor_hashes + lower_ancestor_hashes,
+                        sibling_hashes + lower_sibling_hashes,
+                    )
+
+        return query_paths
+
+    def _bin_index(self, key: bytes, height: int) -> int:
+        # the subtree_height bits of key from height, at most 16 bits so they are within 3 bytes.
+        # Past the end of the key the bits are 0: the last subtree layer is partial if the key length in bits
+        # is not a multiple of subtree_height.
+        b = height >> 3
+        shift = 8 - (height & 7) - self.subtree_height
+        if shift >= 0:
+            return (key[b] >> shift) & (self.max_number_of_nodes - 1)
+        chunk = key[b : b + 3]
+        bits = int.from_bytes(chunk, "big") << (24 - 8 * len(chunk))
+        return (bits >> (shift + 16)) & (self.max_number_of_nodes - 1)
+
+    def _subtree_layers(self, subtree: SubTree) -> list[tuple[list[bytes], list[bool], list[int], list[int], list[bytes]]]:
+        # Recalculate internal hashes from the stored subtree nodes, bottom layer first.
+        # For each layer store (hashes, is_empty, parent index, sibling index or -1, parent layer hashes).
+        hashes = [n.hash for n in subtree.nodes]
+        is_empty = [isinstance(n, EmptyNode) for n in subtree.nodes]
+        structure = list(subtree.structure)
+        layers = []
         for s in reversed(range(1, max(structure) + 1)):
-            _nodes = []
+            parents = []
+            siblings = []
+            _hashes = []
+            _is_empty = []
             _structure = []
 
             i = 0
-            while i < len(nodes):
+            while i < len(hashes):
                 if structure[i] == s:
-                    parent_node = BranchNode(nodes[i].hash, nodes[i + 1].hash)
-                    parent_node.id = int(max_id)
-                    max_id += 1
-                    _nodes.append(parent_node)
-                    _structure.append(structure[i] - 1)
-                    # check if the target node is the next
-                    # 'is' operator checks equality of pointers
-                    # if target_node is nodes[i]:
-                    if target_id == nodes[i].id:
-                        ancestor_hashes.insert(0, parent_node.hash)
-                        target_id = parent_node.id
-                        if isinstance(nodes[i + 1], EmptyNode):
-                            binary_bitmap = binary_bitmap + "0"
-                        else:
-                            binary_bitmap = binary_bitmap + "1"
-                            sibling_hashes.insert(0, nodes[i + 1].hash)
-                    # 'is' operator checks equality of pointers
-                    # elif target_node is nodes[i + 1]:
-                    elif target_id == nodes[i+1].id:
-                    # elif (target_node and target_node.hash == nodes[i+1].hash) or (target_node == None and target_node_idx == i+1):
-                        ancestor_hashes.insert(0, parent_node.hash)
-                        target_id = parent_node.id
-                        if isinstance(nodes[i], EmptyNode):
-                            binary_bitmap = binary_bitmap + "0"
-                        else:
-                            binary_bitmap = binary_bitmap + "1"
-                            sibling_hashes.insert(0, nodes[i].hash)
-                    i += 1
+                    parents += [len(_hashes), len(_hashes)]
+                    siblings += [i + 1, i]
+                    _hashes.append(BranchNode(hashes[i], hashes[i + 1]).hash)
+                    _is_empty.append(False)
+                    _structure.append(s - 1)
+                    i += 2
                 else:
-                    _nodes.append(nodes[i])
+                    parents.append(len(_hashes))
+                    siblings.append(-1)
+                    _hashes.append(hashes[i])
+                    _is_empty.append(is_empty[i])
                     _structure.append(structure[i])
-                i += 1
-            nodes = _nodes
+                    i += 1
+            layers.append((hashes, is_empty, parents, siblings, _hashes))
+            hashes = _hashes
+            is_empty = _is_empty
             structure = _structure
 
-        if isinstance(current_node, EmptyNode):
-            return QueryWithProof(query_key, EMPTY_VALUE, binary_to_bytes(binary_bitmap), ancestor_hashes, sibling_hashes)
+        return layers
 
-        elif isinstance(current_node, LeafNode):
-            ancestor_hashes.append(current_node.hash)
-            return QueryWithProof(
-                current_node.key,
-                current_node.value,
-                binary_to_bytes(binary_bitmap),
-                ancestor_hashes,
-                sibling_hashes,
-            )
 
-        elif isinstance(current_node, StubNode):
-            assert height % self.subtree_height == 0
-            lower_subtree = await self.get_subtree(current_node.hash)
-            lower_query_proof: QueryWithProof = await self._generate_query_proof(lower_subtree, query_key, height + query_height)
-            # In the skip Merkle tree we have to handle hashes and bitmap from lower layers
-           
-            return QueryWithProof(
-                lower_query_proof.key,
-                lower_query_proof.value,
-                binary_to_bytes(lower_query_proof.binary_bitmap + binary_bitmap),
-                ancestor_hashes + lower_query_proof.ancestor_hashes,
-                sibling_hashes + lower_query_proof.sibling_hashes,
-            )
+class _SortedPairs(object):
+    # (key, value) pairs with one pair of lookahead in head, checking that keys are sorted. Empty values are skipped.
+    def __init__(self, pairs: Iterable[tuple[bytes, bytes]], key_length: int) -> None:
+        self._pairs = iter(pairs)
+        self.key_length = key_length
+        self.head: tuple[bytes, bytes] | None = None
+        self._last_key: bytes | None = None
+        self._advance()
+
+    def pop(self) -> tuple[bytes, bytes]:
+        pair = self.head
+        self._advance()
+        return pair
+
+    def _advance(self) -> None:
+        self.head = None
+        for key, value in self._pairs:
+            if len(key) != self.key_length or (self._last_key is not None and key <= self._last_key):
+                raise InvalidKeyError
+            self._last_key = key
+            if len(value) > 0:
+                self.head = (key, value)
+                return
 
 
-def insert_and_filter_queries(q: QueryWithProof or Query, queries: list[QueryWithProof or Query]) -> list[QueryWithProof or Query]:
-    if len(queries) == 0:
-        return [q]
+def _same_prefix(a: bytes, b: bytes, bits: int) -> bool:
+    # a and b have the same first bits
+    n = bits >> 3
+    if a[:n] != b[:n]:
+        return False
+    r = bits & 7
+    return r == 0 or (a[n] ^ b[n]) >> (8 - r) == 0
+
+
+# tree inherited by the forked update workers
+_forked_tree: SkipMerkleTree | None = None
+
+
+def _init_update_worker() -> None:
+    # sqlite connections must not be shared with the parent process
+    if isinstance(_forked_tree._db, SqliteDB):
+        _forked_tree._db = SqliteDB(_forked_tree._db.filename, _forked_tree._db.cache_size)
+
+
+def _update_bottom_node_worker(
+    keys: list[bytes],
+    values: list[bytes],
+    current_node: TreeNode,
+    height: int,
+) -> tuple[TreeNode, dict[bytes, bytes], dict[bytes, int], dict[str, int], int]:
+    tree = _forked_tree
+    tree._dirty = {}
+    tree._retired = {}
+    tree._stale = OrderedDict()
+    tree.stats = dict.fromkeys(tree.stats, 0)
+    with HashCounter() as counter:
+        new_node = asyncio.run(tree._update_bottom_node(keys, values, current_node, height))
+    return (new_node, tree._dirty, tree._retired, tree.stats, counter.hashes)
+
+
+def _merge_query_proofs(query_proofs: list[QueryWithProof]) -> Proof:
+    # prepare queries from single proofs, maintaining original order (same as query keys)
+    queries: list[Query] = [Query(sp.key, sp.value, sp.bitmap) for sp in query_proofs]
+    sibling_hashes: list[bytes] = []
+    added_hashes: set[bytes] = set(h for sp in query_proofs for h in sp.ancestor_hashes)
+    # process by largest height (bottom first), smaller key (left first)
+    queue = QueryQueue(query_proofs)
+
+    while len(queue) > 0:
+        sp = queue.pop()
+        if sp.height == 0:
+            continue
 
-    insert_index = binary_search(
-        queries,
-        lambda p: (q.height == p.height and q.key < p.key) or (q.height > p.height),
-    )
+        if sp.bitmap_bit == 1:
+            node_hash = sp.sibling_hashes.pop()
+            if not node_hash in added_hashes:
+                sibling_hashes.append(node_hash)
+                added_hashes.add(node_hash)
 
-    if insert_index == len(queries):
-        return queries + [q]
-    
-    p = queries[insert_index]
-    # if not p.binary_path.endswith(q.binary_path, p.height):
-    if p.binary_path != q.binary_path:
-        queries.insert(insert_index, q)
+        sp.move_up()
+        queue.push(sp)
+
+    return Proof(sibling_hashes, queries)
+
+
+class ProofLayout(ABC):
+    """
+    Layout of the proofs of a tree: how the proofs of the single query keys are merged in one proof and how
+    that proof is verified. It does not change the tree, the same tree can give proofs in any layout.
+    """
+
+    @abstractmethod
+    def merge(self, query_proofs: list[QueryWithProof]) -> Any:
+        # query_proofs are in the order of the query keys, their sibling hashes from the root down
+        ...
+
+    @abstractmethod
+    def verify(self, query_keys: list[bytes], proof: Any, merkle_root: bytes, key_length: int = DEFAULT_KEY_LENGTH) -> bool:
+        ...
+
+
+class QueryBitmaps(ProofLayout):
+    # LIP-0039 layout: a bitmap for each query, the sibling hashes in the order they are hashed
+    def merge(self, query_proofs: list[QueryWithProof]) -> Proof:
+        return _merge_query_proofs(query_proofs)
+
+    def verify(self, query_keys: list[bytes], proof: Proof, merkle_root: bytes, key_length: int = DEFAULT_KEY_LENGTH) -> bool:
+        return verify(query_keys, proof, merkle_root, key_length)
+
+
+class QueryQueue(object):
+    """
+    Priority queue of queries, largest height (bottom) first and smaller key (left) first.
+    Queries are deduplicated by path: pushing a query whose node is already queued drops it.
+    """
 
-    return queries
+    def __init__(self, queries: list[Query]) -> None:
+        self._heap: list[tuple[int, bytes, Query]] = []
+        self._paths: set[tuple[int, int]] = set()
+        for q in queries:
+            self.push(q)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, q: Query) -> None:
+        path = q.path
+        if path in self._paths:
+            return
+        self._paths.add(path)
+        # (height, key) is unique among queued queries, so queries themselves are never compared
+        heappush(self._heap, (-q.height, q.key, q))
+
+    def pop(self) -> Query:
+        q = heappop(self._heap)[2]
+        self._paths.remove(q.path)
+        return q
+
+    def peek(self) -> Query | None:
+        return self._heap[0][2] if self._heap else None
 
 
 def verify(query_keys: list[bytes], proof: Proof, merkle_root: bytes, key_length: int = DEFAULT_KEY_LENGTH) -> bool:
+    return check_proof(query_keys, proof, merkle_root, key_length).valid
+
+
+def check_proof(
+    query_keys: list[bytes], proof: Proof, merkle_root: bytes, key_length: int = DEFAULT_KEY_LENGTH, index: int = 0
+) -> VerifyResult:
+    """
+    Verify the proof for query_keys against merkle_root and return the reason of the failure, if any.
+    The proof is not modified.
+    """
     if len(query_keys) != len(proof.queries):
-        print("len(query_keys) != len(proof.queries)")
-        return False
+        return VerifyResult(index, VerifyFailure.QUERY_COUNT)
 
-    for key, query in zip(query_keys, proof.queries):
+    for i, (key, query) in enumerate(zip(query_keys, proof.queries)):
         # The bitmap does not contain extra leading 0s
-        if query.bitmap[0] == 0:
-            print("query.bitmap[0] == 0")
-            return False
+        if len(query.bitmap) > 0 and query.bitmap[0] == 0:
+            return VerifyResult(index, VerifyFailure.BITMAP_LEADING_ZEROS, i)
         # q is an inclusion proof for k or a default empty node
         if len(key) != key_length:
-            print("len(key) != key_length")
-            return False
+            return VerifyResult(index, VerifyFailure.KEY_LENGTH, i)
         if key == query.key:
             continue
 
         # q is an inclusion proof for another leaf node
-        common_prefix = os.path.commonprefix([binary_expansion(query.key), binary_expansion(key)])
-        if len(query.binary_bitmap) > len(common_prefix):
+        common_prefix_length = 8 * len(key) - (int.from_bytes(key, "big") ^ query.key_int).bit_length()
+        if query.height > common_prefix_length:
             # q does not give an non-inclusion proof for k
-            print("len(query.binary_bitmap) > len(common_prefix)")
-            return False
-    
+            return VerifyResult(index, VerifyFailure.KEY_NOT_COVERED, i)
+
     filtered_queries = []
-    filter: dict[bytes, bool] = {}
+    filter: dict[tuple[int, int], bool] = {}
     duplicate_queries = {}
-    for q in proof.queries:
+    for i, q in enumerate(proof.queries):
         # Remove duplicate queries preserving order. 
         # This can happen if the same query is given for different query_keys, as for inclusion proofs or non-inclusion proofs pointing to a leaf node
         # or for non-inclusion proofs pointing to the same empty node. 
         # To do this, we check the binary path (key binary expansion up to the query height)
-        if q.binary_path not in filter:
-            filtered_queries.append(q)
-            filter[q.binary_path] = True
+        if q.path not in filter:
+            # queries are hashed up in place, work on copies
+            filtered_queries.append(copy.copy(q))
+            filter[q.path] = True
         
         # Check that if a key appears in several queries, than these queries are exactly the same.
         if q.key not in duplicate_queries:
@@ -561,367 +1068,388 @@ def verify(query_keys: list[bytes], proof: Proof, merkle_root: bytes, key_length
         else:
             duplicate_query = duplicate_queries[q.key]
             if q.key != duplicate_query.key or q.bitmap != duplicate_query.bitmap or q.value != duplicate_query.value:
-                print("q.key != duplicate_query.key or q.bitmap != duplicate_query.bitmap or q.value != duplicate_query.value")
-                return False
-        
-        
-    if not calculate_root(proof.sibling_hashes, filtered_queries) == merkle_root:
-        print("not calculate_root(proof.sibling_hashes, filtered_queries) == merkle_root")
-        return False
-
-    return True
+                return VerifyResult(index, VerifyFailure.DUPLICATE_MISMATCH, i)
+
+    try:
+        root = calculate_root(proof.sibling_hashes, filtered_queries)
+    except IndexError:
+        return VerifyResult(index, VerifyFailure.MISSING_SIBLING_HASHES)
+    except Exception:
+        return VerifyResult(index, VerifyFailure.MALFORMED_PROOF)
+    if root != merkle_root:
+        return VerifyResult(index, VerifyFailure.ROOT_MISMATCH)
+
+    return VerifyResult(index)
+
+
+def verify_batch(
+    proofs: list[tuple[list[bytes], Proof, bytes]],
+    key_length: int = DEFAULT_KEY_LENGTH,
+    workers: int = DEFAULT_VERIFY_WORKERS,
+    executor: Executor | None = None,
+) -> list[VerifyResult]:
+    """
+    Verify many (query_keys, proof, merkle_root) tuples, returning a VerifyResult for each of them in order.
+    With workers > 1 the proofs are verified in chunks by a pool of processes, or by executor when given so that
+    a long running pool is reused. Hashing short inputs does not release the GIL, threads would not run in parallel.
+    """
+    if executor is None and (workers <= 1 or len(proofs) < 2):
+        return _check_proofs(proofs, key_length, 0)
+
+    n_chunks = 4 * max(workers, 1)
+    chunk_size = max(1, -(-len(proofs) // n_chunks))
+    starts = range(0, len(proofs), chunk_size)
+    chunks = [proofs[start : start + chunk_size] for start in starts]
+    if executor is not None:
+        results = executor.map(_check_proofs, chunks, [key_length] * len(chunks), starts)
+        return [result for chunk_results in results for result in chunk_results]
+
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(_check_proofs, chunks, [key_length] * len(chunks), starts)
+        return [result for chunk_results in results for result in chunk_results]
+
+
+def _check_proofs(proofs: list[tuple[list[bytes], Proof, bytes]], key_length: int, start: int) -> list[VerifyResult]:
+    return [check_proof(query_keys, proof, merkle_root, key_length, start + i) for i, (query_keys, proof, merkle_root) in enumerate(proofs)]
 
 
 def calculate_root(sibling_hashes: list[bytes], queries: list[Query]) -> bytes:
-    sorted_queries = sorted(queries, key=lambda q: (-q.height, q.key))
-
-    while len(sorted_queries) > 0:
-        q = sorted_queries.pop(0)
+    return _calculate_root_query(sibling_hashes, queries).hash
+
+
+def _calculate_root_query(
+    sibling_hashes: list[bytes],
+    queries: list[Query],
+    get_sibling_hash: Callable[[Query, bytes], bytes] | None = None,
+    on_merge: Callable[[Query, Query], None] | None = None,
+    on_hash: Callable[[Query, bytes], None] | None = None,
+) -> Query:
+    """
+    Hash the queries up to the root and return the root query.
+    get_sibling_hash can replace a hash taken from sibling_hashes, on_merge is called when two queried branches merge
+    and on_hash before each query is hashed with its sibling.
+    """
+    queue = QueryQueue(queries)
+    sibling_index = 0
+
+    while len(queue) > 0:
+        q = queue.pop()
 
         # We reached the top of the tree, return merkle root
         if q.height == 0:
             # To avoid appending useless bits to all query bitmaps
-            assert len(q.binary_bitmap) == 0
-            assert len(sibling_hashes) == 0
-            return q.hash
+            assert q.bitmap_int == 0
+            assert sibling_index == len(sibling_hashes)
+            return q
 
         # we distinguish three cases for the sibling hash:
-        # 1. sibling is next element of sorted_queries
-        if len(sorted_queries) > 0 and q.is_sibling_of(sorted_queries[0]):
-            sibling_hash = sorted_queries[0].hash
+        # 1. sibling is next element of the queue
+        sibling_query = queue.peek()
+        if sibling_query is not None and q.is_sibling_of(sibling_query):
+            queue.pop()
+            sibling_hash = sibling_query.hash
             # We are merging two branches.
             # Check that the bitmap at the merging point is consistent with the nodes type.
-            if sorted_queries[0].hash == EMPTY_HASH:
-                assert q.binary_bitmap[0] == "0"
+            if sibling_query.hash == EMPTY_HASH:
+                assert q.bitmap_bit == 0
             else:
-                assert q.binary_bitmap[0] == "1"
+                assert q.bitmap_bit == 1
             if q.hash == EMPTY_HASH:
-                assert sorted_queries[0].binary_bitmap[0] == "0"
+                assert sibling_query.bitmap_bit == 0
             else:
-                assert sorted_queries[0].binary_bitmap[0] == "1"
+                assert sibling_query.bitmap_bit == 1
 
             # Check that the bitmap coincide from the merging point up.
-            assert len(q.binary_bitmap) == len(sorted_queries[0].binary_bitmap)
-            if len(q.binary_bitmap):
-                # print(f"query: key={q.key.hex()[:4]:4s} bitmap={q.binary_bitmap:12s} - {q.bitmap.hex()}")
-                # print(f"sibli: key={sorted_queries[0].key.hex()[:4]:4s} bitmap={sorted_queries[0].binary_bitmap:12s} - {sorted_queries[0].bitmap.hex()}")
-                assert q.binary_bitmap[1:] == sorted_queries[0].binary_bitmap[1:]
+            mask = (1 << (q.height - 1)) - 1
+            assert q.bitmap_int & mask == sibling_query.bitmap_int & mask
 
-            del sorted_queries[0]
+            if on_merge is not None:
+                on_merge(q, sibling_query)
         # 2. sibling is default empty node
-        elif q.binary_bitmap[0] == "0":
+        elif q.bitmap_bit == 0:
             sibling_hash = EMPTY_HASH
         # 3. sibling hash comes from sibling_hashes
-        elif q.binary_bitmap[0] == "1":
-            sibling_hash = sibling_hashes.pop(0)
+        else:
+            sibling_hash = sibling_hashes[sibling_index]
+            sibling_index += 1
+            if get_sibling_hash is not None:
+                sibling_hash = get_sibling_hash(q, sibling_hash)
 
-        d = q.binary_key[q.height - 1]
-        if d == "0":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", q.hash.hex()[:4], sibling_hash.hex()[:4], " --> ", BranchNode(q.hash, sibling_hash).hash.hex()[:4])
+        if on_hash is not None:
+            on_hash(q, sibling_hash)
+
+        if q.key_bit == 0:
             q.hash = BranchNode(q.hash, sibling_hash).hash
-        elif d == "1":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", sibling_hash.hex()[:4], q.hash.hex()[:4], " --> ", BranchNode(sibling_hash, q.hash).hash.hex()[:4])
+        else:
             q.hash = BranchNode(sibling_hash, q.hash).hash
 
-        q.binary_bitmap = q.binary_bitmap[1:]
-        sorted_queries = insert_and_filter_queries(q, sorted_queries)
+        q.move_up()
+        queue.push(q)
 
     raise Exception("Can not calculate root hash")
 
+
 def remove_keys_from_proof(base_proof: Proof, removing_keys: list[bytes]) -> Proof:
-    import copy
-    sibling_hashes = copy.deepcopy(base_proof.sibling_hashes)
     queries = copy.deepcopy(base_proof.queries)
+    removing_keys = set(removing_keys)
     removing_sibling_hashes: list[bytes] = []
     adding_sibling_hashes: list[tuple[int, bytes]] = []
     adding_sibling_hash_index = 0
-    sorted_queries = sorted(queries, key=lambda q: (-q.height, q.key))
-    for q in sorted_queries:
-        if q.key in removing_keys:
-            q.removing = True
-        else:
-            q.removing = False
-
-    while len(sorted_queries) > 0:
-        q = sorted_queries.pop(0)
-
-        # We reached the top of the tree, return merkle root
-        if q.height == 0:
-            # To avoid appending useless bits to all query bitmaps
-            assert len(q.binary_bitmap) == 0
-            assert len(sibling_hashes) == 0
-            for idx, h in adding_sibling_hashes:
-                assert h not in base_proof.sibling_hashes
-                base_proof.sibling_hashes.insert(idx, h)
-                assert h in base_proof.sibling_hashes
-            for h in removing_sibling_hashes:
-                assert h in base_proof.sibling_hashes
-                base_proof.sibling_hashes.remove(h)
-                assert h not in base_proof.sibling_hashes
-
-            updated_queries = [q for q in base_proof.queries]
-            for q in base_proof.queries:
-                if q.key in removing_keys:
-                    updated_queries.remove(q)
-            for q in updated_queries:
-                assert q.key not in removing_keys
-            
-            base_proof.queries = updated_queries
-
-            return base_proof
-
-        # we distinguish three cases for the sibling hash:
-        # 1. sibling is next element of sorted_queries
-        if len(sorted_queries) > 0 and q.is_sibling_of(sorted_queries[0]):
-            sibling_hash = sorted_queries[0].hash
-            # We are merging two branches.
-            # Check that the bitmap at the merging point is consistent with the nodes type.
-            if sorted_queries[0].hash == EMPTY_HASH:
-                assert q.binary_bitmap[0] == "0"
-            else:
-                assert q.binary_bitmap[0] == "1"
-            if q.hash == EMPTY_HASH:
-                assert sorted_queries[0].binary_bitmap[0] == "0"
-            else:
-                assert sorted_queries[0].binary_bitmap[0] == "1"
-
-            # Check that the bitmap coincide from the merging point up.
-            assert len(q.binary_bitmap) == len(sorted_queries[0].binary_bitmap)
-            if len(q.binary_bitmap):
-                assert q.binary_bitmap[1:] == sorted_queries[0].binary_bitmap[1:]
-            
-            # If the branch is being removed, we need to add the sibling hash to the list of hashes to be added
-            if not q.removing and sorted_queries[0].removing:
-                adding_sibling_hashes.append((adding_sibling_hash_index, sibling_hash))
-                adding_sibling_hash_index += 1
-                # print("Adding sibling merging branches", sibling_hash.hex()[:4])
-            elif q.removing and not sorted_queries[0].removing:
-                adding_sibling_hashes.append((adding_sibling_hash_index, q.hash))
-                adding_sibling_hash_index += 1
-                # print("Adding sibling merging branches", q.hash.hex()[:4])
-                # If the other branch is not removed, we update the query to not be removed
-                # print("Updating query to not be removed", q.binary_bitmap, q.key.hex()[:4])
-                q.removing = False
-            
-            del sorted_queries[0]
-        # 2. sibling is default empty node
-        elif q.binary_bitmap[0] == "0":
-            sibling_hash = EMPTY_HASH
-        # 3. sibling hash comes from sibling_hashes
-        elif q.binary_bitmap[0] == "1":
-            sibling_hash = sibling_hashes.pop(0)
+    # queries are slotted, the removing flag is kept aside by query identity
+    removing = {id(q): q.key in removing_keys for q in queries}
+
+    def on_merge(q: Query, sibling_query: Query) -> None:
+        nonlocal adding_sibling_hash_index
+        # If the branch is being removed, we need to add the sibling hash to the list of hashes to be added
+        if not removing[id(q)] and removing[id(sibling_query)]:
+            adding_sibling_hashes.append((adding_sibling_hash_index, sibling_query.hash))
             adding_sibling_hash_index += 1
-            if q.removing:
-                # print("Removing unnecessary sibling", sibling_hash.hex()[:4])
-                removing_sibling_hashes.append(sibling_hash)
+        elif removing[id(q)] and not removing[id(sibling_query)]:
+            adding_sibling_hashes.append((adding_sibling_hash_index, q.hash))
+            adding_sibling_hash_index += 1
+            # If the other branch is not removed, we update the query to not be removed
+            removing[id(q)] = False
 
-        d = q.binary_key[q.height - 1]
-        if d == "0":
-            q.hash = BranchNode(q.hash, sibling_hash).hash
-        elif d == "1":
-            q.hash = BranchNode(sibling_hash, q.hash).hash
+    def get_sibling_hash(q: Query, sibling_hash: bytes) -> bytes:
+        nonlocal adding_sibling_hash_index
+        adding_sibling_hash_index += 1
+        if removing[id(q)]:
+            removing_sibling_hashes.append(sibling_hash)
+        return sibling_hash
 
-        q.binary_bitmap = q.binary_bitmap[1:]
-        sorted_queries = insert_and_filter_queries(q, sorted_queries)
+    _calculate_root_query(base_proof.sibling_hashes, queries, get_sibling_hash, on_merge)
 
-    raise Exception("Can not calculate root hash")
+    for idx, h in adding_sibling_hashes:
+        assert h not in base_proof.sibling_hashes
+        base_proof.sibling_hashes.insert(idx, h)
+    for h in removing_sibling_hashes:
+        assert h in base_proof.sibling_hashes
+        base_proof.sibling_hashes.remove(h)
+
+    base_proof.queries = [q for q in base_proof.queries if q.key not in removing_keys]
+    return base_proof
 
 
 def get_visited_nodes(sibling_hashes: list[bytes], queries: list[Query]) -> dict[str, bytes]:
     visited_nodes: dict[str, bytes] = {}
-    sorted_queries = sorted(queries, key=lambda q: (-q.height, q.key))
 
-    while len(sorted_queries) > 0:
-        q = sorted_queries.pop(0)
+    def on_hash(q: Query, sibling_hash: bytes) -> None:
+        binary_path = q.binary_path
+        visited_nodes[binary_path] = q.hash
+        visited_nodes[binary_path[:-1] + ("0" if q.key_bit else "1")] = sibling_hash
 
-        # We reached the top of the tree, return merkle root
-        if q.height == 0:
-            # To avoid appending useless bits to all query bitmaps
-            assert len(q.binary_bitmap) == 0
-            assert len(sibling_hashes) == 0
-            visited_nodes["root"] = q.hash
-            return visited_nodes
+    visited_nodes["root"] = _calculate_root_query(sibling_hashes, queries, on_hash=on_hash).hash
+    return visited_nodes
 
-        # we distinguish three cases for the sibling hash:
-        # 1. sibling is next element of sorted_queries
-        if len(sorted_queries) > 0 and q.is_sibling_of(sorted_queries[0]):
-            sibling_hash = sorted_queries[0].hash
-            # We are merging two branches.
-            # Check that the bitmap at the merging point is consistent with the nodes type.
-            if sorted_queries[0].hash == EMPTY_HASH:
-                assert q.binary_bitmap[0] == "0"
-            else:
-                assert q.binary_bitmap[0] == "1"
-            if q.hash == EMPTY_HASH:
-                assert sorted_queries[0].binary_bitmap[0] == "0"
-            else:
-                assert sorted_queries[0].binary_bitmap[0] == "1"
 
-            # Check that the bitmap coincide from the merging point up.
-            assert len(q.binary_bitmap) == len(sorted_queries[0].binary_bitmap)
-            if len(q.binary_bitmap):
-                # print(f"query: key={q.key.hex()[:4]:4s} bitmap={q.binary_bitmap:12s} - {q.bitmap.hex()}")
-                # print(f"sibli: key={sorted_queries[0].key.hex()[:4]:4s} bitmap={sorted_queries[0].binary_bitmap:12s} - {sorted_queries[0].bitmap.hex()}")
-                assert q.binary_bitmap[1:] == sorted_queries[0].binary_bitmap[1:]
+def calculate_root_with_visited_nodes_override(sibling_hashes: list[bytes], queries: list[Query], visited_nodes_override: dict[str, bytes]) -> bytes:
+    def get_sibling_hash(q: Query, sibling_hash: bytes) -> bytes:
+        # here we inject the nodes from the visited_nodes_override
+        sibling_binary_key = q.binary_path[:-1] + ("0" if q.key_bit else "1")
+        return visited_nodes_override.get(sibling_binary_key, sibling_hash)
 
-            del sorted_queries[0]
-        # 2. sibling is default empty node
-        elif q.binary_bitmap[0] == "0":
-            sibling_hash = EMPTY_HASH
-        # 3. sibling hash comes from sibling_hashes
-        elif q.binary_bitmap[0] == "1":
-            sibling_hash = sibling_hashes.pop(0)
-
-        d = q.binary_key[q.height - 1]
-        if d == "0":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", q.hash.hex()[:4], sibling_hash.hex()[:4], " --> ", BranchNode(q.hash, sibling_hash).hash.hex()[:4])
-            # print(f"Hashing >> left: {q.binary_key[:q.height]} right: {q.binary_key[:q.height - 1] + '1'} into {q.binary_key[:q.height - 1]}")
-            sibling_binary_key = q.binary_key[:q.height - 1] + "1"
-            visited_nodes[q.binary_key[:q.height]] = q.hash
-            visited_nodes[sibling_binary_key] = sibling_hash
-            q.hash = BranchNode(q.hash, sibling_hash).hash
-        elif d == "1":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", sibling_hash.hex()[:4], q.hash.hex()[:4], " --> ", BranchNode(sibling_hash, q.hash).hash.hex()[:4])
-            # print(f"Hashing >> left: {q.binary_key[:q.height - 1] + '0'} right: {q.binary_key[:q.height]} into {q.binary_key[:q.height - 1]}")
-            sibling_binary_key = q.binary_key[:q.height - 1] + "0"
-            visited_nodes[q.binary_key[:q.height]] = q.hash
-            # print(f"Inserted {q.binary_key[:q.height]}: {q.hash.hex()[:4]}")
-            visited_nodes[sibling_binary_key] = sibling_hash
-            # print(f"Inserted {sibling_binary_key}: {sibling_hash.hex()[:4]}")
-            
-            q.hash = BranchNode(sibling_hash, q.hash).hash
+    return _calculate_root_query(sibling_hashes, queries, get_sibling_hash).hash
 
-        q.binary_bitmap = q.binary_bitmap[1:]
-        sorted_queries = insert_and_filter_queries(q, sorted_queries)
 
-    raise Exception("Can not calculate root hash")
+def get_nodes_override_mapping(sibling_hashes: list[bytes], queries: list[Query], visited_nodes_override: dict[str, bytes]) -> dict[bytes, bytes]:
+    override_mapping: dict[bytes, bytes] = {}
 
-def calculate_root_with_visited_nodes_override(sibling_hashes: list[bytes], queries: list[Query], visited_nodes_override: dict[str, bytes]) -> bytes:
-    sorted_queries = sorted(queries, key=lambda q: (-q.height, q.key))
+    def get_sibling_hash(q: Query, sibling_hash: bytes) -> bytes:
+        # here we inject the nodes from the visited_nodes_override
+        sibling_binary_key = q.binary_path[:-1] + ("0" if q.key_bit else "1")
+        if sibling_binary_key in visited_nodes_override:
+            override_mapping[sibling_hash] = visited_nodes_override[sibling_binary_key]
+            return visited_nodes_override[sibling_binary_key]
+        return sibling_hash
 
-    while len(sorted_queries) > 0:
-        q = sorted_queries.pop(0)
+    _calculate_root_query(sibling_hashes, queries, get_sibling_hash)
+    return override_mapping
 
-        # We reached the top of the tree, return merkle root
-        if q.height == 0:
-            # To avoid appending useless bits to all query bitmaps
-            assert len(q.binary_bitmap) == 0
-            assert len(sibling_hashes) == 0
-            return q.hash
 
-        # we distinguish three cases for the sibling hash:
-        # 1. sibling is next element of sorted_queries
-        if len(sorted_queries) > 0 and q.is_sibling_of(sorted_queries[0]):
-            sibling_hash = sorted_queries[0].hash
-            # We are merging two branches.
-            # Check that the bitmap at the merging point is consistent with the nodes type.
-            if sorted_queries[0].hash == EMPTY_HASH:
-                assert q.binary_bitmap[0] == "0"
-            else:
-                assert q.binary_bitmap[0] == "1"
-            if q.hash == EMPTY_HASH:
-                assert sorted_queries[0].binary_bitmap[0] == "0"
-            else:
-                assert sorted_queries[0].binary_bitmap[0] == "1"
+class _ProofBranch(object):
+    # branch of a ProofTree, its children are kept and its hash is computed once
+    __slots__ = ("left", "right", "_hash")
 
-            # Check that the bitmap coincide from the merging point up.
-            assert len(q.binary_bitmap) == len(sorted_queries[0].binary_bitmap)
-            if len(q.binary_bitmap):
-                # print(f"query: key={q.key.hex()[:4]:4s} bitmap={q.binary_bitmap:12s} - {q.bitmap.hex()}")
-                # print(f"sibli: key={sorted_queries[0].key.hex()[:4]:4s} bitmap={sorted_queries[0].binary_bitmap:12s} - {sorted_queries[0].bitmap.hex()}")
-                assert q.binary_bitmap[1:] == sorted_queries[0].binary_bitmap[1:]
+    def __init__(self, left: "ProofNode", right: "ProofNode", node_hash: bytes | None = None) -> None:
+        self.left = left
+        self.right = right
+        self._hash = node_hash
 
-            del sorted_queries[0]
-        # 2. sibling is default empty node
-        elif q.binary_bitmap[0] == "0":
-            sibling_hash = EMPTY_HASH
-        # 3. sibling hash comes from sibling_hashes
-        elif q.binary_bitmap[0] == "1":
-            sibling_hash = sibling_hashes.pop(0)
-            # here we inject the nodes from the visited_nodes_override
-            sibling_binary_key = q.binary_key[:q.height - 1] + "0" if q.binary_key[q.height - 1] == "1" else q.binary_key[:q.height - 1] + "1"
-            if sibling_binary_key in visited_nodes_override:
-                # print("sibling key", q.binary_path, q.binary_key[:q.height+5], sibling_binary_key)
-                # print(f"overriding sibling hash {sibling_hash.hex()[:4]} with {visited_nodes_override[sibling_binary_key].hex()[:4]} at key {sibling_binary_key}")
-                sibling_hash = visited_nodes_override[sibling_binary_key]
-            
-        d = q.binary_key[q.height - 1]
-        if d == "0":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", q.hash.hex()[:4], sibling_hash.hex()[:4], " --> ", BranchNode(q.hash, sibling_hash).hash.hex()[:4])
-            q.hash = BranchNode(q.hash, sibling_hash).hash
-        elif d == "1":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", sibling_hash.hex()[:4], q.hash.hex()[:4], " --> ", BranchNode(sibling_hash, q.hash).hash.hex()[:4])
-            q.hash = BranchNode(sibling_hash, q.hash).hash
+    @property
+    def hash(self) -> bytes:
+        if self._hash is None:
+            self._hash = BranchNode(self.left.hash, self.right.hash).hash
+        return self._hash
 
-        q.binary_bitmap = q.binary_bitmap[1:]
-        sorted_queries = insert_and_filter_queries(q, sorted_queries)
 
-    raise Exception("Can not calculate root hash")
+ProofNode = LeafNode | EmptyNode | StubNode | _ProofBranch
 
-def get_nodes_override_mapping(sibling_hashes: list[bytes], queries: list[Query], visited_nodes_override: dict[str, bytes]) -> dict[bytes, bytes]:
-    override_mapping: dict[bytes, bytes] = {}
-    sorted_queries = sorted(queries, key=lambda q: (-q.height, q.key))
 
-    while len(sorted_queries) > 0:
-        q = sorted_queries.pop(0)
+class ProofTree(object):
+    """
+    The part of the tree revealed by a proof: the queried leaves and empty nodes, the branches above them and
+    stubs for the subtrees known only by their sibling hash. Updates are applied without the db, rehashing
+    the changed paths only, so a light client following query_keys can keep its proof across blocks.
 
-        # We reached the top of the tree, return merkle root
-        if q.height == 0:
-            # To avoid appending useless bits to all query bitmaps
-            assert len(q.binary_bitmap) == 0
-            assert len(sibling_hashes) == 0
-            return override_mapping
+    An update must fall outside of the stubs. Removing a leaf also fails if a stub would have to be pushed up:
+    the proof does not tell whether the stub is a single leaf. Both raise MissingNodeError and leave the tree
+    unchanged. The second case is common when deleting: the sibling of a removed leaf is usually a stub.
+    """
 
-        # we distinguish three cases for the sibling hash:
-        # 1. sibling is next element of sorted_queries
-        if len(sorted_queries) > 0 and q.is_sibling_of(sorted_queries[0]):
-            sibling_hash = sorted_queries[0].hash
-            # We are merging two branches.
-            # Check that the bitmap at the merging point is consistent with the nodes type.
-            if sorted_queries[0].hash == EMPTY_HASH:
-                assert q.binary_bitmap[0] == "0"
-            else:
-                assert q.binary_bitmap[0] == "1"
-            if q.hash == EMPTY_HASH:
-                assert sorted_queries[0].binary_bitmap[0] == "0"
-            else:
-                assert sorted_queries[0].binary_bitmap[0] == "1"
+    def __init__(self, query_keys: list[bytes], proof: Proof) -> None:
+        self.query_keys = list(query_keys)
+        # stubs known to be branches, as the sibling of an empty node
+        self._branch_hashes: set[bytes] = set()
+        self.stats = {
+            "hashes": 0,
+        }
 
-            # Check that the bitmap coincide from the merging point up.
-            assert len(q.binary_bitmap) == len(sorted_queries[0].binary_bitmap)
-            if len(q.binary_bitmap):
-                # print(f"query: key={q.key.hex()[:4]:4s} bitmap={q.binary_bitmap:12s} - {q.bitmap.hex()}")
-                # print(f"sibli: key={sorted_queries[0].key.hex()[:4]:4s} bitmap={sorted_queries[0].binary_bitmap:12s} - {sorted_queries[0].bitmap.hex()}")
-                assert q.binary_bitmap[1:] == sorted_queries[0].binary_bitmap[1:]
+        queries = [copy.copy(q) for q in proof.queries]
+        nodes: dict[tuple[int, int], ProofNode] = {}
+        for q in queries:
+            nodes[q.path] = EmptyNode() if q.value == EMPTY_VALUE else LeafNode(q.key, q.value)
+        branch_hashes: dict[tuple[int, int], bytes] = {}
+        merged: set[tuple[int, int]] = set()
+
+        def on_merge(q: Query, sibling_query: Query) -> None:
+            merged.add(sibling_query.path)
+            if sibling_query.path not in nodes:
+                branch_hashes[sibling_query.path] = sibling_query.hash
+
+        def on_hash(q: Query, sibling_hash: bytes) -> None:
+            # branches are built from the hashes computed while checking the proof
+            height, prefix = q.path
+            if q.path not in nodes:
+                branch_hashes[q.path] = q.hash
+            sibling_path = (height, prefix ^ 1)
+            if sibling_path not in nodes and sibling_path not in merged:
+                nodes[sibling_path] = EmptyNode() if sibling_hash == EMPTY_HASH else StubNode(sibling_hash)
+
+        with HashCounter() as counter:
+            try:
+                root_hash = _calculate_root_query(proof.sibling_hashes, queries, on_merge=on_merge, on_hash=on_hash).hash
+            except (AssertionError, IndexError):
+                raise InvalidDataError("Invalid proof")
+        self.stats["hashes"] += counter.hashes
+        branch_hashes[(0, 0)] = root_hash
+        self.root = self._build(nodes, branch_hashes, 0, 0)
+
+    def _build(
+        self, nodes: dict[tuple[int, int], ProofNode], branch_hashes: dict[tuple[int, int], bytes], height: int, prefix: int
+    ) -> ProofNode:
+        if (height, prefix) in nodes:
+            return nodes[(height, prefix)]
+        left = self._build(nodes, branch_hashes, height + 1, prefix << 1)
+        right = self._build(nodes, branch_hashes, height + 1, (prefix << 1) | 1)
+        if isinstance(left, EmptyNode) and isinstance(right, StubNode):
+            self._branch_hashes.add(right.hash)
+        elif isinstance(right, EmptyNode) and isinstance(left, StubNode):
+            self._branch_hashes.add(left.hash)
+        return _ProofBranch(left, right, branch_hashes.get((height, prefix)))
+
+    @property
+    def root_hash(self) -> bytes:
+        with HashCounter() as counter:
+            root_hash = self.root.hash
+        self.stats["hashes"] += counter.hashes
+        return root_hash
+
+    def update(self, keys: list[bytes], values: list[bytes]) -> bytes:
+        # an empty value removes the key, as in SkipMerkleTree.update. Return the new root hash.
+        assert len(keys) == len(values)
+        root = self.root
+        for key, value in zip(keys, values):
+            root = self._update_node(root, key, value, 0)
+        # the updates are applied together, a failing one leaves the tree as it was
+        self.root = root
+        return self.root_hash
+
+    def _update_node(self, node: ProofNode, key: bytes, value: bytes, height: int) -> ProofNode:
+        if isinstance(node, StubNode):
+            raise MissingNodeError(f"Key {key.hex()} is not covered by the proof")
+        if isinstance(node, EmptyNode):
+            return node if value == EMPTY_VALUE else LeafNode(key, value)
+        if isinstance(node, LeafNode):
+            if node.key == key:
+                return EmptyNode() if value == EMPTY_VALUE else LeafNode(key, value)
+            if value == EMPTY_VALUE:
+                return node
+            return self._split(node, LeafNode(key, value), height)
+
+        if is_bit_set(key, height):
+            return self._branch(node.left, self._update_node(node.right, key, value, height + 1))
+        return self._branch(self._update_node(node.left, key, value, height + 1), node.right)
+
+    def _branch(self, left: ProofNode, right: ProofNode) -> ProofNode:
+        # canonical form: a leaf with an empty sibling is pushed up, as is an empty node with an empty sibling
+        if isinstance(left, EmptyNode):
+            child = right
+        elif isinstance(right, EmptyNode):
+            child = left
+        else:
+            return _ProofBranch(left, right)
+        if isinstance(child, StubNode) and child.hash not in self._branch_hashes:
+            raise MissingNodeError(f"Subtree {child.hash.hex()} is not in the proof")
+        return child if isinstance(child, (EmptyNode, LeafNode)) else _ProofBranch(left, right)
+
+    def _split(self, a: LeafNode, b: LeafNode, height: int) -> _ProofBranch:
+        # two leaves share the node at height: branch down to the first different bit
+        bit_a = is_bit_set(a.key, height)
+        if bit_a == is_bit_set(b.key, height):
+            child = self._split(a, b, height + 1)
+            return _ProofBranch(EmptyNode(), child) if bit_a else _ProofBranch(child, EmptyNode())
+        return _ProofBranch(b, a) if bit_a else _ProofBranch(a, b)
+
+    def proof(self) -> Proof:
+        with HashCounter() as counter:
+            query_proofs: list[QueryWithProof] = []
+            for k in self.query_keys:
+                node = self.root
+                height = 0
+                ancestor_hashes = []
+                sibling_hashes = []
+                binary_bitmap = ""
+                while isinstance(node, _ProofBranch):
+                    ancestor_hashes.append(node.hash)
+                    if is_bit_set(k, height):
+                        node, sibling = node.right, node.left
+                    else:
+                        node, sibling = node.left, node.right
+                    if isinstance(sibling, EmptyNode):
+                        binary_bitmap = "0" + binary_bitmap
+                    else:
+                        binary_bitmap = "1" + binary_bitmap
+                        sibling_hashes.append(sibling.hash)
+                    height += 1
+
+                bitmap = binary_to_bytes(binary_bitmap) if height > 0 else b""
+                if isinstance(node, LeafNode):
+                    ancestor_hashes.append(node.hash)
+                    query_proofs.append(QueryWithProof(node.key, node.value, bitmap, ancestor_hashes, sibling_hashes))
+                elif isinstance(node, EmptyNode):
+                    query_proofs.append(QueryWithProof(k, EMPTY_VALUE, bitmap, ancestor_hashes, sibling_hashes))
+                else:
+                    raise MissingNodeError(f"Key {k.hex()} is not covered by the proof")
+        self.stats["hashes"] += counter.hashes
+        return _merge_query_proofs(query_proofs)
 
-            del sorted_queries[0]
-        # 2. sibling is default empty node
-        elif q.binary_bitmap[0] == "0":
-            sibling_hash = EMPTY_HASH
-        # 3. sibling hash comes from sibling_hashes
-        elif q.binary_bitmap[0] == "1":
-            sibling_hash = sibling_hashes.pop(0)
-            # here we inject the nodes from the visited_nodes_override
-            sibling_binary_key = q.binary_key[:q.height - 1] + "0" if q.binary_key[q.height - 1] == "1" else q.binary_key[:q.height - 1] + "1"
-            if sibling_binary_key in visited_nodes_override:
-                # print("sibling key", q.binary_path, q.binary_key[:q.height+5], sibling_binary_key)
-                # print(f"overriding sibling hash {sibling_hash.hex()[:4]} with {visited_nodes_override[sibling_binary_key].hex()[:4]} at key {sibling_binary_key}")
-                override_mapping[sibling_hash] = visited_nodes_override[sibling_binary_key]
-                sibling_hash = visited_nodes_override[sibling_binary_key]
-                
-            
-        d = q.binary_key[q.height - 1]
-        if d == "0":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", q.hash.hex()[:4], sibling_hash.hex()[:4], " --> ", BranchNode(q.hash, sibling_hash).hash.hex()[:4])
-            q.hash = BranchNode(q.hash, sibling_hash).hash
-        elif d == "1":
-            # print(f"Hashing at h={len(q.binary_bitmap)}", sibling_hash.hex()[:4], q.hash.hex()[:4], " --> ", BranchNode(sibling_hash, q.hash).hash.hex()[:4])
-            q.hash = BranchNode(sibling_hash, q.hash).hash
 
-        q.binary_bitmap = q.binary_bitmap[1:]
-        sorted_queries = insert_and_filter_queries(q, sorted_queries)
+def update_proof(query_keys: list[bytes], proof: Proof, keys: list[bytes], values: list[bytes]) -> tuple[Proof, bytes] | None:
+    """
+    Apply the updates of keys to the proof of query_keys and return the updated proof and root hash, without the db.
+    The proof should be verified against the trusted root first.
+
+    Return None if the proof does not reveal enough of the tree for the updates, see ProofTree: an updated key
+    is not covered by the proof, or a removed leaf has a sibling known only by its hash. The proof can not be
+    updated and must be generated again from the tree.
+    """
+    tree = ProofTree(query_keys, proof)
+    try:
+        root_hash = tree.update(keys, values)
+    except MissingNodeError:
+        return None
+    return tree.proof(), root_hash
 
-    raise Exception("Can not calculate root hash")
 
 def is_inclusion_proof(query_key: bytes, query: Query) -> bool:
     return query_key == query.key and query.value != EMPTY_VALUE
@@ -957,5 +1485,4 @@ async def testing():
     print(await _smt.print(_smt.root))
     return _smt
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(testing())
\ No newline at end of file
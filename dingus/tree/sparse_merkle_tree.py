@@ -1,22 +1,33 @@
-from .constants import BRANCH_PREFIX, DEFAULT_KEY_LENGTH, EMPTY_HASH, LEAF_PREFIX, DEFAULT_HASHER
-from .types import LeafNode, BranchNode, EmptyNode, TreeNode
+from .constants import BRANCH_PREFIX, DEFAULT_KEY_LENGTH, DEFAULT_UPDATE_CONCURRENCY, EMPTY_HASH, LEAF_PREFIX, DEFAULT_HASHER
+from .types import LeafNode, BranchNode, EmptyNode, StubNode, TreeNode
+from .collector import GarbageCollector
+from .hasher import HashCounter
 from .utils import split_index, is_bit_set
 from .errors import *
 from typing import Coroutine, Any
+import asyncio
 import os
 from dingus.crypto import hash
 
-from dingus.db import InMemoryDB, RocksDB
+from dingus.db import InMemoryDB, RocksDB, SqliteDB
 
 
 class SparseMerkleTree(object):
-    def __init__(self, key_length: int = DEFAULT_KEY_LENGTH, db: str = "inmemorydb") -> None:
+    def __init__(
+        self,
+        key_length: int = DEFAULT_KEY_LENGTH,
+        db: str = "inmemorydb",
+        gc_slice: float | None = None,
+        concurrency: int = DEFAULT_UPDATE_CONCURRENCY,
+    ) -> None:
         self.key_length = key_length
         self.root = EmptyNode()
         if db == "inmemorydb":
             self._db = InMemoryDB()
         elif db == "rocksdb":
             self._db = RocksDB(filename="./database/smt.db")
+        elif db == "sqlitedb":
+            self._db = SqliteDB(filename="./database/smt.sqlite")
         self.stats = {
             "db_set": 0,
             "db_get": 0,
@@ -26,6 +37,14 @@ class SparseMerkleTree(object):
             "branch_created": 0,
             "update_calls": 0,
         }
+        # With gc_slice set, replaced nodes are not deleted by the tree: after each update a garbage collector
+        # runs for gc_slice seconds and deletes the nodes the root can not reach.
+        self.gc_slice = gc_slice
+        self._collector = GarbageCollector(self) if gc_slice is not None else None
+        # With concurrency > 1, update reads the children of a branch together and updates both sides concurrently,
+        # with at most concurrency db reads in flight. The semaphore is created for each update, in its event loop.
+        self.concurrency = concurrency
+        self._reads: asyncio.Semaphore | None = None
 
     async def print(self, node: TreeNode, preamble: str = "    ", hash_length: int = 4) -> str:
         BROWN = lambda t: f"\u001b[38;2;{105};{103};{60}m" + t + "\u001b[0m"
@@ -53,7 +72,11 @@ class SparseMerkleTree(object):
         if node_hash == EmptyNode.hash:
             return EmptyNode()
 
-        data = await self._db.get(node_hash)
+        if self._reads is not None:
+            async with self._reads:
+                data = await self._db.get(node_hash)
+        else:
+            data = await self._db.get(node_hash)
         self.stats["db_get"] += 1
 
         if not data:
@@ -74,10 +97,32 @@ class SparseMerkleTree(object):
     async def set_node(self, node: TreeNode) -> None:
         await self._db.set(node.hash, node.data)
         self.stats["db_set"] += 1
+        if self._collector is not None:
+            self._collector.shade(node.hash)
+
+    async def delete_node(self, node_hash: bytes) -> None:
+        # the collector, if any, deletes the node once unreachable
+        if self._collector is None:
+            await self._db.delete(node_hash)
+            self.stats["db_delete"] += 1
+
+    def live_roots(self) -> list[bytes]:
+        return [self.root.hash]
+
+    def node_children(self, data: bytes) -> list[bytes]:
+        # hashes of the children of an encoded branch node
+        if data.startswith(BRANCH_PREFIX):
+            return [h for h in BranchNode.parse(data) if h != EMPTY_HASH]
+        return []
 
     async def write_to_db(self) -> None:
         await self._db.write()
 
+    async def load(self, root_hash: bytes) -> Coroutine[Any, Any, TreeNode]:
+        # resume from a root stored in a persistent db
+        self.root = await self.get_node(root_hash)
+        return self.root
+
     # async def update(
     #     self, key: bytes, value: bytes, starting_height: int = 0
     # ) -> Coroutine[Any, Any, TreeNode]:
@@ -177,10 +222,22 @@ class SparseMerkleTree(object):
         keys = [key for key, _ in sorted_data]
         values = [value for _, value in sorted_data]
 
-        self.root = await self._update(keys, values, self.root, 0)
-        await self.write_to_db()
+        with HashCounter() as counter:
+            if self.concurrency > 1:
+                self._reads = asyncio.Semaphore(self.concurrency)
+            try:
+                self.root = await self._update(keys, values, self.root, 0)
+            finally:
+                self._reads = None
+            await self.write_to_db()
+            await self._collect_garbage()
+        self.stats["hashes"] += counter.hashes
         return self.root
 
+    async def _collect_garbage(self) -> None:
+        if self._collector is not None:
+            await self._collector.step(self.gc_slice)
+
     async def _update(
         self,
         keys: list[bytes],
@@ -202,8 +259,7 @@ class SparseMerkleTree(object):
                 await self.set_node(new_leaf)
                 return new_leaf
             elif isinstance(current_node, LeafNode) and current_node.key == keys[0]:
-                await self._db.delete(current_node.hash)
-                self.stats["db_delete"] += 1
+                await self.delete_node(current_node.hash)
                 new_leaf = LeafNode(keys[0], values[0])
                 self.stats["leaf_created"] += 1
                 await self.set_node(new_leaf)
@@ -219,23 +275,30 @@ class SparseMerkleTree(object):
             else:
                 left_node = current_node
                 right_node = EmptyNode()
-        elif isinstance(current_node, BranchNode):
-            left_node = await self.get_node(current_node.left_hash)
-            right_node = await self.get_node(current_node.right_hash)
-            await self._db.delete(current_node.hash)
-            self.stats["db_delete"] += 1
 
         idx = split_index(keys, lambda k: is_bit_set(k, height))
-
-        # concurrent_update = (height < 8) and (0 < idx < len(keys))
-        # if concurrent_update:
-        #     left_node, right_node = await asyncio.gather(
-        #         self._update(keys[:idx], values[:idx], left_node, height + 1),
-        #         self._update(keys[idx:], values[idx:], right_node, height + 1),
-        #     )
-        # else:
-        left_node = await self._update(keys[:idx], values[:idx], left_node, height + 1)
-        right_node = await self._update(keys[idx:], values[idx:], right_node, height + 1)
+        if isinstance(current_node, BranchNode):
+            # a child without keys below is kept as it is, only its hash is needed
+            left_node = StubNode(current_node.left_hash)
+            right_node = StubNode(current_node.right_hash)
+            if self._reads is not None and 0 < idx < len(keys):
+                left_node, right_node = await asyncio.gather(self.get_node(current_node.left_hash), self.get_node(current_node.right_hash))
+            else:
+                if idx > 0:
+                    left_node = await self.get_node(current_node.left_hash)
+                if idx < len(keys):
+                    right_node = await self.get_node(current_node.right_hash)
+            await self.delete_node(current_node.hash)
+
+        if self._reads is not None and 0 < idx < len(keys):
+            # the order of the db writes changes, not the nodes written
+            left_node, right_node = await asyncio.gather(
+                self._update(keys[:idx], values[:idx], left_node, height + 1),
+                self._update(keys[idx:], values[idx:], right_node, height + 1),
+            )
+        else:
+            left_node = await self._update(keys[:idx], values[:idx], left_node, height + 1)
+            right_node = await self._update(keys[idx:], values[idx:], right_node, height + 1)
 
         current_node = BranchNode(left_node.hash, right_node.hash)
         self.stats["branch_created"] += 1
@@ -273,18 +336,15 @@ class SparseMerkleTree(object):
             return current_node
 
         bottom_node = EmptyNode()
+        await self.delete_node(current_node.hash)
 
-        # current_node has a branch sibling, delete current_node
-        if isinstance(current_node_sibling, BranchNode):
-            await self._db.delete(current_node.hash)
-        elif isinstance(current_node_sibling, LeafNode):
+        if isinstance(current_node_sibling, LeafNode):
             # current_node has a leaf sibling,
-            # remove the leaf and move sibling up the tree
-            await self._db.delete(current_node.hash)
-            self.stats["db_delete"] += 1
+            # remove the leaf and move sibling up the tree in place of their parent
             bottom_node = current_node_sibling
 
             h -= 1
+            await self.delete_node(ancestor_nodes[h].hash)
             # In order to move sibling up the tree
             # an exact emptyHash check is required
             # not using EMPTY_HASH here to make sure we use correct hash from Empty class
@@ -295,8 +355,7 @@ class SparseMerkleTree(object):
                 if p.left_hash != EmptyNode.hash and p.right_hash != EmptyNode.hash:
                     break
 
-                await self._db.delete(p.hash)
-                self.stats["db_delete"] += 1
+                await self.delete_node(p.hash)
                 h -= 1
 
         # finally update all branch nodes in ancestor_nodes.
@@ -305,18 +364,81 @@ class SparseMerkleTree(object):
         while h > 0:
             p = ancestor_nodes[h - 1]
             h -= 1
+            await self.delete_node(p.hash)
 
             if is_bit_set(key, h):
-                p.right_hash = bottom_node.hash
+                p = BranchNode(p.left_hash, bottom_node.hash)
             else:
-                p.left_hash = bottom_node.hash
+                p = BranchNode(bottom_node.hash, p.right_hash)
 
             await self.set_node(p)
             bottom_node = p
 
         self.root = bottom_node
+        await self.write_to_db()
+        await self._collect_garbage()
         return bottom_node
 
+    async def remove_many(self, keys: list[bytes]) -> Coroutine[Any, Any, TreeNode]:
+        """
+        Remove keys in a single descent, missing keys are ignored.
+        Single leaves are pushed up bottom-up and each rewritten ancestor is written once.
+        """
+        for key in keys:
+            if len(key) != self.key_length:
+                raise InvalidKeyError
+
+        key_set = set(keys)
+        with HashCounter() as counter:
+            self.root = await self._remove(sorted(key_set), key_set, self.root, 0)
+            await self.write_to_db()
+            await self._collect_garbage()
+        self.stats["hashes"] += counter.hashes
+        return self.root
+
+    async def _remove(self, keys: list[bytes], key_set: set[bytes], current_node: TreeNode, height: int) -> Coroutine[Any, Any, TreeNode]:
+        if len(keys) == 0 or isinstance(current_node, EmptyNode):
+            return current_node
+
+        if isinstance(current_node, LeafNode):
+            if current_node.key in key_set:
+                await self.delete_node(current_node.hash)
+                return EmptyNode()
+            return current_node
+
+        # children without keys below are read only if they may have to be pushed up
+        idx = split_index(keys, lambda k: is_bit_set(k, height))
+        left_node = self._child(current_node.left_hash)
+        right_node = self._child(current_node.right_hash)
+        if idx > 0:
+            left_node = await self._remove(keys[:idx], key_set, await self.get_node(current_node.left_hash), height + 1)
+        if idx < len(keys):
+            right_node = await self._remove(keys[idx:], key_set, await self.get_node(current_node.right_hash), height + 1)
+
+        if left_node.hash == current_node.left_hash and right_node.hash == current_node.right_hash:
+            return current_node
+
+        await self.delete_node(current_node.hash)
+        if isinstance(left_node, EmptyNode) and isinstance(right_node, StubNode):
+            right_node = await self.get_node(right_node.hash)
+        elif isinstance(right_node, EmptyNode) and isinstance(left_node, StubNode):
+            left_node = await self.get_node(left_node.hash)
+
+        # a single leaf or no leaf below the branch: the branch is replaced by it
+        if isinstance(left_node, EmptyNode) and isinstance(right_node, (EmptyNode, LeafNode)):
+            return right_node
+        if isinstance(right_node, EmptyNode) and isinstance(left_node, LeafNode):
+            return left_node
+
+        current_node = BranchNode(left_node.hash, right_node.hash)
+        self.stats["branch_created"] += 1
+        await self.set_node(current_node)
+        return current_node
+
+    def _child(self, node_hash: bytes) -> TreeNode:
+        # child that is not read, known by its hash only
+        return EmptyNode() if node_hash == EMPTY_HASH else StubNode(node_hash)
+
 def create_test_case(n: int, key_length: int = 2) -> list[tuple[bytes, bytes]]:
     keys = sorted([hash(i.to_bytes(2))[:key_length] for i in range(n)])
     for i in range(len(keys)):
@@ -363,5 +485,4 @@ async def testing():
     print(f"verify proof: {check}")
     return _smt
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(testing())
\ No newline at end of file
@@ -1,9 +1,9 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from enum import Enum
 import dingus.tree.hasher as hasher
 from dingus.tree.errors import *
-from dingus.crypto import hash
 from dingus.tree.constants import (
     DEFAULT_KEY_LENGTH,
     EMPTY_VALUE,
@@ -14,13 +14,19 @@ from dingus.tree.constants import (
     DEFAULT_SUBTREE_MAX_HEIGHT,
     EMPTY_HASH_PLACEHOLDER_PREFIX,
 )
-from dingus.tree.utils import binary_expansion
+from dingus.tree.utils import binary_expansion, encode_varint, decode_varint
 
 
-@dataclass
+# Tree nodes are frozen: the hash is computed on first access and cached in _node_hash.
+# To change a node, create a new one. The structure and nodes lists of a SubTree must not be changed in place either.
+# Nodes and queries are slotted, a tree holds millions of them and the per-instance __dict__ dominates their size.
+
+
+@dataclass(slots=True, frozen=True)
 class LeafNode(object):
     key: bytes
     value: bytes
+    _node_hash: bytes | None = field(default=None, init=False, repr=False, compare=False)
 
     @classmethod
     def parse(cls, data: bytes, key_length: int = DEFAULT_KEY_LENGTH) -> tuple[bytes, bytes]:
@@ -30,7 +36,7 @@ class LeafNode(object):
 
     @classmethod
     def _hash(cls, data: bytes) -> bytes:
-        return hash(LEAF_PREFIX + data)
+        return hasher.counted_hash(LEAF_PREFIX + data)
 
     @classmethod
     def from_data(cls, data: bytes, key_length: int = DEFAULT_KEY_LENGTH) -> LeafNode:
@@ -44,13 +50,16 @@ class LeafNode(object):
 
     @property
     def hash(self) -> bytes:
-        return hash(self.data)
+        if self._node_hash is None:
+            object.__setattr__(self, "_node_hash", hasher.counted_hash(self.data))
+        return self._node_hash
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class BranchNode(object):
     left_hash: bytes
     right_hash: bytes
+    _node_hash: bytes | None = field(default=None, init=False, repr=False, compare=False)
 
     @classmethod
     def parse(cls, data: bytes) -> tuple[bytes, bytes]:
@@ -66,7 +75,7 @@ class BranchNode(object):
 
     @classmethod
     def _hash(cls, data: bytes) -> bytes:
-        return hash(BRANCH_PREFIX + data)
+        return hasher.counted_hash(BRANCH_PREFIX + data)
 
     @property
     def data(self) -> bytes:
@@ -74,10 +83,12 @@ class BranchNode(object):
 
     @property
     def hash(self) -> bytes:
-        return hash(self.data)
+        if self._node_hash is None:
+            object.__setattr__(self, "_node_hash", hasher.counted_hash(self.data))
+        return self._node_hash
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class StubNode(object):
     hash: bytes
 
@@ -96,9 +107,19 @@ class StubNode(object):
         return BRANCH_PREFIX + self.hash
 
 
-@dataclass
 class EmptyNode(object):
+    # Empty nodes carry no data, EmptyNode() always returns the same shared instance.
+    __slots__ = ()
     hash = EMPTY_HASH
+    _instance: EmptyNode | None = None
+
+    def __new__(cls) -> EmptyNode:
+        if cls._instance is None:
+            cls._instance = object.__new__(cls)
+        return cls._instance
+
+    def __repr__(self) -> str:
+        return "EmptyNode()"
 
     @classmethod
     def from_data(cls, data: bytes) -> StubNode:
@@ -110,11 +131,12 @@ class EmptyNode(object):
         return EMPTY_HASH_PLACEHOLDER_PREFIX
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class SubTree(object):
     structure: list[int]
     nodes: list[TreeNode]
     hasher: hasher.Hasher
+    _node_hash: bytes | None = field(default=None, init=False, repr=False, compare=False)
 
     @classmethod
     def structure_to_bins(cls, structure: list[int], subtree_height: int = DEFAULT_SUBTREE_MAX_HEIGHT) -> list[tuple[int, int]]:
@@ -133,32 +155,38 @@ class SubTree(object):
         cls,
         data: bytes,
         key_length: int = DEFAULT_KEY_LENGTH,
+        count_size: int = 1,
     ) -> tuple[list[int], list[TreeNode]]:
-        subtree_nodes = data[0] + 1
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        # the node count takes count_size bytes: 1 for subtrees up to height 8, as in LIP-0039
+        subtree_nodes = (data[0] if count_size == 1 else int.from_bytes(data[:count_size], "big")) + 1
         # assert 1 <= subtree_nodes <= (2<<subtree_height)
 
-        structure_data, nodes_data = (
-            data[1 : subtree_nodes + 1],
-            data[subtree_nodes + 1 :],
-        )
-
-        structure = [h for h in structure_data]
+        structure = list(data[count_size : count_size + subtree_nodes])
 
+        # walk the nodes data with an offset, only the key, value and hash fields are copied out
         nodes: list[TreeNode] = []
         leaf_data_length = len(LEAF_PREFIX) + key_length + NODE_HASH_SIZE
         subtree_branch_data_length = len(BRANCH_PREFIX) + NODE_HASH_SIZE
-
-        while len(nodes_data):
-            if nodes_data.startswith(LEAF_PREFIX):
-                node = LeafNode.from_data(nodes_data[:leaf_data_length], key_length)
-                nodes_data = nodes_data[leaf_data_length:]
-            elif nodes_data.startswith(BRANCH_PREFIX):
-                _hash = StubNode.parse(nodes_data[:subtree_branch_data_length])
-                node = StubNode(_hash)
-                nodes_data = nodes_data[subtree_branch_data_length:]
-            elif nodes_data.startswith(EMPTY_HASH_PLACEHOLDER_PREFIX):
+        offset = count_size + subtree_nodes
+        end = len(data)
+
+        while offset < end:
+            if data.startswith(LEAF_PREFIX, offset):
+                if offset + leaf_data_length > end:
+                    raise InvalidDataError
+                key_offset = offset + len(LEAF_PREFIX)
+                node = LeafNode(data[key_offset : key_offset + key_length], data[key_offset + key_length : offset + leaf_data_length])
+                offset += leaf_data_length
+            elif data.startswith(BRANCH_PREFIX, offset):
+                if offset + subtree_branch_data_length > end:
+                    raise InvalidDataError
+                node = StubNode(data[offset + len(BRANCH_PREFIX) : offset + subtree_branch_data_length])
+                offset += subtree_branch_data_length
+            elif data.startswith(EMPTY_HASH_PLACEHOLDER_PREFIX, offset):
                 node = EmptyNode()
-                nodes_data = nodes_data[len(EMPTY_HASH_PLACEHOLDER_PREFIX) :]
+                offset += len(EMPTY_HASH_PLACEHOLDER_PREFIX)
             else:
                 raise InvalidDataError
             nodes.append(node)
@@ -168,36 +196,73 @@ class SubTree(object):
 
     @property
     def data(self) -> bytes:
-        subtree_nodes = (len(self.structure) - 1).to_bytes(1, "big")
-        structure_data = b"".join([s.to_bytes(1, "big") for s in self.structure])
-        nodes_data = b"".join([node.data for node in self.nodes])
-        return subtree_nodes + structure_data + nodes_data
+        return self.encode()
+
+    def encode(self, count_size: int = 1) -> bytes:
+        return (len(self.structure) - 1).to_bytes(count_size, "big") + bytes(self.structure) + b"".join([node.data for node in self.nodes])
+
+    @property
+    def size(self) -> int:
+        # len(self.data) without encoding the nodes
+        return self.encoded_size()
+
+    def encoded_size(self, count_size: int = 1) -> int:
+        size = count_size + len(self.structure)
+        for node in self.nodes:
+            if isinstance(node, LeafNode):
+                size += len(LEAF_PREFIX) + len(node.key) + len(node.value)
+            elif isinstance(node, StubNode):
+                size += len(BRANCH_PREFIX) + len(node.hash)
+            else:
+                size += len(EMPTY_HASH_PLACEHOLDER_PREFIX)
+        return size
 
     @property
     def hash(self) -> bytes:
-        return self.hasher.hash(self.nodes, self.structure)
+        if self._node_hash is None:
+            object.__setattr__(self, "_node_hash", self.hasher.hash(self.nodes, self.structure))
+        return self._node_hash
 
 
 TreeNode = LeafNode | BranchNode | EmptyNode | StubNode
 
 
-@dataclass
+@dataclass(slots=True)
 class Query(object):
     key: bytes
     value: bytes
     bitmap: bytes
+    key_int: int = field(init=False, repr=False, compare=False)
+    key_bits: int = field(init=False, repr=False, compare=False)
+    bitmap_int: int = field(init=False, repr=False, compare=False)
+    height: int = field(init=False, repr=False, compare=False)
+    hash: bytes = field(init=False, repr=False, compare=False)
 
     def __post_init__(self) -> None:
-        self.binary_bitmap = binary_expansion(self.bitmap).lstrip("0")
+        # Bit paths are kept as integers. The most significant bit of the bitmap refers to the bottom of the path
+        # and is consumed first by move_up, so the height is tracked separately to keep the consumed leading zeros.
+        self.key_int = int.from_bytes(self.key, "big")
+        self.key_bits = 8 * len(self.key)
+        self.bitmap_int = int.from_bytes(self.bitmap, "big")
+        self.height = self.bitmap_int.bit_length()
         self.hash = EMPTY_HASH if self.value == EMPTY_VALUE else LeafNode(self.key, self.value).hash
-    
+
     def __str__(self) -> str:
         return f"Query(key={self.key.hex()}, value={self.value.hex()}, bitmap={self.bitmap.hex()})"
 
+    @property
+    def binary_bitmap(self) -> str:
+        return f"{self.bitmap_int:0{self.height}b}" if self.height > 0 else ""
+
+    @binary_bitmap.setter
+    def binary_bitmap(self, bstr: str) -> None:
+        self.height = len(bstr)
+        self.bitmap_int = int(bstr, 2) if bstr else 0
+
     @property
     def binary_path(self) -> str:
-        # Convert the key to binary
-        return binary_expansion(self.key)[:self.height]
+        # Convert the key prefix up to height to binary
+        return f"{self.key_int >> (self.key_bits - self.height):0{self.height}b}" if self.height > 0 else ""
 
     @property
     def binary_key(self) -> str:
@@ -205,21 +270,33 @@ class Query(object):
         return binary_expansion(self.key)
 
     @property
-    def height(self) -> int:
-        return len(self.binary_bitmap)
+    def path(self) -> tuple[int, int]:
+        # (height, key prefix up to height), the integer counterpart of binary_path
+        return (self.height, self.key_int >> (self.key_bits - self.height))
 
-    def is_sibling_of(self, q: Query) -> bool:
-        if len(self.binary_bitmap) != len(q.binary_bitmap):
-            return False
+    @property
+    def bitmap_bit(self) -> int:
+        # 1 if the sibling at the current height is not empty
+        return (self.bitmap_int >> (self.height - 1)) & 1
+
+    @property
+    def key_bit(self) -> int:
+        # 1 if the node at the current height is a right child
+        return (self.key_int >> (self.key_bits - self.height)) & 1
 
-        # end of string is exclusive
-        if self.binary_key[: self.height - 1] != q.binary_key[: q.height - 1]:
+    def move_up(self) -> None:
+        self.height -= 1
+        self.bitmap_int &= (1 << self.height) - 1
+
+    def is_sibling_of(self, q: Query) -> bool:
+        if self.height != q.height:
             return False
 
-        return self.binary_key[self.height - 1] != q.binary_key[self.height - 1]
+        # same prefix up to height - 1, different bit at height
+        return (self.key_int ^ q.key_int) >> (self.key_bits - self.height) == 1
 
 
-@dataclass
+@dataclass(slots=True)
 class QueryWithProof(Query):
     ancestor_hashes: list[bytes]
     sibling_hashes: list[bytes]
@@ -230,6 +307,104 @@ class Proof(object):
     sibling_hashes: list[bytes]
     queries: list[Query]
 
+    @classmethod
+    def from_dict(cls, proof: dict) -> Proof:
+        # hex encoded json form of the state_prove RPC
+        sibling_hashes = [bytes.fromhex(h) for h in proof["siblingHashes"]]
+        queries = [Query(bytes.fromhex(q["key"]), bytes.fromhex(q["value"]), bytes.fromhex(q["bitmap"])) for q in proof["queries"]]
+        return Proof(sibling_hashes, queries)
+
+    def to_dict(self) -> dict:
+        return {
+            "siblingHashes": [h.hex() for h in self.sibling_hashes],
+            "queries": [{"key": q.key.hex(), "value": q.value.hex(), "bitmap": q.bitmap.hex()} for q in self.queries],
+        }
+
+    @classmethod
+    def from_data(cls, data: bytes) -> Proof:
+        # decode in a single pass over data, the fields are sliced straight out of it
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        try:
+            n_queries, offset = decode_varint(data, 0)
+            key_length, offset = decode_varint(data, offset)
+            fields = []
+            for _ in range(n_queries):
+                key = data[offset : offset + key_length]
+                value_length, offset = decode_varint(data, offset + key_length)
+                value = data[offset : offset + value_length]
+                if len(key) != key_length or len(value) != value_length:
+                    raise InvalidDataError
+                bitmap_length, offset = decode_varint(data, offset + value_length)
+                height, offset = decode_varint(data, offset)
+                if height > 8 * bitmap_length:
+                    raise InvalidDataError
+                fields.append((key, value, bitmap_length, height))
+
+            # bitmaps are packed one after the other, without padding
+            queries = []
+            bit_offset = 8 * offset
+            for key, value, bitmap_length, height in fields:
+                start = bit_offset >> 3
+                end = (bit_offset + height + 7) >> 3
+                bitmap_int = (int.from_bytes(data[start:end], "big") >> (8 * end - bit_offset - height)) & ((1 << height) - 1)
+                if bitmap_int.bit_length() != height:
+                    raise InvalidDataError
+                queries.append(Query(key, value, bitmap_int.to_bytes(bitmap_length, "big")))
+                bit_offset += height
+            offset = (bit_offset + 7) >> 3
+            if offset > len(data):
+                raise InvalidDataError
+
+            n_siblings, offset = decode_varint(data, offset)
+            n_unique, offset = decode_varint(data, offset)
+            unique_hashes = [data[offset + NODE_HASH_SIZE * i : offset + NODE_HASH_SIZE * (i + 1)] for i in range(n_unique)]
+            offset += NODE_HASH_SIZE * n_unique
+            if offset > len(data):
+                raise InvalidDataError
+            if n_unique == n_siblings:
+                sibling_hashes = unique_hashes
+            else:
+                # repeated sibling hashes are written once and referenced by index
+                sibling_hashes = []
+                for _ in range(n_siblings):
+                    i, offset = decode_varint(data, offset)
+                    sibling_hashes.append(unique_hashes[i])
+        except IndexError:
+            raise InvalidDataError
+        if offset != len(data):
+            raise InvalidDataError
+        return Proof(sibling_hashes, queries)
+
+    @property
+    def data(self) -> bytes:
+        """
+        Compact binary encoding: varint counts and lengths, query keys of a common length, bitmaps packed as a
+        single bit string after the queries and sibling hashes written once, repeated ones referenced by varint index.
+        Each query gives the byte length and the height of its bitmap, so decoding gives back the same bitmap bytes.
+        """
+        key_length = len(self.queries[0].key) if len(self.queries) > 0 else 0
+        parts = [encode_varint(len(self.queries)), encode_varint(key_length)]
+        for q in self.queries:
+            if len(q.key) != key_length:
+                raise InvalidKeyError
+            # the bitmap length is given apart from its height, so bitmaps with leading zero bytes are kept as they are
+            parts += [q.key, encode_varint(len(q.value)), q.value, encode_varint(len(q.bitmap)), encode_varint(q.height)]
+
+        bits = "".join(f"{q.bitmap_int:0{q.height}b}" for q in self.queries if q.height > 0)
+        if len(bits) > 0:
+            bits += "0" * (-len(bits) % 8)
+            parts.append(int(bits, 2).to_bytes(len(bits) // 8, "big"))
+
+        indices: dict[bytes, int] = {}
+        for h in self.sibling_hashes:
+            indices.setdefault(h, len(indices))
+        parts += [encode_varint(len(self.sibling_hashes)), encode_varint(len(indices))]
+        parts += list(indices)
+        if len(indices) < len(self.sibling_hashes):
+            parts += [encode_varint(indices[h]) for h in self.sibling_hashes]
+        return b"".join(parts)
+
     def __str__(self) -> str:
         keys = '\n      '.join([''] + [q.key.hex() for q in self.queries] + [''])
         sibling_hashes = '\n      '.join([''] + [h.hex() for h in self.sibling_hashes] + [''])
@@ -239,3 +414,24 @@ Proof:
     sibling_hashes:{sibling_hashes}
 """
 
+
+class VerifyFailure(str, Enum):
+    QUERY_COUNT = "query_count"  # number of queries and query keys differ
+    KEY_LENGTH = "key_length"  # query key of the wrong length
+    BITMAP_LEADING_ZEROS = "bitmap_leading_zeros"  # bitmap with extra leading zero bytes
+    KEY_NOT_COVERED = "key_not_covered"  # query is neither an inclusion nor a non-inclusion proof for its key
+    DUPLICATE_MISMATCH = "duplicate_mismatch"  # queries for the same key differ
+    MISSING_SIBLING_HASHES = "missing_sibling_hashes"  # fewer sibling hashes than the bitmaps require
+    MALFORMED_PROOF = "malformed_proof"  # bitmaps and sibling hashes are not consistent with the queries
+    ROOT_MISMATCH = "root_mismatch"  # the proof leads to another root
+
+
+@dataclass(slots=True)
+class VerifyResult(object):
+    index: int  # position of the proof in the batch
+    failure: VerifyFailure | None = None
+    query_index: int | None = None  # query at fault, if any
+
+    @property
+    def valid(self) -> bool:
+        return self.failure is None
@@ -1,31 +1,41 @@
-from typing import Any, Callable
-import math
+from typing import Any, Callable, Iterable
 from dingus.tree.constants import EMPTY_HASH, LEAF_PREFIX, BRANCH_PREFIX
 from dingus.crypto import hash
 
 
-def merkle_root(data: list[bytes]) -> bytes:
+def merkle_root(data: Iterable[bytes]) -> bytes:
     """Returns the Merkle root from a list of bytes as specified in https://github.com/LiskHQ/lips/blob/main/proposals/lip-0031.md#merkle-root
 
+    The values are hashed bottom-up in a single pass, as they are appended to the tree: only the roots of the
+    complete subtrees are kept, one for each level. data can be any iterable, such as a generator of values.
+
     Args:
-        data (list[bytes]): input list
+        data (Iterable[bytes]): input values
 
     Returns:
         bytes: Merkle root
     """
 
-    size = len(data)
-    if size == 0:
-        return EMPTY_HASH
-    if size == 1:
-        return hash(LEAF_PREFIX + data[0])
-    
-    # Largest power of two smaller than size
-    k = 2 ** (math.floor(math.log2(size - 1)))
-    # Split the data array into 2 subtrees. leftTree from index 0 to index k (not included), rightTree for the rest
-    leftTree = data[:k]
-    rightTree = data[k:]
-    return merkle_root(BRANCH_PREFIX + merkle_root(leftTree) + merkle_root(rightTree))
+    # roots of the complete subtrees indexed by level, a level is None if the number of values has its bit unset
+    levels: list[bytes | None] = []
+    for value in data:
+        h = hash(LEAF_PREFIX + value)
+        level = 0
+        while level < len(levels) and levels[level] is not None:
+            h = hash(BRANCH_PREFIX + levels[level] + h)
+            levels[level] = None
+            level += 1
+        if level == len(levels):
+            levels.append(h)
+        else:
+            levels[level] = h
+
+    # the root of the smallest subtree is the rightmost node, it is hashed with the larger subtrees on its left
+    root = None
+    for h in levels:
+        if h is not None:
+            root = h if root is None else hash(BRANCH_PREFIX + h + root)
+    return EMPTY_HASH if root is None else root
 
 
 def split_index(keys: list[bytes], condition: Callable) -> int:
@@ -55,6 +65,29 @@ def key_to_bin(key: bytes, idx: int) -> int:
 def binary_to_bytes(bstr: str) -> bytes:
     return int(bstr, 2).to_bytes((len(bstr) + 7) // 8, "big")
 
+def encode_varint(n: int) -> bytes:
+    # unsigned LEB128
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_varint(data: bytes, offset: int) -> tuple[int, int]:
+    # return the value and the offset after it
+    n = 0
+    shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (n, offset)
+        shift += 7
+
+
 def binary_expansion(key: bytes):
     return f"{int.from_bytes(key, 'big'):0{8*len(key)}b}"
 
@@ -0,0 +1,127 @@
+import asyncio
+import os
+from dingus.db import SqliteDB
+from dingus.tree.skip_merkle_tree import SkipMerkleTree
+from dingus.tree.sparse_merkle_tree import SparseMerkleTree
+
+
+def test_batched_write(tmp_path):
+    asyncio.run(batched_write(str(tmp_path / "test.sqlite")))
+
+
+async def batched_write(filename):
+    db = SqliteDB(filename, cache_size=2)
+    await db.set(b"a", b"1")
+    await db.set(b"b", b"2")
+    # pending writes are visible before write
+    assert await db.get(b"a") == b"1"
+    await db.delete(b"b")
+    assert await db.get(b"b") == b""
+    await db.write()
+    assert db.batch == {}
+    assert db.stats["batch_writes"] == 1
+    db.close()
+
+    db = SqliteDB(filename, cache_size=2)
+    assert await db.get(b"a") == b"1"
+    assert await db.get(b"a") == b"1"
+    assert db.stats["cache_hits"] == 1
+    assert await db.get(b"b") == b""
+    await db.set(b"c", b"3")
+    await db.set(b"d", b"4")
+    await db.write()
+    assert await db.get(b"c") == b"3"
+    assert await db.get(b"d") == b"4"
+    # least recently used key is evicted
+    assert list(db.cache.keys()) == [b"c", b"d"]
+    db.close()
+
+
+def test_write_in_flight(tmp_path):
+    asyncio.run(write_in_flight(str(tmp_path / "test.sqlite")))
+
+
+async def write_in_flight(filename):
+    db = SqliteDB(filename)
+    await db.set(b"a", b"1")
+    await db.set(b"b", b"2")
+    await db.write()
+    await db.set(b"a", b"3")
+    await db.delete(b"b")
+    # the commit runs on the worker thread, the batch is readable until it is committed
+    write = asyncio.create_task(db.write())
+    await asyncio.sleep(0)
+    assert db.batch == {}
+    assert await db.get(b"a") == b"3"
+    assert await db.get(b"b") == b""
+    await db.set(b"c", b"4")
+    page, _ = await db.keys_page(None, 10)
+    assert page == [b"a", b"c"]
+    await write
+    assert await db.get(b"a") == b"3"
+    assert db.stats["batch_writes"] == 2
+    db.close()
+
+
+def test_keys_page(tmp_path):
+    asyncio.run(keys_page(str(tmp_path / "test.sqlite")))
+
+
+async def keys_page(filename):
+    db = SqliteDB(filename)
+    for i in range(0, 20, 2):
+        await db.set(bytes([i]), b"1")
+    await db.write()
+    # pending writes are applied to the pages
+    await db.set(bytes([5]), b"1")
+    await db.delete(bytes([6]))
+    expected = sorted(set(bytes([i]) for i in range(0, 20, 2)) - {bytes([6])} | {bytes([5])})
+
+    keys = []
+    after = None
+    while True:
+        page, after = await db.keys_page(after, 3)
+        keys += page
+        if after is None:
+            break
+    assert keys == expected
+    db.close()
+
+
+def test_tree_reload(tmp_path):
+    asyncio.run(tree_reload(str(tmp_path / "skmt.sqlite"), str(tmp_path / "smt.sqlite")))
+
+
+async def tree_reload(skmt_filename, smt_filename):
+    keys = [os.urandom(32) for _ in range(500)]
+    values = [os.urandom(32) for _ in range(500)]
+
+    _skmt = SkipMerkleTree()
+    _skmt._db = SqliteDB(skmt_filename)
+    root = await _skmt.update(keys, values)
+    proof = await _skmt.generate_proof(keys[:10])
+    _skmt._db.close()
+
+    _skmt = SkipMerkleTree()
+    _skmt._db = SqliteDB(skmt_filename)
+    await _skmt.load(root.hash)
+    assert _skmt.root.hash == root.hash
+    reloaded_proof = await _skmt.generate_proof(keys[:10])
+    assert reloaded_proof.sibling_hashes == proof.sibling_hashes
+    new_root = await _skmt.update(keys[:100], [b""] * 100)
+    _skmt._db.close()
+
+    _skmt = SkipMerkleTree()
+    _skmt._db = SqliteDB(skmt_filename)
+    await _skmt.load(new_root.hash)
+    assert (await _skmt.update(keys[:100], values[:100])).hash == root.hash
+
+    _smt = SparseMerkleTree()
+    _smt._db = SqliteDB(smt_filename)
+    root = await _smt.update(keys, values)
+    _smt._db.close()
+
+    _smt = SparseMerkleTree()
+    _smt._db = SqliteDB(smt_filename)
+    await _smt.load(root.hash)
+    assert (await _smt.update(keys[:10], values[:10])).hash == root.hash
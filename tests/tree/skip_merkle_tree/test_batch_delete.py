@@ -0,0 +1,56 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree, verify
+from dingus.tree.sparse_merkle_tree import SparseMerkleTree
+import asyncio
+import random
+
+
+def test_batch_delete():
+    asyncio.run(batch_delete())
+
+
+async def batch_delete():
+    # blocks of inserts, updates, deletions and deletions of missing keys, checked against a tree built from the live keys
+    rnd = random.Random(0)
+    for subtree_height in [3, 4, 8]:
+        _smt = SkipMerkleTree(32, subtree_height)
+        live: dict[bytes, bytes] = {}
+        for _ in range(12):
+            block = {rnd.randbytes(32): rnd.randbytes(32) for _ in range(150)}
+            for k in rnd.sample(sorted(live), min(len(live), 100)):
+                block[k] = rnd.choice([b"", rnd.randbytes(32)])
+            for _ in range(20):
+                block[rnd.randbytes(32)] = b""
+            root = await _smt.update(list(block), list(block.values()))
+            for k, v in block.items():
+                if v:
+                    live[k] = v
+                else:
+                    live.pop(k, None)
+
+            _sparse = SparseMerkleTree(32)
+            await _sparse.update(list(live), list(live.values()))
+            assert root.hash == _sparse.root.hash
+
+        removed = rnd.sample(sorted(live), len(live) // 2)
+        root = await _smt.delete(removed + [rnd.randbytes(32) for _ in range(10)])
+        proof = await _smt.generate_proof(removed[:20])
+        assert verify(removed[:20], proof, root.hash)
+        assert all(q.value == b"" or q.key not in removed for q in proof.queries)
+        root = await _smt.delete([k for k in live if k not in removed])
+        assert root.hash == SkipMerkleTree().root.hash
+
+
+def test_insert_without_push_up():
+    asyncio.run(insert_without_push_up())
+
+
+async def insert_without_push_up():
+    keys = [random.randbytes(32) for _ in range(3000)]
+    _smt = SkipMerkleTree()
+    await _smt.update(keys[:2000], keys[:2000])
+    await _smt.update(keys[2000:], keys[2000:])
+    await _smt.update(keys[:100], [random.randbytes(32) for _ in range(100)])
+    assert _smt.stats["push_up_passes"] == 0
+    # only the subtrees that lost a leaf, and the ones above them, are pushed up
+    await _smt.delete(keys[:1])
+    assert _smt.stats["push_up_passes"] <= 2
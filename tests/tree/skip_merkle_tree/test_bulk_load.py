@@ -0,0 +1,28 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree
+from dingus.tree.errors import InvalidKeyError
+import asyncio
+import os
+import pytest
+
+
+def test_bulk_load():
+    asyncio.run(bulk_load())
+
+
+async def bulk_load():
+    for key_length, subtree_height, n in [(32, 8, 1), (32, 8, 2), (2, 8, 300), (3, 4, 2000), (32, 8, 5000), (32, 4, 3000)]:
+        # update does not support keys differing in the last bit only, it is cleared
+        keys = sorted(set((int.from_bytes(os.urandom(key_length), "big") & ~1).to_bytes(key_length, "big") for _ in range(n)))
+        values = [os.urandom(32) for _ in keys]
+        _smt = SkipMerkleTree(key_length, subtree_height)
+        _bulk = SkipMerkleTree(key_length, subtree_height)
+        root = await _smt.update(keys, values)
+        # pairs are streamed, empty values are skipped
+        bulk_root = await _bulk.bulk_load((k, v) for k, v in zip(keys + [b"\xff" * key_length], values + [b""]))
+        assert bulk_root.hash == root.hash
+        assert _bulk._db.kv == _smt._db.kv
+        assert _bulk.versions == _smt.versions
+
+    _bulk = SkipMerkleTree(32)
+    with pytest.raises(InvalidKeyError):
+        await _bulk.bulk_load([(b"\x01" * 32, b"1"), (b"\x00" * 32, b"1")])
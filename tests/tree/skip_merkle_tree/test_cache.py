@@ -0,0 +1,51 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree
+import asyncio
+import os
+
+
+def test_subtree_cache():
+    asyncio.run(subtree_cache())
+
+
+async def subtree_cache():
+    keys = [os.urandom(32) for _ in range(2000)]
+    values = [os.urandom(32) for _ in range(2000)]
+
+    _smt = SkipMerkleTree(cache_size=1024)
+    _uncached = SkipMerkleTree(cache_size=0)
+    assert (await _smt.update(keys, values)).hash == (await _uncached.update(keys, values)).hash
+    assert len(_smt._cache) <= 1024
+    # dirty subtrees are flushed by update
+    assert _smt._dirty == {}
+    assert await _smt._db.get(_smt.root.hash) == _smt.root.data
+
+    for i in range(5):
+        block_keys = keys[100 * i : 100 * (i + 1)]
+        block_values = [os.urandom(32) for _ in block_keys]
+        root = await _smt.update(block_keys, block_values)
+        uncached_root = await _uncached.update(block_keys, block_values)
+        assert root.hash == uncached_root.hash
+
+    assert _smt.stats["cache_hits"] > 0
+    assert _smt.stats["db_get"] < _uncached.stats["db_get"]
+    proof = await _smt.generate_proof(keys[:10])
+    uncached_proof = await _uncached.generate_proof(keys[:10])
+    assert proof.sibling_hashes == uncached_proof.sibling_hashes
+
+
+def test_write_back():
+    asyncio.run(write_back())
+
+
+async def write_back():
+    keys = [os.urandom(32) for _ in range(300)]
+    values = [os.urandom(32) for _ in range(300)]
+
+    _smt = SkipMerkleTree()
+    new_root = await _smt._update_subtree(keys, values, _smt.root, 0)
+    # nothing reaches the db before write_to_db
+    assert _smt._db.kv == {}
+    assert _smt._dirty[new_root.hash] == new_root.data
+    await _smt.write_to_db()
+    assert _smt._dirty == {}
+    assert await _smt._db.get(new_root.hash) == new_root.data
@@ -0,0 +1,27 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree
+from dingus.tree.constants import PARALLEL_UPDATE_MIN_KEYS
+import asyncio
+import os
+import random
+
+
+def test_parallel_update():
+    asyncio.run(parallel_update())
+
+
+async def parallel_update():
+    N = 2 * PARALLEL_UPDATE_MIN_KEYS
+    keys = [os.urandom(32) for _ in range(N)]
+    values = [os.urandom(32) for _ in range(N)]
+
+    _smt = SkipMerkleTree()
+    _parallel_smt = SkipMerkleTree(workers=2)
+    assert (await _parallel_smt.update(keys, values)).hash == (await _smt.update(keys, values)).hash
+
+    # update, insert and delete below existing subtrees
+    update_keys = random.sample(keys, N // 2) + [os.urandom(32) for _ in range(N // 4)]
+    update_values = [b"" if random.random() < 0.3 else os.urandom(32) for _ in update_keys]
+    new_root = await _smt.update(update_keys, update_values)
+    assert (await _parallel_smt.update(update_keys, update_values)).hash == new_root.hash
+    assert _parallel_smt._db.kv.keys() == _smt._db.kv.keys()
+    assert _parallel_smt._bin_updates == {}
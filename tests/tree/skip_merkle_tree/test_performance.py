@@ -1,11 +1,15 @@
 from typing import Coroutine
 from dingus.tree.skip_merkle_tree import SkipMerkleTree
+from dingus.tree import sbit_merkle_tree
+from dingus.db import SqliteDB
 from dingus.tree.constants import EMPTY_HASH
 import time
 import asyncio
+import random
 from tests.tree.utils import create_test_case
 
 KEY_LENGTH = 32
+WORKERS = 4
 
 
 def test_large_update(capsys) -> None:
@@ -22,10 +26,75 @@ def test_large_update(capsys) -> None:
     )
 
 
-async def case_testing_batch(
+def test_large_update_sqlitedb(capsys, tmp_path) -> None:
+    start_time = time.time()
+    initial_keys, initial_values = create_test_case(1000000)
+    extra_keys, extra_values = create_test_case(10000)
+
+    with capsys.disabled():
+        print(f"\ncreate test cases: {time.time() - start_time:.2f}s")
+    _smt = asyncio.run(
+        case_testing_batch(
+            initial_keys, initial_values, extra_keys, extra_values, capsys, SqliteDB(str(tmp_path / "skmt.sqlite"))
+        )
+    )
+    with capsys.disabled():
+        print(_smt._db.stats)
+
+
+def test_bulk_load(capsys) -> None:
+    for n in [1000000, 10000000]:
+        _smt = SkipMerkleTree(KEY_LENGTH)
+        start_time = time.time()
+        asyncio.run(_smt.bulk_load(sorted_pairs(n)))
+        with capsys.disabled():
+            print(f"\nbulk load tree with {n} leaves: {time.time() - start_time:.2f}s")
+
+
+def sorted_pairs(n: int):
+    # evenly spread sorted keys, generated on the fly
+    step = (1 << (8 * KEY_LENGTH)) // n
+    for i in range(n):
+        key = (i * step + random.getrandbits(64)).to_bytes(KEY_LENGTH, "big")
+        yield (key, key)
+
+
+def test_large_update_parallel(capsys) -> None:
+    initial_keys, initial_values = create_test_case(200000)
+    extra_keys, extra_values = create_test_case(100000)
+    asyncio.run(
+        case_testing_parallel(
+            initial_keys, initial_values, extra_keys, extra_values, capsys
+        )
+    )
+
+
+async def case_testing_parallel(
     initial_keys, initial_values, extra_keys, extra_values, capsys
+) -> None:
+    _smt = SkipMerkleTree(KEY_LENGTH)
+    _parallel_smt = SkipMerkleTree(KEY_LENGTH, workers=WORKERS)
+    for keys, values in [(initial_keys, initial_values), (extra_keys, extra_values)]:
+        start_time = time.time()
+        new_root = await _smt.update(keys, values)
+        sequential_time = time.time() - start_time
+
+        start_time = time.time()
+        parallel_root = await _parallel_smt.update(keys, values)
+        parallel_time = time.time() - start_time
+        assert parallel_root.hash == new_root.hash
+        with capsys.disabled():
+            print(
+                f"\nupdate with {len(keys)} leaves: sequential {sequential_time:.2f}s, {WORKERS} workers {parallel_time:.2f}s"
+            )
+
+
+async def case_testing_batch(
+    initial_keys, initial_values, extra_keys, extra_values, capsys, db=None
 ) -> Coroutine[None, None, SkipMerkleTree]:
     _smt = SkipMerkleTree(KEY_LENGTH)
+    if db is not None:
+        _smt._db = db
     assert _smt.root.hash == EMPTY_HASH
     start_time = time.time()
     new_root = await _smt.update(initial_keys, initial_values)
@@ -44,3 +113,94 @@ async def case_testing_batch(
         )
 
     return _smt
+
+
+def test_subtree_height_matrix(capsys) -> None:
+    # state store layout: key length 38, batches of updates to existing and new keys on a loaded tree
+    key_length = 38
+    n = 100000
+    batch_size = 1000
+    batches = 10
+    keys = [random.randbytes(key_length) for _ in range(n + batches * batch_size)]
+    values = [random.randbytes(32) for _ in keys]
+
+    with capsys.disabled():
+        print("\nheight | load (s) | update (ms) | db reads/update | db writes/update | stored (MiB) | stored/leaf (B)")
+    for subtree_height in [2, 4, 6, 8, 12, 16]:
+        _smt = SkipMerkleTree(key_length, subtree_height)
+        start_time = time.time()
+        asyncio.run(_smt.update(keys[:n], values[:n]))
+        load_time = time.time() - start_time
+
+        db_get, db_set = _smt.stats["db_get"], _smt.stats["db_set"]
+        start_time = time.time()
+        for i in range(batches):
+            new_keys = keys[n + i * batch_size : n + (i + 1) * batch_size]
+            batch_keys = random.sample(keys[:n], batch_size // 2) + new_keys[: batch_size // 2]
+            asyncio.run(_smt.update(batch_keys, [random.randbytes(32) for _ in batch_keys]))
+        update_time = (time.time() - start_time) / batches
+
+        leaves = n + batches * batch_size // 2
+        with capsys.disabled():
+            print(
+                f"{subtree_height:>6} | {load_time:>8.2f} | {1000 * update_time:>11.1f} | "
+                f"{(_smt.stats['db_get'] - db_get) / batches:>15.0f} | {(_smt.stats['db_set'] - db_set) / batches:>16.0f} | "
+                f"{_smt.stats['db_bytes'] / 2**20:>12.1f} | {_smt.stats['db_bytes'] / leaves:>15.0f}"
+            )
+
+
+def test_mixed_block_workloads(capsys) -> None:
+    # blocks of 1000 keys on a tree with 100k leaves, inserts of new keys and deletions of existing ones in one update
+    n = 100000
+    keys = [random.randbytes(KEY_LENGTH) for _ in range(n)]
+    _smt = SkipMerkleTree(KEY_LENGTH)
+    asyncio.run(_smt.update(keys, [random.randbytes(32) for _ in keys]))
+
+    for name, inserts, deletes in [("insert only", 1000, 0), ("90% insert", 900, 100), ("50% insert", 500, 500), ("delete only", 0, 1000)]:
+        elapsed = 0.0
+        push_up_passes = _smt.stats["push_up_passes"]
+        for _ in range(5):
+            random.shuffle(keys)
+            new_keys = [random.randbytes(KEY_LENGTH) for _ in range(inserts)]
+            deleted_keys, keys = keys[:deletes], keys[deletes:]
+            # a single batch mixing inserts and deletions, as in a block
+            block_keys = new_keys + deleted_keys
+            block_values = [random.randbytes(32) for _ in new_keys] + [b""] * len(deleted_keys)
+            start_time = time.time()
+            asyncio.run(_smt.update(block_keys, block_values))
+            elapsed += time.time() - start_time
+            keys += new_keys
+        with capsys.disabled():
+            print(f"\n{name}: {1000 * elapsed / 5:.1f}ms per block, {(_smt.stats['push_up_passes'] - push_up_passes) / 5:.0f} push-up passes per block")
+
+
+def test_proof_layouts(capsys):
+    asyncio.run(proof_layouts(capsys))
+
+
+async def proof_layouts(capsys):
+    # the same tree gives proofs in both layouts, compare their size and verify time
+    n = 20000
+    rnd = random.Random(0)
+    keys = [rnd.randbytes(32) for _ in range(n)]
+    _smt = SkipMerkleTree()
+    await _smt.update(keys, keys)
+    layouts = [("query bitmaps", _smt.proof_layout), ("shared bitmap", sbit_merkle_tree.SharedBitmap())]
+
+    with capsys.disabled():
+        print(f"\n{n} leaves, half of the query keys absent")
+        print("queries |        layout | proof (B) | bitmaps (B) | verify (ms)")
+        for n_queries in [1, 16, 256]:
+            query_keys = rnd.sample(keys, n_queries // 2 + n_queries % 2) + [rnd.randbytes(32) for _ in range(n_queries // 2)]
+            for name, layout in layouts:
+                _smt.proof_layout = layout
+                proofs = [await _smt.generate_proof(query_keys) for _ in range(10)]
+                start_time = time.time()
+                for proof in proofs:
+                    assert layout.verify(query_keys, proof, _smt.root.hash)
+                elapsed = (time.time() - start_time) / len(proofs)
+                if hasattr(proof, "bitmap"):
+                    bitmap_size = len(proof.bitmap)
+                else:
+                    bitmap_size = (sum(q.height for q in proof.queries) + 7) // 8
+                print(f"{n_queries:7} | {name:>13} | {len(proof.data):9} | {bitmap_size:11} | {1000 * elapsed:11.3f}")
@@ -0,0 +1,74 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree, verify
+from dingus.tree.types import Proof, Query
+from dingus.tree.errors import InvalidDataError
+import asyncio
+import json
+import os
+import pytest
+import time
+
+
+async def create_proofs(query_sizes: list[int]) -> tuple[bytes, list[tuple[list[bytes], Proof]]]:
+    keys = [os.urandom(32) for _ in range(20000)]
+    _smt = SkipMerkleTree()
+    root = await _smt.update(keys, [os.urandom(32) for _ in keys])
+    proofs = []
+    for n in query_sizes:
+        # inclusion and non-inclusion queries
+        query_keys = keys[:n] + [os.urandom(32) for _ in range(n // 10 + 1)]
+        proofs.append((query_keys, await _smt.generate_proof(query_keys)))
+    return (root.hash, proofs)
+
+
+def test_proof_encoding():
+    root, proofs = asyncio.run(create_proofs([1, 10, 200]))
+    for query_keys, proof in proofs:
+        decoded = Proof.from_data(proof.data)
+        assert decoded == proof
+        assert Proof.from_dict(json.loads(json.dumps(proof.to_dict()))) == proof
+        assert verify(query_keys, Proof.from_data(memoryview(proof.data)), root)
+
+    # repeated sibling hashes are written once
+    proof = Proof([b"\x01" * 32, b"\x02" * 32, b"\x01" * 32], [Query(b"\x00" * 32, b"", b"\x05")])
+    assert Proof.from_data(proof.data) == proof
+    assert len(proof.data) < len(Proof([b"\x01" * 32, b"\x02" * 32, b"\x03" * 32], proof.queries).data)
+    assert Proof.from_data(Proof([], []).data) == Proof([], [])
+
+    # bitmaps with leading zero bytes are decoded as they are, for the verifier to reject them
+    for bitmap in [b"\x00", b"\x00\x05", b"\x00\x00\x80"]:
+        proof = Proof([b"\x01" * 32], [Query(b"\x00" * 32, b"", bitmap)])
+        assert Proof.from_data(proof.data).queries[0].bitmap == bitmap
+        assert Proof.from_data(proof.data) == proof
+
+    data = proofs[1][1].data
+    for bad_data in [data[:-1], data + b"\x00", data[:40]]:
+        with pytest.raises(InvalidDataError):
+            Proof.from_data(bad_data)
+
+
+def test_proof_encoding_benchmark(capsys):
+    _, proofs = asyncio.run(create_proofs([1, 100, 1000]))
+    with capsys.disabled():
+        print()
+        for query_keys, proof in proofs:
+            start_time = time.time()
+            for _ in range(10):
+                json_data = json.dumps(proof.to_dict())
+            json_encode = (time.time() - start_time) / 10
+            start_time = time.time()
+            for _ in range(10):
+                Proof.from_dict(json.loads(json_data))
+            json_decode = (time.time() - start_time) / 10
+
+            start_time = time.time()
+            for _ in range(10):
+                data = proof.data
+            encode = (time.time() - start_time) / 10
+            start_time = time.time()
+            for _ in range(10):
+                Proof.from_data(data)
+            decode = (time.time() - start_time) / 10
+            print(
+                f"proof for {len(query_keys)} keys: json {len(json_data)}B, encode {1e3 * json_encode:.2f}ms, decode {1e3 * json_decode:.2f}ms;"
+                f" binary {len(data)}B, encode {1e3 * encode:.2f}ms, decode {1e3 * decode:.2f}ms"
+            )
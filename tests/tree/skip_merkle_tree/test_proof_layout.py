@@ -0,0 +1,57 @@
+from dingus.tree import sbit_merkle_tree
+from dingus.tree.skip_merkle_tree import ProofLayout, SkipMerkleTree
+import asyncio
+import pytest
+import random
+
+
+def test_shared_bitmap():
+    asyncio.run(shared_bitmap())
+
+
+async def shared_bitmap():
+    rnd = random.Random(0)
+    keys = [rnd.randbytes(32) for _ in range(2000)]
+    _smt = SkipMerkleTree()
+    _sbit = sbit_merkle_tree.SkipMerkleTree()
+    assert isinstance(_sbit.proof_layout, sbit_merkle_tree.SharedBitmap)
+    await _smt.update(keys, keys)
+    await _sbit.update(keys, keys)
+    assert _smt.root.hash == _sbit.root.hash
+
+    for n_queries in [1, 2, 10, 100]:
+        # present, absent and repeated keys
+        query_keys = rnd.sample(keys, n_queries) + [rnd.randbytes(32) for _ in range(n_queries)]
+        query_keys += query_keys[:2]
+        proof = await _sbit.generate_proof(query_keys)
+        assert [q.key for q in proof.queries] == [q.key for q in (await _smt.generate_proof(query_keys)).queries]
+        assert sbit_merkle_tree.verify(query_keys, proof, _sbit.root.hash)
+        assert _sbit.proof_layout.verify(query_keys, sbit_merkle_tree.Proof.from_data(proof.data), _sbit.root.hash)
+        assert not sbit_merkle_tree.verify(query_keys, proof, _smt.root.hash[::-1])
+
+        # any changed bit, missing or extra sibling hash fails
+        for i in range(len(proof.bitmap)):
+            for bit in range(8):
+                bitmap = bytearray(proof.bitmap)
+                bitmap[i] ^= 1 << bit
+                tampered = sbit_merkle_tree.Proof(proof.sibling_hashes, bytes(bitmap), proof.queries)
+                assert not sbit_merkle_tree.verify(query_keys, tampered, _sbit.root.hash)
+        tampered = sbit_merkle_tree.Proof(proof.sibling_hashes[1:], proof.bitmap, proof.queries)
+        assert not sbit_merkle_tree.verify(query_keys, tampered, _sbit.root.hash)
+        tampered = sbit_merkle_tree.Proof(proof.sibling_hashes + keys[:1], proof.bitmap, proof.queries)
+        assert not sbit_merkle_tree.verify(query_keys, tampered, _sbit.root.hash)
+        # a query for another key does not cover the query key
+        other_keys = [rnd.randbytes(32)] + query_keys[1:]
+        assert not sbit_merkle_tree.verify(other_keys, proof, _sbit.root.hash)
+
+
+def test_abstract_layout():
+    class MergeOnly(ProofLayout):
+        def merge(self, query_proofs):
+            return query_proofs
+
+    # a layout must give both merge and verify
+    with pytest.raises(TypeError):
+        ProofLayout()
+    with pytest.raises(TypeError):
+        MergeOnly()
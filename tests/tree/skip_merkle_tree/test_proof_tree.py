@@ -0,0 +1,97 @@
+from dingus.tree.errors import MissingNodeError
+import dingus.tree.skip_merkle_tree as skmt
+import asyncio
+import pytest
+import random
+
+
+def test_update_proof():
+    asyncio.run(update_proof())
+
+
+async def update_proof():
+    rnd = random.Random(1)
+    keys = [rnd.randbytes(32) for _ in range(1000)]
+    _skmt = skmt.SkipMerkleTree()
+    await _skmt.update(keys[:800], [rnd.randbytes(32) for _ in range(800)])
+
+    # present and absent keys, absent ones are inserted later
+    query_keys = rnd.sample(keys[:800], 40) + keys[800:840]
+    proof = await _skmt.generate_proof(query_keys)
+    tree = skmt.ProofTree(query_keys, proof)
+    assert tree.root_hash == _skmt.root.hash
+    assert tree.proof() == proof
+    # only the path of the updated key is hashed again
+    start_hashes = tree.stats["hashes"]
+    tree.update(query_keys[:1], [b"1"])
+    assert tree.stats["hashes"] - start_hashes <= 1 + len(proof.queries[0].binary_bitmap)
+
+    patched = 0
+    for _ in range(20):
+        update_keys = rnd.sample(query_keys, 8)
+        update_values = [rnd.randbytes(32) if rnd.random() < 0.7 else b"" for _ in update_keys]
+        # None if a removed leaf had a sibling known only by its hash
+        updated = skmt.update_proof(query_keys, proof, update_keys, update_values)
+        root = await _skmt.update(update_keys, update_values)
+        if updated is not None:
+            new_proof, new_root = updated
+            assert new_root == root.hash
+            assert new_proof == await _skmt.generate_proof(query_keys)
+            assert skmt.verify(query_keys, new_proof, new_root)
+            patched += 1
+        proof = await _skmt.generate_proof(query_keys)
+    assert patched > 0
+
+    # keys outside of the proof can not be updated
+    assert skmt.update_proof(query_keys, proof, keys[900:901], [b"1"]) is None
+    with pytest.raises(MissingNodeError):
+        skmt.ProofTree(query_keys, proof).update(keys[900:901], [b"1"])
+
+
+def test_proof_tree_missing_sibling():
+    asyncio.run(proof_tree_missing_sibling())
+
+
+async def proof_tree_missing_sibling():
+    # the queried leaf has a subtree as sibling, the proof gives its hash only
+    query_key = bytes.fromhex("00" * 32)
+    other_keys = [bytes.fromhex("40" + "00" * 31), bytes.fromhex("60" + "00" * 31)]
+    _skmt = skmt.SkipMerkleTree()
+    await _skmt.update([query_key] + other_keys, [b"a", b"b", b"c"])
+    proof = await _skmt.generate_proof([query_key])
+
+    # removing the leaf would push up the sibling: the proof can not tell if it is a leaf or a branch
+    tree = skmt.ProofTree([query_key], proof)
+    with pytest.raises(MissingNodeError):
+        tree.update([query_key], [b""])
+    # a failed update is not applied, not even in part
+    with pytest.raises(MissingNodeError):
+        tree.update([query_key, other_keys[0]], [b"z", b"d"])
+    assert tree.root_hash == _skmt.root.hash
+    assert tree.proof() == proof
+    assert skmt.update_proof([query_key], proof, [query_key], [b""]) is None
+
+    # the caller generates the proof again from the tree
+    root = await _skmt.update([query_key], [b""])
+    new_proof = await _skmt.generate_proof([query_key])
+    assert skmt.verify([query_key], new_proof, root.hash)
+
+
+def test_proof_tree_split_and_push_up():
+    asyncio.run(proof_tree_split_and_push_up())
+
+
+async def proof_tree_split_and_push_up():
+    # a new key below a queried leaf splits it, removing the new key again pushes the leaf back up
+    leaf_key = bytes.fromhex("f0" + "00" * 31)
+    near_key = bytes.fromhex("f001" + "00" * 30)
+    _skmt = skmt.SkipMerkleTree()
+    await _skmt.update([bytes(32), leaf_key], [b"a", b"b"])
+    query_keys = [leaf_key, near_key]
+    proof = await _skmt.generate_proof(query_keys)
+
+    tree = skmt.ProofTree(query_keys, proof)
+    assert tree.update([near_key], [b"c"]) == (await _skmt.update([near_key], [b"c"])).hash
+    assert tree.proof() == await _skmt.generate_proof(query_keys)
+    assert tree.update([near_key], [b""]) == (await _skmt.update([near_key], [b""])).hash
+    assert tree.proof() == proof
@@ -40,6 +40,28 @@ def test_skip_merkle_tree_inclusion_and_non_inclusion(capsys):
     for case in test_cases:
         asyncio.run(skip_random_test(case, capsys))
 
+def test_query_bit_paths():
+    key = bytes.fromhex("b3" + "00" * 31)
+    q = Query(key, b"", b"\x16")
+    assert q.height == 5
+    assert q.binary_bitmap == "10110"
+    assert q.binary_path == "10110"
+    assert q.bitmap_bit == 1 and q.key_bit == 0
+    q.move_up()
+    assert q.height == 4
+    assert q.binary_bitmap == "0110"
+    assert q.binary_path == "1011"
+    assert q.bitmap_bit == 0 and q.key_bit == 1
+    assert q.path == (4, 0b1011)
+    assert q.is_sibling_of(Query(bytes.fromhex("a0" + "00" * 31), b"", b"\x0f"))
+    assert not q.is_sibling_of(Query(bytes.fromhex("b0" + "00" * 31), b"", b"\x0f"))
+
+def test_calculate_root_duplicate_queries():
+    asyncio.run(calculate_root_duplicate_queries())
+
+def test_skip_merkle_tree_batch_proof(capsys):
+    asyncio.run(skip_batch_proof_test(capsys))
+
 async def skip_test(case, capsys):
     keys = case["keys"]
     values = case["values"]
@@ -135,3 +157,45 @@ async def skip_random_test(case, capsys):
     delete_proof = await _skmt.generate_proof(query_keys + non_included_keys) 
     assert verify(query_keys + non_included_keys, delete_proof, del_root.hash)
     assert is_inclusion_proof(query_keys[0], delete_proof.queries[0]) == False
+
+
+async def skip_batch_proof_test(capsys):
+    import time
+    N = 20000
+    Q = 1000
+    keys = [os.urandom(32) for _ in range(N)]
+    values = [os.urandom(32) for _ in range(N)]
+    # inclusion, non-inclusion and duplicated query keys
+    query_keys = random.sample(keys, Q) + [os.urandom(32) for _ in range(Q)]
+    query_keys += query_keys[:10]
+
+    _skmt = skmt.SkipMerkleTree()
+    await _skmt.update(keys, values)
+
+    start_time = time.time()
+    proof = await _skmt.generate_proof(query_keys)
+    with capsys.disabled():
+        print(f"\nbatch proof for {len(query_keys)} keys on {N} leaves: {time.time() - start_time:.2f}s")
+
+    assert verify(query_keys, proof, _skmt.root.hash)
+    assert len(set(proof.sibling_hashes)) == len(proof.sibling_hashes)
+    # each query is the same as the one of the single key proof
+    for k, q in zip(query_keys[:50], proof.queries[:50]):
+        single_query = (await _skmt.generate_proof([k])).queries[0]
+        assert (q.key, q.value, q.bitmap) == (single_query.key, single_query.value, single_query.bitmap)
+
+
+async def calculate_root_duplicate_queries():
+    keys = [os.urandom(32) for _ in range(500)]
+    values = [os.urandom(32) for _ in range(500)]
+    _skmt = skmt.SkipMerkleTree()
+    await _skmt.update(keys, values)
+
+    query_keys = keys[:20] + keys[:5] + [os.urandom(32) for _ in range(50)]
+    proof = await _skmt.generate_proof(query_keys)
+    queries = [Query(q.key, q.value, q.bitmap) for q in proof.queries]
+    # queries pointing to the same node are merged by path
+    assert len(skmt.QueryQueue(queries)) < len(queries)
+    assert skmt.calculate_root(proof.sibling_hashes, queries) == _skmt.root.hash
+    # sibling hashes are not consumed
+    assert skmt.calculate_root(proof.sibling_hashes, proof.queries) == _skmt.root.hash
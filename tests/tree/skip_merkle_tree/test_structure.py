@@ -181,3 +181,26 @@ def test_nodes():
 
     print(data.hex())
     print(_hash.hex())
+
+
+def test_round_trip(capsys):
+    import time
+    from dingus.tree.types import LeafNode, StubNode, EmptyNode
+
+    for n in [1, 16, 256]:
+        nodes = [
+            [LeafNode(os.urandom(32), os.urandom(32)), StubNode(os.urandom(32)), EmptyNode()][i % 3]
+            for i in range(n)
+        ]
+        structure = [(n - 1).bit_length() for _ in range(n)]
+        st = SubTree(structure, nodes, hasher.TreeHasher())
+        data = st.data
+        assert SubTree.parse(data) == (structure, nodes)
+        assert SubTree.parse(memoryview(data)) == (structure, nodes)
+        assert SubTree(*SubTree.parse(data), hasher.TreeHasher()).data == data
+
+        start_time = time.time()
+        for _ in range(1000):
+            SubTree(*SubTree.parse(data), hasher.TreeHasher()).data
+        with capsys.disabled():
+            print(f"\n1000 round trips of a {n}-node subtree: {time.time() - start_time:.3f}s")
@@ -1,7 +1,36 @@
-from dingus.tree.hasher import TreeHasher, ECCHasher
-from dingus.tree.types import LeafNode
+from dingus.tree.hasher import TreeHasher, ECCHasher, HashCounter
+from dingus.tree.types import LeafNode, EmptyNode, SubTree
+from dingus.tree.constants import BRANCH_PREFIX
+from dingus.tree.skip_merkle_tree import SkipMerkleTree
+from dingus.tree.sparse_merkle_tree import SparseMerkleTree
+from dingus.crypto import hash
+from dataclasses import FrozenInstanceError
+import asyncio
 import os
+import pytest
 import random
+import time
+
+
+def layered_hash(nodes: list, structure: list[int]) -> bytes:
+    # reference implementation, reducing the subtree layer by layer
+    hashes = [node.hash for node in nodes]
+    for height in reversed(range(1, max(structure) + 1)):
+        _hashes = []
+        _structure = []
+        i = 0
+        while i < len(hashes):
+            if structure[i] == height:
+                _hashes.append(hash(BRANCH_PREFIX + hashes[i] + hashes[i + 1]))
+                _structure.append(height - 1)
+                i += 2
+            else:
+                _hashes.append(hashes[i])
+                _structure.append(structure[i])
+                i += 1
+        hashes = _hashes
+        structure = _structure
+    return hashes[0]
 
 
 def test_tree_hasher():
@@ -12,6 +41,80 @@ def test_tree_hasher():
         TreeHasher.hash(nodes, structure)
 
 
+def test_tree_hasher_compatibility():
+    _skmt = SkipMerkleTree()
+    asyncio.run(_skmt.update([os.urandom(32) for _ in range(3000)], [os.urandom(32) for _ in range(3000)]))
+    subtrees = [_skmt.root] + [asyncio.run(_skmt.get_subtree(node.hash)) for node in _skmt.root.nodes[:20]]
+    for subtree in subtrees:
+        assert TreeHasher.hash(subtree.nodes, subtree.structure) == layered_hash(subtree.nodes, subtree.structure)
+
+    # empty pairs
+    nodes = [EmptyNode(), EmptyNode(), LeafNode(os.urandom(32), os.urandom(32)), EmptyNode()]
+    structure = [2, 2, 2, 2]
+    assert TreeHasher.hash(nodes, structure) == layered_hash(nodes, structure)
+
+
+def test_tree_hasher_benchmark(capsys):
+    n = 256
+    structure = [8 for _ in range(n)]
+    full = [LeafNode(os.urandom(32), os.urandom(32)) for _ in range(n)]
+    sparse = [LeafNode(os.urandom(32), os.urandom(32)) if i % 16 == 0 else EmptyNode() for i in range(n)]
+    for name, nodes in [("full", full), ("sparse", sparse)]:
+        for node in nodes:
+            node.hash
+        start_time = time.time()
+        for _ in range(1000):
+            layered_hash(nodes, structure)
+        layered_time = time.time() - start_time
+
+        start_time = time.time()
+        for _ in range(1000):
+            TreeHasher.hash(nodes, structure)
+        tree_hasher_time = time.time() - start_time
+        with capsys.disabled():
+            print(f"\n1000 {name} {n}-node subtrees: layered {layered_time:.3f}s, TreeHasher {tree_hasher_time:.3f}s")
+
+
+def test_memoized_hash():
+    n = 256
+    nodes = [LeafNode(os.urandom(32), os.urandom(32)) for _ in range(n)]
+    structure = [8 for _ in range(n)]
+    subtree = SubTree(structure, nodes, TreeHasher())
+
+    start = HashCounter.count
+    subtree_hash = subtree.hash
+    # one hash per leaf and one per internal branch
+    assert HashCounter.count - start == 2 * n - 1
+    assert subtree.hash == subtree_hash == TreeHasher.hash(nodes, structure)
+    assert HashCounter.count - start == 2 * n - 1 + n - 1
+
+    # the cached hashes can not go stale
+    with pytest.raises(FrozenInstanceError):
+        nodes[0].value = os.urandom(32)
+    with pytest.raises(FrozenInstanceError):
+        subtree.nodes = nodes[::-1]
+
+
+def test_hash_counter_context():
+    asyncio.run(hash_counter_context())
+
+
+async def hash_counter_context():
+    keys = [[os.urandom(32) for _ in range(n)] for n in [2000, 500]]
+    alone = []
+    for k in keys:
+        _smt = SparseMerkleTree(concurrency=4)
+        await _smt.update(k, k)
+        alone.append(_smt.stats["hashes"])
+
+    # trees updated at the same time count their own hashes only
+    trees = [SparseMerkleTree(concurrency=4) for _ in keys]
+    with HashCounter() as counter:
+        await asyncio.gather(*[_smt.update(k, k) for _smt, k in zip(trees, keys)])
+    assert [_smt.stats["hashes"] for _smt in trees] == alone
+    assert counter.hashes == sum(alone)
+
+
 def test_ecc_hasher():
     n = 256
     nodes = [LeafNode(os.urandom(32), os.urandom(32)) for _ in range(n)]
@@ -0,0 +1,43 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree, verify
+from dingus.tree.sparse_merkle_tree import SparseMerkleTree
+from dingus.tree.errors import InvalidHeightError
+from dingus.tree.types import SubTree
+import asyncio
+import pytest
+import random
+
+
+def test_subtree_heights():
+    asyncio.run(subtree_heights())
+
+
+async def subtree_heights():
+    # the root does not depend on the subtree height. With 38 bytes keys the last subtree layer is partial
+    # for most heights.
+    rnd = random.Random(0)
+    key_length = 38
+    keys = [rnd.randbytes(key_length) for _ in range(400)]
+    values = [rnd.randbytes(32) for _ in keys]
+    query_keys = keys[:20] + [rnd.randbytes(key_length) for _ in range(5)]
+    _sparse = SparseMerkleTree(key_length)
+    await _sparse.update(keys, values)
+    for k in keys[:40]:
+        await _sparse.remove(k)
+
+    for subtree_height in range(1, 17):
+        _smt = SkipMerkleTree(key_length, subtree_height)
+        await _smt.update(keys, values)
+        root = await _smt.update(keys[:40], [b""] * 40)
+        assert root.hash == _sparse.root.hash
+        proof = await _smt.generate_proof(query_keys)
+        assert verify(query_keys, proof, root.hash, key_length)
+        _bulk = SkipMerkleTree(key_length, subtree_height)
+        assert (await _bulk.bulk_load(sorted(zip(keys[40:], values[40:])))).hash == root.hash
+        # subtrees higher than 8 have more than 256 nodes, their node count takes 2 bytes
+        for data in _smt._db.kv.values():
+            structure, nodes = SubTree.parse(data, key_length, _smt.count_size)
+            assert SubTree(structure, nodes, _smt.hasher).encode(_smt.count_size) == data
+
+    for subtree_height in [0, 17]:
+        with pytest.raises(InvalidHeightError):
+            SkipMerkleTree(key_length, subtree_height)
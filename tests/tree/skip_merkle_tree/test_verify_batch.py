@@ -0,0 +1,63 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree, verify, verify_batch
+from dingus.tree.types import Proof, Query, VerifyFailure
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import time
+
+
+async def create_proofs(n: int) -> list[tuple[list[bytes], Proof, bytes]]:
+    keys = [os.urandom(32) for _ in range(5000)]
+    _smt = SkipMerkleTree()
+    root = await _smt.update(keys, [os.urandom(32) for _ in keys])
+    proofs = []
+    for i in range(n):
+        query_keys = keys[3 * i : 3 * i + 2] + [os.urandom(32)]
+        proofs.append((query_keys, await _smt.generate_proof(query_keys), root.hash))
+    return proofs
+
+
+def test_verify_batch():
+    proofs = asyncio.run(create_proofs(200))
+    query_keys, proof, root = proofs[0]
+    bad_proofs = [
+        (query_keys[:2], proof, root),
+        (query_keys, proof, os.urandom(32)),
+        (query_keys, Proof(proof.sibling_hashes[:-1], proof.queries), root),
+        (query_keys, Proof(proof.sibling_hashes + [os.urandom(32)], proof.queries), root),
+        (query_keys[:2] + [query_keys[2][:31]], proof, root),
+        (query_keys[:2] + [query_keys[0]], proof, root),
+        (query_keys, Proof(proof.sibling_hashes, proof.queries[:2] + [Query(proof.queries[2].key, b"", b"\x00" + proof.queries[2].bitmap)]), root),
+    ]
+    expected = [
+        (VerifyFailure.QUERY_COUNT, None),
+        (VerifyFailure.ROOT_MISMATCH, None),
+        (VerifyFailure.MISSING_SIBLING_HASHES, None),
+        (VerifyFailure.MALFORMED_PROOF, None),
+        (VerifyFailure.KEY_LENGTH, 2),
+        (VerifyFailure.KEY_NOT_COVERED, 2),
+        (VerifyFailure.BITMAP_LEADING_ZEROS, 2),
+    ]
+    batch = proofs + bad_proofs
+
+    sequential = verify_batch(batch)
+    assert [r.index for r in sequential] == list(range(len(batch)))
+    assert all(r.valid for r in sequential[: len(proofs)])
+    assert [(r.failure, r.query_index) for r in sequential[len(proofs) :]] == expected
+    assert verify_batch(batch, workers=2) == sequential
+    with ThreadPoolExecutor(2) as executor:
+        assert verify_batch(batch, executor=executor) == sequential
+
+    # verification does not modify the proofs
+    assert all(verify(query_keys, proof, root) for query_keys, proof, root in proofs)
+
+
+def test_verify_batch_throughput(capsys):
+    proofs = asyncio.run(create_proofs(1000))
+    with capsys.disabled():
+        print()
+        for workers in [1, 4]:
+            start_time = time.time()
+            assert all(r.valid for r in verify_batch(proofs, workers=workers))
+            elapsed = time.time() - start_time
+            print(f"verify {len(proofs)} proofs with {workers} workers: {elapsed:.2f}s, {len(proofs) / elapsed:.0f} proofs/s")
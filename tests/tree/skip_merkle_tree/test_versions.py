@@ -0,0 +1,74 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree, verify
+from dingus.tree.types import StubNode
+from dingus.tree.errors import InvalidHeightError, MissingNodeError
+import asyncio
+import os
+import pytest
+
+
+async def reachable(tree: SkipMerkleTree, root_hash: bytes) -> set[bytes]:
+    # hashes of the subtrees below root_hash, root included
+    hashes = set()
+    stack = [root_hash]
+    while len(stack) > 0:
+        node_hash = stack.pop()
+        hashes.add(node_hash)
+        subtree = await tree.get_subtree(node_hash)
+        stack += [node.hash for node in subtree.nodes if isinstance(node, StubNode)]
+    return hashes
+
+
+def test_versions():
+    asyncio.run(versions())
+
+
+async def versions():
+    keys = [os.urandom(32) for _ in range(3000)]
+    _smt = SkipMerkleTree(retention=2)
+
+    roots = {}
+    for height in range(6):
+        # insert new keys, update and delete some of the old ones
+        block_keys = keys[500 * height : 500 * (height + 1)] + keys[: 100 * height]
+        block_values = [os.urandom(32) if i % 3 else b"" for i in range(len(block_keys))]
+        roots[height] = (await _smt.update(block_keys, block_values, height)).hash
+
+    assert list(_smt.versions.items()) == [(h, roots[h]) for h in [3, 4, 5]]
+    assert _smt.stats["versions"] == 3
+    for height in [3, 4, 5]:
+        assert (await _smt.get_root(height)).hash == roots[height]
+        proof = await _smt.generate_proof(keys[:50], root=roots[height])
+        assert verify(keys[:50], proof, roots[height], 32)
+
+    # pruned versions are gone, the db holds exactly the subtrees of the retained ones
+    with pytest.raises(InvalidHeightError):
+        await _smt.get_root(2)
+    with pytest.raises(MissingNodeError):
+        await _smt.generate_proof(keys[:50], root=roots[2])
+    live = set()
+    for height in [3, 4, 5]:
+        live |= await reachable(_smt, roots[height])
+    assert set(_smt._db.kv.keys()) == live
+    assert _smt.stats["db_bytes"] == sum(len(data) for data in _smt._db.kv.values())
+    assert _smt.stats["stale_bytes"] == sum(size for _, size in _smt._stale.values())
+
+    with pytest.raises(InvalidHeightError):
+        await _smt.update(keys[:1], [b"1"], 5)
+
+
+def test_no_retention():
+    asyncio.run(no_retention())
+
+
+async def no_retention():
+    keys = [os.urandom(32) for _ in range(2000)]
+    values = [os.urandom(32) for _ in range(2000)]
+    _smt = SkipMerkleTree()
+    root = await _smt.update(keys, values)
+    await _smt.update(keys[:1000], [b""] * 1000)
+    # only the latest version is kept, deleting and inserting back gives the same subtrees
+    new_root = await _smt.update(keys[:1000], values[:1000])
+    assert new_root.hash == root.hash
+    assert list(_smt.versions.keys()) == [2]
+    assert set(_smt._db.kv.keys()) == await reachable(_smt, root.hash)
+    assert _smt.stats["stale_subtrees"] == 0
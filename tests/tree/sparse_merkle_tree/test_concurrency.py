@@ -0,0 +1,31 @@
+from dingus.tree.sparse_merkle_tree import SparseMerkleTree
+from tests.tree.utils import LatencyDB
+import asyncio
+import random
+
+
+def test_concurrent_update():
+    asyncio.run(concurrent_update())
+
+
+async def concurrent_update():
+    rnd = random.Random(0)
+    keys = [rnd.randbytes(32) for _ in range(500)]
+    values = [rnd.randbytes(32) for _ in keys]
+    batch_keys = rnd.sample(keys, 30) + [rnd.randbytes(32) for _ in range(30)]
+    batch_values = [rnd.randbytes(32) for _ in batch_keys]
+
+    results = {}
+    for concurrency in [1, 4, 16]:
+        _smt = SparseMerkleTree(concurrency=concurrency)
+        _smt._db = LatencyDB()
+        await _smt.update(keys, values)
+        _smt._db.max_in_flight = 0
+        root = await _smt.update(batch_keys, batch_values)
+        results[concurrency] = (root.hash, _smt._db.kv)
+        # reads overlap up to the concurrency, never beyond
+        assert _smt._db.max_in_flight == concurrency
+
+    # the same root and the same stored nodes whatever the concurrency
+    for concurrency in [4, 16]:
+        assert results[concurrency] == results[1]
@@ -0,0 +1,41 @@
+from dingus.tree.sparse_merkle_tree import SparseMerkleTree
+from dingus.tree.errors import InvalidKeyError
+import asyncio
+import pytest
+import random
+
+
+def test_remove_many(capsys):
+    asyncio.run(remove_many(capsys))
+
+
+async def remove_many(capsys):
+    rnd = random.Random(0)
+    keys = [rnd.randbytes(32) for _ in range(3000)]
+    values = [rnd.randbytes(32) for _ in keys]
+    _smt = SparseMerkleTree()
+    _single = SparseMerkleTree()
+    await _smt.update(keys, values)
+    await _single.update(keys, values)
+
+    # missing keys are ignored
+    for removed in [rnd.sample(keys, 1), rnd.sample(keys, 1000) + [rnd.randbytes(32) for _ in range(50)], keys[:2990]]:
+        db_set = (_smt.stats["db_set"], _single.stats["db_set"])
+        hashes = _smt.stats["hashes"]
+        root = await _smt.remove_many(removed)
+        for k in removed:
+            await _single.remove(k)
+        keys = [k for k in keys if k not in set(removed)]
+        assert root.hash == _single.root.hash
+        # the store holds the nodes of the new tree only, each rewritten branch is written once
+        assert set(_smt._db.kv) == set(_single._db.kv)
+        assert _smt.stats["db_set"] - db_set[0] <= _single.stats["db_set"] - db_set[1]
+        assert _smt.stats["hashes"] > hashes
+        with capsys.disabled():
+            print(f"\nremove {len(removed)} keys: {_smt.stats['db_set'] - db_set[0]} writes, {_single.stats['db_set'] - db_set[1]} with remove")
+
+    root = await _smt.remove_many(keys)
+    assert root.hash == SparseMerkleTree().root.hash
+    assert len(_smt._db.kv) == 0
+    with pytest.raises(InvalidKeyError):
+        await _smt.remove_many([b"\x00"])
@@ -3,9 +3,11 @@ from dingus.tree.sparse_merkle_tree import SparseMerkleTree
 from dingus.tree.constants import EMPTY_HASH
 import time
 import asyncio
-from tests.tree.utils import create_test_case
+import random
+from tests.tree.utils import create_test_case, LatencyDB
 
 KEY_LENGTH = 32
+LATENCY = 0.0005
 
 
 def test_large_update(capsys) -> None:
@@ -44,3 +46,28 @@ async def case_testing_batch(
         )
 
     return _smt
+
+
+def test_concurrent_update(capsys):
+    asyncio.run(concurrent_update(capsys))
+
+
+async def concurrent_update(capsys):
+    # update latency on a db with slow reads
+    rnd = random.Random(0)
+    keys = [rnd.randbytes(32) for _ in range(5000)]
+    values = [rnd.randbytes(32) for _ in keys]
+    batch_keys = rnd.sample(keys, 300) + [rnd.randbytes(32) for _ in range(300)]
+    batch_values = [rnd.randbytes(32) for _ in batch_keys]
+
+    for concurrency in [1, 4, 16]:
+        _smt = SparseMerkleTree(concurrency=concurrency)
+        _smt._db = LatencyDB(LATENCY)
+        await _smt.update(keys, values)
+        _smt._db.max_in_flight = 0
+        db_get = _smt.stats["db_get"]
+        start_time = time.time()
+        await _smt.update(batch_keys, batch_values)
+        elapsed = time.time() - start_time
+        with capsys.disabled():
+            print(f"\nconcurrency {concurrency}: {1000 * elapsed:.0f}ms, {_smt.stats['db_get'] - db_get} reads, {_smt._db.max_in_flight} in flight")
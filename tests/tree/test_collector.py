@@ -0,0 +1,110 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree, verify
+from dingus.tree.sparse_merkle_tree import SparseMerkleTree
+from dingus.db import InMemoryDB, SqliteDB
+import asyncio
+import os
+import random
+
+
+async def reachable(tree: SkipMerkleTree | SparseMerkleTree) -> set[bytes]:
+    # hashes of the stored nodes reachable from the live roots, all of them must be in the db
+    hashes = set()
+    stack = list(tree.live_roots())
+    while len(stack) > 0:
+        node_hash = stack.pop()
+        if node_hash in hashes:
+            continue
+        hashes.add(node_hash)
+        data = await tree._db.get(node_hash)
+        assert data, "live node was deleted"
+        stack += tree.node_children(data)
+    return hashes
+
+
+async def stored_keys(db) -> set[bytes]:
+    keys = set()
+    page, after = await db.keys_page(None, 100)
+    keys.update(page)
+    while after is not None:
+        page, after = await db.keys_page(after, 100)
+        keys.update(page)
+    return keys
+
+
+def test_skip_merkle_tree_collector():
+    asyncio.run(skip_merkle_tree_collector())
+
+
+async def skip_merkle_tree_collector():
+    rnd = random.Random(0)
+    keys = [os.urandom(32) for _ in range(2000)]
+    values = [os.urandom(32) for _ in range(2000)]
+    _smt = SkipMerkleTree(retention=2, gc_slice=0.0)
+    _eager = SkipMerkleTree(retention=2)
+    await _smt.update(keys, values)
+    await _eager.update(keys, values)
+
+    for i in range(30):
+        # churn: delete a block of keys and insert them back later, recreating the same subtrees
+        block_keys = keys[100 * (i % 5) : 100 * (i % 5 + 1)] + rnd.sample(keys, 50)
+        block_keys = list(dict.fromkeys(block_keys))
+        block_values = [b"" if i % 2 == 0 else values[keys.index(k)] for k in block_keys]
+        root = await _smt.update(block_keys, block_values)
+        assert root.hash == (await _eager.update(block_keys, block_values)).hash
+        await reachable(_smt)
+        for height, root_hash in _smt.versions.items():
+            proof = await _smt.generate_proof(keys[:20], root=root_hash)
+            assert verify(keys[:20], proof, root_hash, 32)
+
+    await _smt._collector.collect()
+    await _smt._collector.collect()
+    assert _smt._collector.stats["swept"] > 0
+    # the store holds the live state only, as with eager deletion
+    assert set(_smt._db.kv.keys()) == await reachable(_smt) == set(_eager._db.kv.keys())
+
+
+def test_sparse_merkle_tree_collector(tmp_path):
+    asyncio.run(sparse_merkle_tree_collector(str(tmp_path / "smt.sqlite")))
+
+
+async def sparse_merkle_tree_collector(filename):
+    keys = [os.urandom(32) for _ in range(500)]
+    values = [os.urandom(32) for _ in range(500)]
+    _smt = SparseMerkleTree(gc_slice=0.0)
+    _smt._db = SqliteDB(filename)
+    _eager = SparseMerkleTree()
+    await _smt.update(keys, values)
+    await _eager.update(keys, values)
+
+    for i in range(10):
+        block_keys = keys[50 * i : 50 * (i + 1)]
+        block_values = [os.urandom(32) for _ in block_keys]
+        assert (await _smt.update(block_keys, block_values)).hash == (await _eager.update(block_keys, block_values)).hash
+        for k in block_keys[:5]:
+            assert (await _smt.remove(k)).hash == (await _eager.remove(k)).hash
+        await reachable(_smt)
+
+    await _smt._collector.collect()
+    await _smt._collector.collect()
+    assert await stored_keys(_smt._db) == await reachable(_smt) == set(_eager._db.kv.keys())
+
+
+def test_paged_sweep(tmp_path):
+    asyncio.run(paged_sweep(SqliteDB(str(tmp_path / "skmt.sqlite"))))
+    asyncio.run(paged_sweep(InMemoryDB()))
+
+
+async def paged_sweep(db):
+    keys = [os.urandom(32) for _ in range(1000)]
+    _smt = SkipMerkleTree(gc_slice=0.0)
+    _smt._db = db
+    _smt._collector.page_size = 8
+    await _smt.update(keys, keys)
+    await _smt.update(keys[:500], [b""] * 500)
+
+    # each step holds at most a page of keys
+    while not await _smt._collector.step(0.0):
+        assert len(_smt._collector._sweep_keys or []) <= 8
+    await _smt._collector.collect()
+    assert _smt._collector.stats["pages"] > 2
+    assert await stored_keys(_smt._db) == await reachable(_smt)
@@ -0,0 +1,62 @@
+from dingus.crypto import hash
+from dingus.tree import hasher
+from dingus.tree import sbit_merkle_tree
+from dingus.tree.constants import BRANCH_PREFIX, EMPTY_HASH
+from dingus.tree.skip_merkle_tree import SkipMerkleTree, verify
+from dingus.tree.sparse_merkle_tree import SparseMerkleTree
+import asyncio
+import random
+
+N = 5000
+
+
+def test_empty_subtree_hashes(monkeypatch, capsys) -> None:
+    # Empty subtrees are collapsed to a single empty node at any height, so an empty subtree hashes to EMPTY_HASH
+    # whatever its height. No branch of two empty subtrees is hashed: a table of empty subtree hashes by height
+    # would never be hit. Hashes with a single empty child depend on the other child and can not be precomputed.
+    empty_hashes = [EMPTY_HASH]
+    for _ in range(8 * 32):
+        empty_hashes.append(hash(BRANCH_PREFIX + empty_hashes[-1] + empty_hashes[-1]))
+    empty_branches = set(BRANCH_PREFIX + h + h for h in empty_hashes)
+    counts = {"total": 0, "empty_children": 0, "one_empty_child": 0}
+
+    def counting_hash(data: bytes) -> bytes:
+        counts["total"] += 1
+        if data in empty_branches:
+            counts["empty_children"] += 1
+        elif data.startswith(BRANCH_PREFIX) and EMPTY_HASH in (data[len(BRANCH_PREFIX) : -len(EMPTY_HASH)], data[-len(EMPTY_HASH) :]):
+            counts["one_empty_child"] += 1
+        return hash(data)
+
+    monkeypatch.setattr(hasher, "hash", counting_hash)
+    rnd = random.Random(0)
+    keys = [rnd.randbytes(32) for _ in range(N)]
+    query_keys = keys[:100] + [rnd.randbytes(32) for _ in range(100)]
+
+    async def workloads():
+        _skip = SkipMerkleTree()
+        _sparse = SparseMerkleTree()
+        _sbit = sbit_merkle_tree.SkipMerkleTree()
+        yield "skip update", _skip.update(keys, keys)
+        yield "skip delete", _skip.delete(keys[N // 2 :])
+        yield "skip proof", _skip.generate_proof(query_keys)
+        proof = await _skip.generate_proof(query_keys)
+        counts.update(dict.fromkeys(counts, 0))
+        assert verify(query_keys, proof, _skip.root.hash)
+        yield "skip verify", None
+        yield "sparse update", _sparse.update(keys, keys)
+        yield "sparse remove", _sparse.remove_many(keys[N // 2 :])
+        yield "sbit update", _sbit.update(keys, keys)
+
+    async def run():
+        with capsys.disabled():
+            print(f"\nrandom 32 bytes keys, {N} leaves")
+        async for name, workload in workloads():
+            if workload is not None:
+                counts.update(dict.fromkeys(counts, 0))
+                await workload
+            with capsys.disabled():
+                print(f"{name}: {counts['total']} hashes, {counts['one_empty_child']} with an empty child")
+            assert counts["empty_children"] == 0
+
+    asyncio.run(run())
@@ -0,0 +1,7 @@
+from dingus.tree.types import LeafNode, BranchNode, StubNode, EmptyNode, Query
+
+
+def test_slotted_nodes() -> None:
+    for node in [LeafNode(b"k", b"v"), BranchNode(b"l", b"r"), StubNode(b"h"), EmptyNode(), Query(b"k", b"v", b"")]:
+        assert not hasattr(node, "__dict__")
+    assert EmptyNode() is EmptyNode()
@@ -0,0 +1,32 @@
+from dingus.tree.skip_merkle_tree import SkipMerkleTree
+from dingus.tree.sparse_merkle_tree import SparseMerkleTree
+from dingus.tree import sbit_merkle_tree
+from dingus.tree.types import LeafNode, StubNode
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+KEY_LENGTH = 32
+N = 20000
+
+
+def test_memory_footprint(capsys) -> None:
+    keys = [os.urandom(KEY_LENGTH) for _ in range(N)]
+    values = [os.urandom(32) for _ in range(N)]
+
+    with capsys.disabled():
+        print(f"\nLeafNode: {sys.getsizeof(LeafNode(keys[0], values[0]))}B, StubNode: {sys.getsizeof(StubNode(values[0]))}B")
+        for name, tree in [
+            ("skip", SkipMerkleTree(KEY_LENGTH)),
+            ("sparse", SparseMerkleTree(KEY_LENGTH)),
+            ("sbit", sbit_merkle_tree.SkipMerkleTree(KEY_LENGTH)),
+        ]:
+            tracemalloc.start()
+            start_time = time.time()
+            asyncio.run(tree.update(keys, values))
+            elapsed = time.time() - start_time
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{name} tree with {N} leaves: {elapsed:.2f}s, retained {current / N:.0f}B/leaf, peak {peak / 2**20:.1f}MiB")
@@ -0,0 +1,71 @@
+from dingus.tree.merkle_tree import MerkleTree, MerkleProof, NodeStore
+from dingus.tree.errors import InvalidDataError, MissingNodeError
+import pytest
+import random
+
+
+def test_inclusion_proofs():
+    rnd = random.Random(0)
+    data = [rnd.randbytes(8) for _ in range(140)]
+    for n in range(len(data) + 1):
+        mt = MerkleTree(data[:n], NodeStore())
+        assert mt.root == MerkleTree(data[:n]).root
+        for n_indexes in [0, 1, 2, 5]:
+            indexes = rnd.sample(range(n), min(n, n_indexes))
+            proof = mt.generate_proof(indexes)
+            assert proof.indexes == sorted(indexes)
+            values = [data[i] for i in proof.indexes]
+            assert MerkleTree.verify_proof(values, proof, mt.root)
+            if len(indexes) == 0:
+                continue
+            assert not MerkleTree.verify_proof([b"x"] + values[1:], proof, mt.root)
+            if len(proof.sibling_hashes) > 0:
+                assert not MerkleTree.verify_proof(values, MerkleProof(n, proof.indexes, proof.sibling_hashes[:-1]), mt.root)
+            assert not MerkleTree.verify_proof(values, MerkleProof(n, proof.indexes, proof.sibling_hashes + [mt.root]), mt.root)
+
+    with pytest.raises(IndexError):
+        mt.generate_proof([len(data)])
+    with pytest.raises(MissingNodeError):
+        MerkleTree(data).generate_proof([0])
+
+
+def test_consistency_proofs():
+    rnd = random.Random(0)
+    data = [rnd.randbytes(8) for _ in range(70)]
+    mt = MerkleTree(data, NodeStore())
+    roots = [MerkleTree(data[:n]).root for n in range(len(data) + 1)]
+    for size in range(len(data) + 1):
+        for old_size in range(size + 1):
+            proof = mt.generate_consistency_proof(old_size, size)
+            assert MerkleTree.verify_consistency(old_size, roots[old_size], size, roots[size], proof)
+            if 0 < old_size < size:
+                assert not MerkleTree.verify_consistency(old_size, roots[old_size - 1], size, roots[size], proof)
+                assert not MerkleTree.verify_consistency(old_size, roots[old_size], size, roots[size], proof[:-1])
+
+
+def test_node_store(tmp_path):
+    data = [i.to_bytes(4, "big") for i in range(100)]
+    filename = str(tmp_path / "outbox.tree")
+    directory = str(tmp_path / "nodes")
+    mt = MerkleTree(data[:37], NodeStore(directory))
+    mt.save(filename)
+    # nodes appended after the last save of the tree are dropped on load
+    mt.append(data[37:50])
+    mt.nodes.save()
+
+    loaded = MerkleTree.load(filename, NodeStore(directory))
+    assert loaded.size == 37
+    loaded.append(data[37:])
+    assert loaded.root == MerkleTree(data).root
+    proof = loaded.generate_proof([3, 36, 99])
+    assert MerkleTree.verify_proof([data[3], data[36], data[99]], proof, loaded.root)
+    loaded.save(filename)
+    # saved hashes are read from the level files, none is left in memory
+    assert all(len(pending) == 0 for pending in loaded.nodes._pending)
+    assert loaded.generate_proof([3, 36, 99]) == proof
+    assert MerkleTree.load(filename, NodeStore(directory)).generate_proof([3, 36, 99]) == proof
+
+    with pytest.raises(InvalidDataError):
+        MerkleTree(data, NodeStore(directory))
+    with pytest.raises(MissingNodeError):
+        MerkleTree.load(filename, NodeStore(str(tmp_path / "other")))
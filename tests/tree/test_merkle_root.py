@@ -1,8 +1,11 @@
 from dingus.tree.merkle_tree import MerkleTree
 from dingus.tree.utils import merkle_root
-from dingus.tree.constants import EMPTY_HASH
+from dingus.tree.constants import EMPTY_HASH, BRANCH_PREFIX
+from dingus.tree.errors import InvalidDataError
 from dingus.crypto import hash
 import json
+import pytest
+import random
 
 
 def test_empty_tree():
@@ -44,6 +47,56 @@ def test_right_witness_from_fixtures():
             wit_root = MerkleTree.root_from_right_witness(partial_mt.size, partial_mt.append_path, right_witness)
             assert wit_root == mt.root == _output
 
+def test_merkle_root():
+    data = [hash(int.to_bytes(i, 4, "big")) for i in range(300)]
+    for n in range(len(data) + 1):
+        root = MerkleTree(data[:n]).root
+        assert merkle_root(data[:n]) == MerkleTree.merkle_root(data[:n]) == root
+        # values can be streamed
+        assert merkle_root(iter(data[:n])) == merkle_root(d for d in data[:n]) == root
+
+    # as defined in LIP-0031, the left subtree holds the largest power of 2 smaller than the size
+    left_root, right_root = merkle_root(data[:4]), merkle_root(data[4:5])
+    assert merkle_root(data[:5]) == hash(BRANCH_PREFIX + left_root + right_root)
+
+
+def test_bulk_append():
+    rnd = random.Random(0)
+    data = [hash(int.to_bytes(i, 4, "big")) for i in range(300)]
+    for n in range(len(data) + 1):
+        mt = MerkleTree(data[:n])
+        assert mt.size == n
+        assert mt.root == MerkleTree.merkle_root(data[:n])
+        assert mt.root == MerkleTree.root_from_append_path(mt.append_path)
+        # appending in chunks of any size gives the same tree
+        chunked_mt = MerkleTree()
+        i = 0
+        while i < n:
+            k = rnd.randint(1, 20)
+            chunked_mt.append(data[i : min(i + k, n)])
+            i += k
+        assert chunked_mt.root == mt.root
+        assert chunked_mt.append_path == mt.append_path
+
+
+def test_save_and_load(tmp_path):
+    data = [hash(int.to_bytes(i, 4, "big")) for i in range(100)]
+    filename = str(tmp_path / "outbox.tree")
+    for n in [0, 1, 2, 37, 64]:
+        MerkleTree(data[:n]).save(filename)
+        mt = MerkleTree.load(filename)
+        assert mt.size == n
+        assert mt.root == MerkleTree(data[:n]).root
+        # the loaded tree resumes appending without the previous values
+        mt.append(data[n:])
+        assert mt.root == MerkleTree(data).root
+
+    encoded = MerkleTree(data[:37]).data
+    for invalid in [encoded[:-1], encoded + b"\x00", b""]:
+        with pytest.raises(InvalidDataError):
+            MerkleTree.from_data(invalid)
+
+
 def test_bin_stuff():
     for n in range(27):
         a = bin(n)[2:]
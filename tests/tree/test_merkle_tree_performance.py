@@ -0,0 +1,57 @@
+from dingus.tree.merkle_tree import MerkleTree, NodeStore
+from dingus.tree.utils import merkle_root
+import random
+import time
+
+N = 1 << 20
+
+
+def test_proofs_performance(capsys):
+    rnd = random.Random(0)
+    data = [rnd.randbytes(32) for _ in range(N)]
+    with capsys.disabled():
+        start_time = time.time()
+        mt = MerkleTree(data, NodeStore())
+        print(f"\nMerkleTree with {N} leaves and their nodes: {time.time() - start_time:.2f}s")
+
+        indexes = [rnd.randrange(N) for _ in range(1000)]
+        start_time = time.time()
+        proofs = [mt.generate_proof([i]) for i in indexes]
+        print(f"inclusion proof: {1e6 * (time.time() - start_time) / len(indexes):.0f}us, {len(proofs[0].sibling_hashes)} sibling hashes")
+        start_time = time.time()
+        for i, proof in zip(indexes, proofs):
+            assert MerkleTree.verify_proof([data[i]], proof, mt.root)
+        print(f"inclusion proof verification: {1e6 * (time.time() - start_time) / len(indexes):.0f}us")
+
+        for n_indexes in [16, 256]:
+            batch = rnd.sample(range(N), n_indexes)
+            start_time = time.time()
+            proof = mt.generate_proof(batch)
+            elapsed = time.time() - start_time
+            separate = sum(len(mt.generate_proof([i]).sibling_hashes) for i in batch)
+            start_time = time.time()
+            assert MerkleTree.verify_proof([data[i] for i in proof.indexes], proof, mt.root)
+            print(
+                f"{n_indexes} indexes: {1000 * elapsed:.1f}ms, verification {1000 * (time.time() - start_time):.1f}ms, "
+                f"{len(proof.sibling_hashes)} sibling hashes instead of {separate}"
+            )
+
+        old_size = rnd.randrange(N)
+        start_time = time.time()
+        proof = mt.generate_consistency_proof(old_size)
+        elapsed = time.time() - start_time
+        old_root = MerkleTree(data[:old_size]).root
+        assert MerkleTree.verify_consistency(old_size, old_root, N, mt.root, proof)
+        print(f"consistency proof from {old_size} leaves: {1e6 * elapsed:.0f}us, {len(proof)} hashes")
+
+
+def test_merkle_root_performance(capsys):
+    rnd = random.Random(0)
+    data = [rnd.randbytes(32) for _ in range(1 << 20)]
+    with capsys.disabled():
+        start_time = time.time()
+        root = merkle_root(data)
+        print(f"\nmerkle_root of {len(data)} values: {time.time() - start_time:.2f}s")
+        start_time = time.time()
+        assert merkle_root(iter(data)) == root
+        print(f"merkle_root of {len(data)} streamed values: {time.time() - start_time:.2f}s")
@@ -1,5 +1,7 @@
+import asyncio
 import os
-from dingus.utils import hash
+from dingus.crypto import hash
+from dingus.db import InMemoryDB
 
 KEY_LENGTH = 32
 
@@ -50,3 +52,19 @@ def create_test_case(n: int, key_length: int = KEY_LENGTH) -> list[tuple[bytes,
     values = [hash(k) for k in keys]
 
     return (keys, values)
+
+
+class LatencyDB(InMemoryDB):
+    # stand-in for a db doing real I/O: each read takes latency seconds, the in-flight reads are counted
+    def __init__(self, latency: float = 0.0) -> None:
+        super().__init__()
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get(self, key: bytes) -> bytes:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.latency)
+        self.in_flight -= 1
+        return await super().get(key)